@@ -7,34 +7,68 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
+import os, sys, time,torch,pickle,trimesh,itertools,zipfile,datetime,gzip,logging,importlib,uuid,signal,multiprocessing,subprocess,tarfile,argparse,hashlib,threading,queue,json,contextlib,functools
 from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
-from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
-from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
-from pytorch3d.renderer.mesh.shader import SoftDepthShader, HardFlatShader
-from pytorch3d.renderer.mesh.textures import Textures
-from pytorch3d.structures import Meshes
-from scipy.interpolate import griddata
-import nvdiffrast.torch as dr
 import torch.nn.functional as F
-import torchvision
 import torch.nn as nn
 from functools import partial
-import pandas as pd
-import open3d as o3d
 from uuid import uuid4
 import cv2
 from PIL import Image
 import numpy as np
 from collections import defaultdict
 import multiprocessing as mp
-import matplotlib.pyplot as plt
 import math,glob,re,copy
 from transformations import *
-from scipy.spatial import cKDTree
-from collections import OrderedDict
-import ruamel.yaml
-yaml = ruamel.yaml.YAML()
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyImport:
+  '''Stands in for a module, or an object built from one, and loads it on first attribute access or call.
+  Keeps dependencies that only debug and offline tools use out of the import time of the inference path
+  @loader: returns the object
+  '''
+  def __init__(self, loader):
+    self._loader = loader
+    self._obj = None
+
+  def _load(self):
+    if self._obj is None:
+      self._obj = self._loader()
+    return self._obj
+
+  def __getattr__(self, name):
+    if name.startswith('__') or name in ('_loader', '_obj'):
+      raise AttributeError(name)
+    return getattr(self._load(), name)
+
+  def __call__(self, *args, **kwargs):
+    return self._load()(*args, **kwargs)
+
+
+def lazy_import(name, attr=None):
+  '''LazyImport of module name, or of its attribute attr
+  '''
+  def loader():
+    module = importlib.import_module(name)
+    return module if attr is None else getattr(module, attr)
+  return LazyImport(loader)
+
+
+########## Only needed by debug, visualization and offline tools
+o3d = lazy_import('open3d')
+pd = lazy_import('pandas')
+plt = lazy_import('matplotlib.pyplot')
+scipy = lazy_import('scipy')
+griddata = lazy_import('scipy.interpolate', 'griddata')
+cKDTree = lazy_import('scipy.spatial', 'cKDTree')
+torchvision = lazy_import('torchvision')
+imageio = lazy_import('imageio')
+joblib = lazy_import('joblib')
+psutil = lazy_import('psutil')
+pdb = lazy_import('pdb')
+yaml = LazyImport(lambda: importlib.import_module('ruamel.yaml').YAML())
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(code_dir)
 # sys.path.append(f"{code_dir}/mycpp/build")
@@ -42,6 +76,10 @@ try:
   import kornia
 except:
   kornia = None
+try:
+  import nvdiffrast.torch as dr
+except:
+  dr = None
 try:
   import mycpp.build.mycpp as mycpp
 except:
@@ -91,27 +129,146 @@ COLOR_MAP=np.array([[0, 0, 0], #Ignore
                     ])
 
 
-def set_logging_format(level=logging.INFO):
-  importlib.reload(logging)
+def set_logging_format(level=logging.INFO, force=True):
+  '''
+  @force: replace the handlers the root logger already has, otherwise an application that configured logging keeps its setup
+  '''
   FORMAT = '[%(funcName)s()] %(message)s'
-  logging.basicConfig(level=level, format=FORMAT)
+  logging.basicConfig(level=level, format=FORMAT, force=force)
+
+set_logging_format(force=False)
+
+
+
+class Tracer:
+  '''Named spans (register, render, forward, ...) with their wall clock time, kept in a ring buffer and exported as Chrome trace JSON (chrome://tracing, Perfetto).
+  Off by default. span() then returns a shared no-op context, so instrumented hot paths only pay an attribute check.
+  Spans do not synchronize the device, so on cuda a span measures launching its kernels unless something inside waits for them. sync=True synchronizes at every span boundary for device timings, at the cost of the overlap
+  @capacity: spans kept, the oldest are dropped first
+  '''
+  def __init__(self, capacity=10000):
+    self.enabled = False
+    self.sync = False
+    self.events = deque(maxlen=capacity)   # (name, start ns, duration ns, thread id, args)
+
+
+  @contextlib.contextmanager
+  def _span(self, name, args):
+    if self.sync and torch.cuda.is_available():
+      torch.cuda.synchronize()
+    start = time.perf_counter_ns()
+    try:
+      yield
+    finally:
+      if self.sync and torch.cuda.is_available():
+        torch.cuda.synchronize()
+      self.events.append((name, start, time.perf_counter_ns()-start, threading.get_ident(), args))
+
+
+  def span(self, name, **args):
+    '''Context timing the enclosed code
+    @args: cheap values shown with the span, e.g. the number of poses. Never tensor contents, formatting them syncs the device
+    '''
+    if not self.enabled:
+      return _null_span
+    return self._span(name, args)
+
+
+  def now(self):
+    '''Timestamp to export the spans from, see export_chrome_trace
+    '''
+    return time.perf_counter_ns()
+
+
+  def export_chrome_trace(self, path=None, since=None):
+    '''
+    @since: now() at the start of the request, None exports every span in the buffer
+    Return: the trace as dict, also written to path if given
+    '''
+    pid = os.getpid()
+    events = [{'name': name, 'ph': 'X', 'ts': start/1e3, 'dur': dur/1e3, 'pid': pid, 'tid': tid, 'args': args} for name, start, dur, tid, args in list(self.events) if since is None or start>=since]
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    if path is not None:
+      with open(path, 'w') as ff:
+        json.dump(trace, ff)
+    return trace
+
 
-set_logging_format()
+  def clear(self):
+    self.events.clear()
 
 
+_null_span = contextlib.nullcontext()
+tracer = Tracer()   # Shared by the pipeline, enable with tracer.enabled = True
 
 
-def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
+def trace_span(name):
+  '''Decorator running the function inside tracer.span(name)
+  '''
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not tracer.enabled:
+        return fn(*args, **kwargs)
+      with tracer._span(name, {}):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+
+
+def texture_size_for_crop(lod_size, texels_per_px=4):
+  '''Power of two texture edge that keeps texels_per_px texels per pixel of the projected object diameter, uv atlases only spend part of the texture on the visible side
+  @lod_size: projected object diameter in output pixels, min(input_resize)/crop_ratio for the crops
+  '''
+  return int(2**np.ceil(np.log2(texels_per_px*lod_size)))
+
+
+def make_texture_mips(tex, min_size=16):
+  '''Box filtered mip chain of a uint8 (1,H,W,C) texture, finest first
+  '''
+  mips = [tex]
+  while min(tex.shape[1:3])>=2 and max(tex.shape[1:3])>min_size:
+    tex = F.avg_pool2d(tex.permute(0,3,1,2).float(), kernel_size=2, ceil_mode=True).round().to(torch.uint8).permute(0,2,3,1).contiguous()
+    mips.append(tex)
+  return mips
+
+
+def select_texture_mip(mesh_tensors, lod_size=None, texels_per_px=4):
+  '''Coarsest mip in mesh_tensors['tex_mips'] with enough texels for lod_size, as the float texture the samplers take
+  '''
+  mips = mesh_tensors.get('tex_mips', [mesh_tensors['tex']])
+  tex = mips[0]
+  if lod_size is not None:
+    for mip in mips[::-1]:
+      if max(mip.shape[1:3])>=texels_per_px*lod_size:
+        tex = mip
+        break
+  if tex.dtype==torch.uint8:
+    tex = tex.float().div_(255)
+  return tex
+
+
+def make_mesh_tensors(mesh, device='cuda', max_tex_size=None, lod_size=None):
+  '''
+  @max_tex_size: cap on the texture edge, derived from lod_size with texture_size_for_crop if not given
+  @lod_size: projected object diameter in output pixels the mesh is rendered at, see select_mesh_lod
+  '''
   mesh_tensors = {}
   if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
     img = np.array(mesh.visual.material.image.convert('RGB'))
     img = img[...,:3]
+    if max_tex_size is None and lod_size is not None:
+      max_tex_size = texture_size_for_crop(lod_size)
     if max_tex_size is not None:
       max_size = max(img.shape[0], img.shape[1])
       if max_size>max_tex_size:
         scale = 1/max_size * max_tex_size
-        img = cv2.resize(img, fx=scale, fy=scale, dsize=None)
-    mesh_tensors['tex'] = torch.as_tensor(img, device=device, dtype=torch.float)[None]/255.0
+        img = cv2.resize(img, fx=scale, fy=scale, dsize=None, interpolation=cv2.INTER_AREA)
+        logging.info(f"texture downsampled to {img.shape[1]}x{img.shape[0]}")
+    mesh_tensors['tex'] = torch.as_tensor(np.ascontiguousarray(img), device=device, dtype=torch.uint8)[None]   # Kept as uint8, converted when sampled
+    mesh_tensors['tex_mips'] = make_texture_mips(mesh_tensors['tex'])
     mesh_tensors['uv_idx']  = torch.as_tensor(mesh.faces, device=device, dtype=torch.int)
     uv = torch.as_tensor(mesh.visual.uv, device=device, dtype=torch.float)
     uv[:,1] = 1 - uv[:,1]
@@ -130,7 +287,71 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
   return mesh_tensors
 
 
-def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+def mesh_hash(mesh):
+  '''sha1 of the geometry and appearance of a trimesh, identifies a mesh in caches that outlive the process
+  '''
+  h = hashlib.sha1()
+  h.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+  h.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    h.update(np.ascontiguousarray(mesh.visual.uv, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(mesh.visual.material.image.convert('RGB')).tobytes())
+  elif mesh.visual.vertex_colors is not None:
+    h.update(np.ascontiguousarray(mesh.visual.vertex_colors[...,:3], dtype=np.uint8).tobytes())
+  return h.hexdigest()
+
+
+def make_mesh_lods(mesh, face_budgets=(100000, 30000, 10000), device='cuda'):
+  '''Decimated copies of the mesh for renders where the object only covers a small crop, see select_mesh_lod.
+  The quadric decimation drops uvs, so textures are baked into vertex colors first.
+  @face_budgets: target face counts, levels at or above the mesh face count are skipped
+  Return: list of mesh_tensors, coarsest first
+  '''
+  try:
+    o3d.geometry
+  except ImportError:
+    logging.warning("open3d not available, rendering the full mesh only")
+    return []
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    colors = mesh.visual.to_color().vertex_colors[...,:3]
+  elif mesh.visual.vertex_colors is not None:
+    colors = mesh.visual.vertex_colors[...,:3]
+  else:
+    colors = np.full((len(mesh.vertices),3), 128, dtype=np.uint8)
+  o3d_mesh = o3d.geometry.TriangleMesh()
+  o3d_mesh.vertices = o3d.utility.Vector3dVector(np.asarray(mesh.vertices, dtype=np.float64))
+  o3d_mesh.triangles = o3d.utility.Vector3iVector(np.asarray(mesh.faces, dtype=np.int32))
+  o3d_mesh.vertex_colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64)/255.0)
+
+  lods = []
+  for n_faces in sorted(face_budgets):
+    if n_faces>=len(mesh.faces):
+      continue
+    lod = o3d_mesh.simplify_quadric_decimation(target_number_of_triangles=int(n_faces))
+    lod.compute_vertex_normals()
+    lods.append({
+      'vertex_color': torch.tensor(np.asarray(lod.vertex_colors), device=device, dtype=torch.float),
+      'pos': torch.tensor(np.asarray(lod.vertices), device=device, dtype=torch.float),
+      'faces': torch.tensor(np.asarray(lod.triangles), device=device, dtype=torch.int),
+      'vnormals': torch.tensor(np.asarray(lod.vertex_normals), device=device, dtype=torch.float),
+    })
+    logging.info(f"mesh lod {len(mesh.faces)} -> {len(lods[-1]['faces'])} faces")
+  return lods
+
+
+def select_mesh_lod(mesh_tensors, lod_size, faces_per_px=1.5):
+  '''Coarsest level in mesh_tensors['lods'] that still keeps triangles around a pixel in size, falls back to the full mesh
+  @lod_size: projected object diameter in output pixels
+  @faces_per_px: faces needed per pixel of the lod_size**2 square, both object sides count
+  '''
+  n_need = faces_per_px*lod_size**2
+  for lod in mesh_tensors.get('lods', []):
+    if len(lod['faces'])>=n_need:
+      return lod
+  return mesh_tensors
+
+
+def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}, lod_size=None, track_memory=False):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
   @ob_in_cams: (N,4,4) torch tensor, openCV camera
@@ -139,60 +360,76 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
   @light_dir: in cam space
   @light_pos: in cam space
+  @glctx: nvdiffrast context, or a CpuRasterizeContext to render with the torch rasterizers. None picks nvdiffrast on cuda and the tiled cpu rasterizer otherwise
+  @lod_size: projected object diameter in output pixels, picks a decimated level from mesh_tensors['lods'] if given
+  @track_memory: put the peak cuda memory of this call above what was allocated before into extra['peak_memory_mb'], resets the torch peak stats
   '''
-  if glctx is None:
-    if context == 'gl':
-      glctx = dr.RasterizeGLContext()
-    elif context=='cuda':
-      glctx = dr.RasterizeCudaContext()
-    else:
-      raise NotImplementedError
-    logging.info("created context")
+  device = ob_in_cams.device
+  if track_memory and device.type=='cuda':
+    torch.cuda.synchronize(device)
+    mem_start = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+  if glctx is None and (device.type=='cpu' or context=='cpu'):
+    glctx = CpuRasterizeContext()
+  if isinstance(glctx, CpuRasterizeContext):
+    rasterize = rasterize_cpu_tiled if glctx.tiled else rasterize_cpu
+    interpolate, texture = interpolate_cpu, texture_cpu
+  else:
+    rasterize, interpolate, texture = dr.rasterize, dr.interpolate, dr.texture
+    if glctx is None:
+      if context == 'gl':
+        glctx = dr.RasterizeGLContext()
+      elif context=='cuda':
+        glctx = dr.RasterizeCudaContext()
+      else:
+        raise NotImplementedError
+      logging.info("created context")
 
   if mesh_tensors is None:
     mesh_tensors = make_mesh_tensors(mesh)
+  if lod_size is not None:
+    mesh_tensors = select_mesh_lod(mesh_tensors, lod_size)
   pos = mesh_tensors['pos']
   vnormals = mesh_tensors['vnormals']
   pos_idx = mesh_tensors['faces']
   has_tex = 'tex' in mesh_tensors
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
   mtx = projection_mat@ob_in_glcams
 
   if output_size is None:
     output_size = np.asarray([H,W])
 
-  pts_cam = transform_pts(pos, ob_in_cams)
-  pos_homo = to_homo_torch(pos)
-  pos_clip = (mtx[:,None]@pos_homo[None,...,None])[...,0]
+  pts_cam = transform_pts_batch(pos, ob_in_cams[:,:3])
   if bbox2d is not None:
     l = bbox2d[:,0]
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
     tf[:,3,1] = (H-t-b)/(t-b)
-    pos_clip = pos_clip@tf
-  rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
-  xyz_map, _ = dr.interpolate(pts_cam, rast_out, pos_idx)
+    mtx = tf.transpose(1,2)@mtx   # tf acts on row vectors
+  pos_clip = transform_pts_batch(pos, mtx)
+  rast_out, _ = rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
+  xyz_map, _ = interpolate(pts_cam, rast_out, pos_idx)
   depth = xyz_map[...,2]
   if has_tex:
-    texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    texc, _ = interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    color = texture(select_texture_mip(mesh_tensors, lod_size), texc, filter_mode='linear')
   else:
-    color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
+    color, _ = interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
 
   if use_light:
     get_normal = True
   if get_normal:
-    vnormals_cam = transform_dirs(vnormals, ob_in_cams)
-    normal_map, _ = dr.interpolate(vnormals_cam, rast_out, pos_idx)
+    vnormals_cam = torch.bmm(vnormals.expand(len(ob_in_cams),-1,-1), ob_in_cams[:,:3,:3].transpose(1,2))
+    normal_map, _ = interpolate(vnormals_cam, rast_out, pos_idx)
     normal_map = F.normalize(normal_map, dim=-1)
     normal_map = torch.flip(normal_map, dims=[1])
   else:
@@ -200,15 +437,15 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
 
   if use_light:
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
     diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
-    diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+    diffuse_intensity_map, _ = interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
@@ -216,9 +453,255 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   color = torch.flip(color, dims=[1])   # Flip Y coordinates
   depth = torch.flip(depth, dims=[1])
   extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
+  if track_memory and device.type=='cuda':
+    extra['peak_memory_mb'] = (torch.cuda.max_memory_allocated(device)-mem_start)/1e6
   return color, depth, normal_map
 
 
+RASTERIZERS = ['nvdiffrast', 'tiled', 'reference']
+
+
+class CpuRasterizeContext:
+  '''Stands in for the nvdiffrast context when rendering without nvdiffrast, see nvdiffrast_render
+  @tiled: rasterize_cpu_tiled, otherwise the plain per pose rasterize_cpu that serves as reference
+  @tile_size: tile edge in pixels
+  @num_threads: threads the tiles are spread over, defaults to torch.get_num_threads()
+  '''
+  def __init__(self, tiled=True, tile_size=32, num_threads=None):
+    self.tiled = tiled
+    self.tile_size = tile_size
+    self.num_threads = num_threads
+    self.pool = None
+
+
+  def get_pool(self):
+    num_threads = self.num_threads or torch.get_num_threads()
+    if self.pool is None or self.pool._max_workers!=num_threads:
+      self.pool = ThreadPoolExecutor(max_workers=num_threads)
+    return self.pool, num_threads
+
+
+def make_raster_context(rasterizer=None, device='cuda'):
+  '''
+  @rasterizer: one of RASTERIZERS, None picks nvdiffrast on cuda and tiled otherwise
+  '''
+  if rasterizer is None:
+    rasterizer = 'nvdiffrast' if torch.device(device).type=='cuda' else 'tiled'
+  if rasterizer=='nvdiffrast':
+    return dr.RasterizeCudaContext(device)
+  if rasterizer in ['tiled', 'reference']:
+    return CpuRasterizeContext(tiled=rasterizer=='tiled')
+  raise NotImplementedError(rasterizer)
+
+
+def rasterize_cpu(glctx, pos, tri, resolution):
+  '''Plain torch rasterizer with the same outputs as nvdiffrast.torch.rasterize, for devices without nvdiffrast
+  @glctx: unused, kept for the same signature
+  @pos: (B,N,4) clip space vertices
+  @tri: (F,3) int tensor
+  @resolution: (H,W)
+  Return: rast_out (B,H,W,4) holding (u,v,z/w,triangle_id+1), perspective correct barycentrics, triangle_id+1=0 is background
+  '''
+  H,W = int(resolution[0]), int(resolution[1])
+  device = pos.device
+  tri = tri.long()
+  rast_out = torch.zeros((len(pos),H,W,4), dtype=torch.float, device=device)
+  for b in range(len(pos)):
+    verts = pos[b][tri]   #(F,3,4)
+    face_ids = torch.nonzero((verts[...,3]>0).all(dim=-1)).reshape(-1)  # Drop faces behind the camera
+    verts = verts[face_ids]
+    ws = verts[...,3]
+    xs = (verts[...,0]/ws+1)*W/2-0.5  # Pixel centers at integer coords, row 0 at ndc y=-1 same as nvdiffrast
+    ys = (verts[...,1]/ws+1)*H/2-0.5
+    zs = verts[...,2]/ws
+    area = (xs[:,1]-xs[:,0])*(ys[:,2]-ys[:,0]) - (xs[:,2]-xs[:,0])*(ys[:,1]-ys[:,0])
+    umin = xs.min(dim=-1)[0].ceil().clamp(min=0).long()
+    umax = xs.max(dim=-1)[0].floor().clamp(max=W-1).long()
+    vmin = ys.min(dim=-1)[0].ceil().clamp(min=0).long()
+    vmax = ys.max(dim=-1)[0].floor().clamp(max=H-1).long()
+    bw = (umax-umin+1).clamp(min=0)
+    n_pix = bw*(vmax-vmin+1).clamp(min=0)
+    n_pix[area==0] = 0
+    if n_pix.sum()==0:
+      continue
+
+    fid = torch.repeat_interleave(torch.arange(len(n_pix), device=device), n_pix)
+    offset = torch.arange(len(fid), device=device) - torch.repeat_interleave(n_pix.cumsum(0)-n_pix, n_pix)
+    px = umin[fid] + offset%bw[fid]
+    py = vmin[fid] + offset//bw[fid]
+    x = xs[fid]
+    y = ys[fid]
+    b0 = ((x[:,1]-px)*(y[:,2]-py) - (x[:,2]-px)*(y[:,1]-py))/area[fid]
+    b1 = ((x[:,2]-px)*(y[:,0]-py) - (x[:,0]-px)*(y[:,2]-py))/area[fid]
+    b2 = 1-b0-b1
+    z = b0*zs[fid,0] + b1*zs[fid,1] + b2*zs[fid,2]
+    inside = (b0>=0) & (b1>=0) & (b2>=0) & (z>=-1) & (z<=1)
+    fid = fid[inside]
+    pix = (py*W+px)[inside]
+    z = z[inside]
+    bary = torch.stack([b0,b1,b2], dim=-1)[inside]/ws[fid]
+    bary = bary/bary.sum(dim=-1, keepdim=True)
+
+    zbuf = torch.full((H*W,), np.inf, dtype=torch.float, device=device)
+    zbuf.scatter_reduce_(0, pix, z, reduce='amin')
+    front = z==zbuf[pix]
+    rast_out[b].reshape(H*W,4)[pix[front]] = torch.stack([bary[front,0], bary[front,1], z[front], (face_ids[fid[front]]+1).float()], dim=-1)
+  return rast_out, None
+
+
+def rasterize_cpu_tiled(glctx, pos, tri, resolution):
+  '''Same output as rasterize_cpu, but the triangles of all poses are set up and binned into screen tiles at once, and the tiles are rasterized in cache sized chunks on a thread pool.
+  Barycentrics and z are affine in screen space, so every triangle gets its edge coefficients once and each candidate pixel costs a few multiply-adds. Each chunk owns whole tiles, so the z-tests of different threads never touch the same pixel
+  @glctx: CpuRasterizeContext, for tile_size and num_threads
+  '''
+  H,W = int(resolution[0]), int(resolution[1])
+  device = pos.device
+  T = glctx.tile_size if glctx is not None else 32
+  B = len(pos)
+  rast_out = torch.zeros((B,H,W,4), dtype=torch.float, device=device)
+
+  ########## Triangle setup for every pose at once
+  tri = tri.long()
+  verts = pos.index_select(1, tri.reshape(-1)).reshape(B,-1,3,4)   #(B,F,3,4)
+  ws = verts[...,3]
+  xs = (verts[...,0]/ws+1)*W/2-0.5   # Pixel centers at integer coords, row 0 at ndc y=-1 same as nvdiffrast
+  ys = (verts[...,1]/ws+1)*H/2-0.5
+  zs = verts[...,2]/ws
+  area = (xs[...,1]-xs[...,0])*(ys[...,2]-ys[...,0]) - (xs[...,2]-xs[...,0])*(ys[...,1]-ys[...,0])
+  umin = xs.min(dim=-1)[0].ceil().clamp(min=0)
+  umax = xs.max(dim=-1)[0].floor().clamp(max=W-1)
+  vmin = ys.min(dim=-1)[0].ceil().clamp(min=0)
+  vmax = ys.max(dim=-1)[0].floor().clamp(max=H-1)
+  keep = (ws>0).all(dim=-1) & (area!=0) & (umin<=umax) & (vmin<=vmax)
+  kept = torch.nonzero(keep.reshape(-1)).reshape(-1)
+  if len(kept)==0:
+    return rast_out, None
+  bi = kept//keep.shape[1]
+  fi = kept%keep.shape[1]
+  x, y, z, w = [v.reshape(-1,3).index_select(0, kept) for v in [xs, ys, zs, ws]]
+  area = area.reshape(-1).index_select(0, kept)
+  umin, umax, vmin, vmax = [v.reshape(-1).index_select(0, kept).long() for v in [umin, umax, vmin, vmax]]
+  ########## b0, b1 and z as linear functions of the pixel offset to vertex 2, which keeps float32 exact enough for tiny triangles
+  b0_coef = torch.stack([y[:,1]-y[:,2], x[:,2]-x[:,1]], dim=-1)/area[:,None]
+  b1_coef = torch.stack([y[:,2]-y[:,0], x[:,0]-x[:,2]], dim=-1)/area[:,None]
+  z_coef = b0_coef*(z[:,0]-z[:,2])[:,None] + b1_coef*(z[:,1]-z[:,2])[:,None]
+  coefs = torch.cat([x[:,2:3], y[:,2:3], b0_coef, b1_coef, z_coef, z[:,2:3]], dim=-1).T.contiguous()   #(9,N_tri), rows stay contiguous after the gather
+
+  ########## Binning, one entry per (triangle, overlapped tile), bbox clipped to the tile
+  n_tx = (W+T-1)//T
+  n_ty = (H+T-1)//T
+  tw = umax//T-umin//T+1
+  n_tile = tw*(vmax//T-vmin//T+1)
+  cid = torch.repeat_interleave(torch.arange(len(bi), device=device), n_tile)
+  offset = torch.arange(len(cid), device=device) - torch.repeat_interleave(n_tile.cumsum(0)-n_tile, n_tile)
+  tx = umin[cid]//T + offset%tw[cid]
+  ty = vmin[cid]//T + offset//tw[cid]
+  u0 = torch.maximum(umin[cid], tx*T)
+  u1 = torch.minimum(umax[cid], tx*T+T-1)
+  v0 = torch.maximum(vmin[cid], ty*T)
+  v1 = torch.minimum(vmax[cid], ty*T+T-1)
+  tile_key = (bi[cid]*n_ty+ty)*n_tx+tx
+  order = torch.argsort(tile_key)
+  cid, tile_key, u0, u1, v0, v1 = cid[order], tile_key[order], u0[order], u1[order], v0[order], v1[order]
+  n_pix = (u1-u0+1)*(v1-v0+1)
+
+  def rasterize_bins(start, end):
+    '''Fragments of the bins [start,end), which cover whole tiles, z-tested against a z-buffer of just these tiles.
+    Pixel coords stay floats and gathers use index_select on contiguous rows, both much cheaper than int64 div/mod and advanced indexing
+    '''
+    _, tile_local = torch.unique_consecutive(tile_key[start:end], return_inverse=True)
+    n = n_pix[start:end]
+    e = torch.repeat_interleave(torch.arange(end-start, device=device), n)
+    off = (torch.arange(len(e), device=device) - torch.repeat_interleave(n.cumsum(0)-n, n)).float()
+    bw = (u1[start:end]-u0[start:end]+1).float().index_select(0, e)
+    dy = (off/bw).floor_()
+    px = (off-dy*bw).add_(u0[start:end].float().index_select(0, e))
+    py = dy.add_(v0[start:end].float().index_select(0, e))
+    coef = coefs.index_select(1, cid[start:end].index_select(0, e))
+    dx = px-coef[0]
+    dy = py-coef[1]
+    b0 = torch.addcmul(coef[2]*dx, coef[3], dy)
+    b1 = torch.addcmul(coef[4]*dx, coef[5], dy)
+    zc = torch.addcmul(torch.addcmul(coef[8], coef[6], dx), coef[7], dy)
+    inside = torch.nonzero((b0>=0) & (b1>=0) & (b0+b1<=1) & (zc>=-1) & (zc<=1)).reshape(-1)
+    e, b0, b1, zc = e.index_select(0, inside), b0.index_select(0, inside), b1.index_select(0, inside), zc.index_select(0, inside)
+    px = px.index_select(0, inside).long()
+    py = py.index_select(0, inside).long()
+    pix_local = tile_local.index_select(0, e)*T*T + (py%T)*T + px%T   # Index into the z-buffer of this chunk's tiles
+    zbuf = torch.full((int(tile_local[-1]+1)*T*T,), np.inf, dtype=torch.float, device=device)
+    zbuf.scatter_reduce_(0, pix_local, zc, reduce='amin')
+    front = torch.nonzero(zc==zbuf.index_select(0, pix_local)).reshape(-1)
+
+    ########## Perspective correct barycentrics only for the visible fragments
+    c = cid[start:end].index_select(0, e.index_select(0, front))
+    b0 = b0.index_select(0, front)
+    b1 = b1.index_select(0, front)
+    bary = torch.stack([b0, b1, 1-b0-b1], dim=-1)/w.index_select(0, c)
+    bary = bary/bary.sum(dim=-1, keepdim=True)
+    pix = (bi.index_select(0, c)*H+py.index_select(0, front))*W+px.index_select(0, front)
+    rast_out.reshape(-1,4)[pix] = torch.stack([bary[:,0], bary[:,1], zc.index_select(0, front), (fi.index_select(0, c)+1).float()], dim=-1)
+
+  ########## Chunks of whole tiles with about the same pixel work, small enough to stay in cache, spread over the threads
+  pool, num_threads = glctx.get_pool() if glctx is not None else (None, 1)
+  tile_start = torch.nonzero(torch.diff(tile_key, prepend=tile_key[:1]-1)).reshape(-1)
+  work = torch.cat([torch.zeros(1, dtype=torch.long, device=device), n_pix.cumsum(0)])
+  n_chunk = max(num_threads, int(work[-1])//(1<<18)+1)
+  cuts = torch.searchsorted(work[tile_start], torch.linspace(0, work[-1].item(), n_chunk+1, device=device)[1:-1].long())
+  bounds = [0] + sorted(set(tile_start[cuts.clamp(max=len(tile_start)-1)].tolist())) + [len(cid)]
+  bounds = [(bounds[i],bounds[i+1]) for i in range(len(bounds)-1) if bounds[i]<bounds[i+1]]
+  if pool is None or num_threads==1:
+    for start,end in bounds:
+      rasterize_bins(start, end)
+  else:
+    list(pool.map(lambda se: rasterize_bins(*se), bounds))
+  return rast_out, None
+
+
+def interpolate_cpu(attr, rast, tri):
+  '''Same as nvdiffrast.torch.interpolate without derivatives
+  @attr: (N,C) or (B,N,C)
+  '''
+  rast_flat = rast.reshape(-1,4)
+  fg = torch.nonzero(rast_flat[:,3]>0).reshape(-1)   # Only covered pixels are interpolated
+  ids = tri.long()[rast_flat[fg,3].long()-1]  #(N_fg,3)
+  if attr.dim()==2:
+    a = attr[ids]  #(N_fg,3,C)
+  else:
+    a = attr[(fg//(rast.shape[1]*rast.shape[2])).reshape(-1,1), ids]
+  u = rast_flat[fg,0:1]
+  v = rast_flat[fg,1:2]
+  out = torch.zeros((len(rast_flat), attr.shape[-1]), dtype=attr.dtype, device=attr.device)
+  out[fg] = a[:,0]*u + a[:,1]*v + a[:,2]*(1-u-v)
+  return out.reshape(*rast.shape[:-1], attr.shape[-1]), None
+
+
+def texture_cpu(tex, uv, filter_mode='linear'):
+  '''Same as nvdiffrast.torch.texture without mipmaps
+  @tex: (1 or B,H_tex,W_tex,C)
+  @uv: (B,H,W,2) in [0,1]
+  '''
+  mode = 'bilinear' if filter_mode=='linear' else 'nearest'
+  tex = tex.permute(0,3,1,2).expand(len(uv),-1,-1,-1)
+  color = F.grid_sample(tex, uv*2-1, mode=mode, padding_mode='border', align_corners=False)
+  return color.permute(0,2,3,1)
+
+
+
+def empty_cache(device='cuda'):
+  if torch.device(device).type=='cuda':
+    torch.cuda.empty_cache()
+
+
+def set_num_threads(num_threads=None):
+  '''Limit the threads torch and opencv use on cpu, defaults to env POSE_NUM_THREADS or all cores
+  '''
+  if num_threads is None:
+    num_threads = int(os.environ.get('POSE_NUM_THREADS', os.cpu_count()))
+  torch.set_num_threads(num_threads)
+  cv2.setNumThreads(num_threads)
+  logging.info(f"num_threads:{num_threads}")
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -277,6 +760,31 @@ def normalizeRotation(pose):
 
 
 
+def voxel_downsample(pts, voxel_size, normals=None):
+  '''Same voxel grid and per voxel averaging as open3d voxel_down_sample, without copying the points into open3d
+  @pts: (N,3) np array or torch tensor, np arrays are averaged in their own precision like open3d does in float64
+  @normals: (N,3) averaged per voxel too, not renormalized
+  Return: pts (M,3), normals (M,3) or None, same type as pts and ordered by voxel
+  '''
+  is_np = isinstance(pts, np.ndarray)
+  pts = torch.as_tensor(pts)
+  voxel_min = pts.min(dim=0)[0] - voxel_size*0.5
+  ids = torch.floor((pts-voxel_min)/voxel_size).long()
+  dims = ids.max(dim=0)[0]+1
+  keys = (ids[:,0]*dims[1] + ids[:,1])*dims[2] + ids[:,2]
+  keys, inverse = torch.unique(keys, return_inverse=True)
+  counts = torch.bincount(inverse, minlength=len(keys)).to(pts.dtype)[:,None]
+  pts_down = torch.zeros((len(keys),3), dtype=pts.dtype, device=pts.device).index_add_(0, inverse, pts)/counts
+  normals_down = None
+  if normals is not None:
+    normals = torch.as_tensor(normals, dtype=pts.dtype, device=pts.device)
+    normals_down = torch.zeros((len(keys),3), dtype=pts.dtype, device=pts.device).index_add_(0, inverse, normals)/counts
+  if is_np:
+    pts_down = pts_down.numpy()
+    normals_down = None if normals_down is None else normals_down.numpy()
+  return pts_down, normals_down
+
+
 def toOpen3dCloud(points,colors=None,normals=None):
   cloud = o3d.geometry.PointCloud()
   cloud.points = o3d.utility.Vector3dVector(points.astype(np.float64))
@@ -300,6 +808,127 @@ def make_grid_image(imgs, nrow, padding=5, pad_value=255):
   return grid
 
 
+
+def capture_vis_crops(pose_data):
+  '''Copy of the crops a debug canvas shows, taken from a batch the predictor computed anyway, e.g. out of CropWorkspace buffers that the next call overwrites.
+  Stays on device, the debug writer moves it to host
+  Return: dict of rgbA, rgbB (B,H,W,3) uint8 and zA, zB (B,H,W) float16 torch tensors, z of the normalized xyz maps
+  '''
+  return {
+    'rgbA': (pose_data.rgbAs*255).clip(0,255).byte().permute(0,2,3,1),
+    'rgbB': (pose_data.rgbBs*255).clip(0,255).byte().permute(0,2,3,1),
+    'zA': pose_data.xyz_mapAs[:,2].half(),
+    'zB': pose_data.xyz_mapBs[:,2].half(),
+  }
+
+
+
+def to_debug_array(x):
+  '''Resolve a debug writer argument on the writer thread: functions are called, tensors are moved to host
+  '''
+  if callable(x):
+    x = x()
+  if torch.is_tensor(x):
+    x = x.data.cpu().numpy()
+  return x
+
+
+def write_debug_image(path, img):
+  '''
+  @img: (H,W,3) RGB or (H,W) image, tensor, or function returning one
+  '''
+  img = to_debug_array(img)
+  if img.ndim==3:
+    imageio.imwrite(path, img)
+  else:
+    cv2.imwrite(path, img)
+
+
+def write_debug_point_cloud(path, pts, colors=None):
+  '''
+  @pts: (N,3) points, or (H,W,3) xyz map whose pixels with z>=0.001 are written
+  @colors: (N,3) or (H,W,3) matching pts
+  '''
+  pts = to_debug_array(pts)
+  colors = to_debug_array(colors)
+  if pts.ndim==3:
+    valid = pts[...,2]>=0.001
+    pts = pts[valid]
+    if colors is not None:
+      colors = colors[valid]
+  o3d.io.write_point_cloud(path, toOpen3dCloud(pts, colors))
+
+
+def write_debug_mesh(path, mesh):
+  to_debug_array(mesh).export(path)
+
+
+
+class DebugWriter:
+  '''Writes debug and visualization files on a background thread, so debugging does not add to the latency of register and track.
+  Jobs wait in a bounded queue and are dropped when it is full. Their tensor and function arguments are resolved on the writer thread (to_debug_array),
+  so callers pass device tensors as they are, and copies of buffers they overwrite later
+  @max_queue: jobs kept waiting at most
+  '''
+  def __init__(self, max_queue=32):
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.n_dropped = 0
+    self.thread = threading.Thread(target=self.run, name='DebugWriter', daemon=True)
+    self.thread.start()
+
+
+  def run(self):
+    while 1:
+      fn, args = self.queue.get()
+      try:
+        fn(*args)
+      except Exception as e:
+        logging.warning(f'debug writer {fn.__name__}{args[:1]} failed: {e}')
+      finally:
+        self.queue.task_done()
+
+
+  def submit(self, fn, *args):
+    '''Run fn(*args) on the writer thread, False if the queue was full and the job dropped
+    '''
+    try:
+      self.queue.put_nowait((fn, args))
+      return True
+    except queue.Full:
+      self.n_dropped += 1
+      logging.warning(f'debug writer queue full, dropped {args[:1]}, {self.n_dropped} dropped so far')
+      return False
+
+
+  def write_image(self, path, img):
+    return self.submit(write_debug_image, path, img)
+
+
+  def write_point_cloud(self, path, pts, colors=None):
+    return self.submit(write_debug_point_cloud, path, pts, colors)
+
+
+  def write_mesh(self, path, mesh):
+    return self.submit(write_debug_mesh, path, mesh)
+
+
+  def flush(self):
+    '''Wait until the queued jobs are written
+    '''
+    self.queue.join()
+
+
+_debug_writer = None
+
+def get_debug_writer():
+  '''DebugWriter shared by the process, started on first use
+  '''
+  global _debug_writer
+  if _debug_writer is None:
+    _debug_writer = DebugWriter()
+  return _debug_writer
+
+
 if wp is not None:
   @wp.kernel(enable_backward=False)
   def bilateral_filter_depth_kernel(depth:wp.array(dtype=float, ndim=2), out:wp.array(dtype=float, ndim=2), radius:int, zfar:float, sigmaD:float, sigmaR:float):
@@ -342,7 +971,7 @@ if wp is not None:
     if sum_weight>0 and num_valid>0:
       out[h,w] = sum/sum_weight
 
-  def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  def bilateral_filter_depth_warp(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
     if isinstance(depth, np.ndarray):
       depth_wp = wp.array(depth, dtype=float, device=device)
     else:
@@ -384,7 +1013,7 @@ if wp is not None:
       out[h,w] = d_ori
 
 
-  def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  def erode_depth_warp(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
     depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
     out_wp = wp.zeros(depth.shape, dtype=float, device=device)
     wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
@@ -395,18 +1024,107 @@ if wp is not None:
     return depth_out
 
 
+def bilateral_filter_depth_torch(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  '''Same output as bilateral_filter_depth_kernel, vectorized over the image by looping the (2*radius+1)^2 window offsets
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  H,W = depth_t.shape
+  padded = F.pad(depth_t[None,None], (radius,radius,radius,radius), value=0)[0,0]   # Out of bound is invalid depth
+  offsets = [(du,dv) for du in range(-radius, radius+1) for dv in range(-radius, radius+1)]   # Same order as the kernel
+  mean_depth = torch.zeros_like(depth_t)
+  num_valid = torch.zeros_like(depth_t)
+  for du,dv in offsets:
+    cur = padded[radius+dv:radius+dv+H, radius+du:radius+du+W]
+    valid = (cur>=0.001) & (cur<zfar)
+    num_valid += valid
+    mean_depth += cur*valid
+  mean_depth = mean_depth/num_valid.clamp(min=1)
+
+  sum_weight = torch.zeros_like(depth_t)
+  sum = torch.zeros_like(depth_t)
+  for du,dv in offsets:
+    cur = padded[radius+dv:radius+dv+H, radius+du:radius+du+W]
+    valid = (cur>=0.001) & (cur<zfar) & (torch.abs(cur-mean_depth)<0.01)
+    weight = torch.exp(-float(du*du+dv*dv)/(2.0*sigmaD*sigmaD) - (depth_t-cur)**2/(2.0*sigmaR*sigmaR))*valid
+    sum_weight += weight
+    sum += weight*cur
+  depth_out = torch.where((sum_weight>0) & (num_valid>0), sum/torch.where(sum_weight>0, sum_weight, torch.ones_like(sum_weight)), torch.zeros_like(depth_t))
+
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def erode_depth_torch(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  '''Same output as erode_depth_kernel, vectorized over the image by looping the (2*radius+1)^2 window offsets
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  H,W = depth_t.shape
+  padded = F.pad(depth_t[None,None], (radius,radius,radius,radius), value=np.nan)[0,0]   # nan marks out of bound, compares False below
+  bad_cnt = torch.zeros_like(depth_t)
+  total = torch.zeros_like(depth_t)
+  for du in range(-radius, radius+1):
+    for dv in range(-radius, radius+1):
+      cur = padded[radius+dv:radius+dv+H, radius+du:radius+du+W]
+      total += ~torch.isnan(cur)
+      bad_cnt += (cur<0.001) | (cur>=zfar) | (torch.abs(cur-depth_t)>depth_diff_thres)
+  depth_out = torch.where(bad_cnt/total>ratio_thres, torch.zeros_like(depth_t), depth_t)
+
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  if wp is not None:
+    return bilateral_filter_depth_warp(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=device)
+  return bilateral_filter_depth_torch(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=device)
+
+
+def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  if wp is not None:
+    return erode_depth_warp(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=device)
+  return erode_depth_torch(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=device)
+
 
-def depth2xyzmap(depth, K, uvs=None):
+
+_ray_grids = OrderedDict()
+
+def get_ray_grid(H, W, K, device=None, max_entries=8):
+  '''Cached (H,W,3) camera rays with z=1 per pixel, so depth[...,None]*rays is the xyz map. Kept per (H,W,K,device), K is constant per camera
+  @device: None for a np array, else a torch tensor on device
+  '''
+  K = np.asarray(K.data.cpu().numpy() if torch.is_tensor(K) else K, dtype=np.float64)
+  key = (H, W, K[0,0], K[1,1], K[0,2], K[1,2], None if device is None else str(torch.device(device)))
+  if key in _ray_grids:
+    _ray_grids.move_to_end(key)
+    return _ray_grids[key]
+  rays = np.ones((H,W,3), dtype=np.float32)
+  rays[...,0] = ((np.arange(W)-K[0,2])/K[0,0])[None]
+  rays[...,1] = ((np.arange(H)-K[1,2])/K[1,1])[:,None]
+  if device is not None:
+    rays = torch.as_tensor(rays, device=device)
+  _ray_grids[key] = rays
+  if len(_ray_grids)>max_entries:
+    _ray_grids.popitem(last=False)
+  return rays
+
+
+def depth2xyzmap(depth, K, uvs=None, rays=None):
+  '''
+  @rays: (H,W,3) from get_ray_grid, e.g. a roi slice of the full frame grid. Defaults to the cached grid of K
+  '''
   invalid_mask = (depth<0.001)
   H,W = depth.shape[:2]
   if uvs is None:
-    vs,us = np.meshgrid(np.arange(0,H),np.arange(0,W), sparse=False, indexing='ij')
-    vs = vs.reshape(-1)
-    us = us.reshape(-1)
-  else:
-    uvs = uvs.round().astype(int)
-    us = uvs[:,0]
-    vs = uvs[:,1]
+    if rays is None:
+      rays = get_ray_grid(H, W, K)
+    xyz_map = np.multiply(depth[...,None], rays, dtype=np.float32)
+    xyz_map[invalid_mask] = 0
+    return xyz_map
+  uvs = uvs.round().astype(int)
+  us = uvs[:,0]
+  vs = uvs[:,1]
   zs = depth[vs,us]
   xs = (us-K[0,2])*zs/K[0,0]
   ys = (vs-K[1,2])*zs/K[1,1]
@@ -417,28 +1135,110 @@ def depth2xyzmap(depth, K, uvs=None):
   return xyz_map
 
 
-def depth2xyzmap_batch(depths, Ks, zfar):
+def depth2xyzmap_batch(depths, Ks, zfar, rays=None):
   '''
   @depths: torch tensor (B,H,W)
-  @Ks: torch tensor (B,3,3)
+  @Ks: torch tensor (B,3,3), unused if rays is given
+  @rays: (H,W,3) shared by the batch, see get_ray_grid
   '''
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
-  zs = depths.reshape(bs,-1)
-  Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
-  xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
-  ys = (vs-Ks[...,1,2])*zs/Ks[...,1,1]
-  pts = torch.stack([xs,ys,zs], dim=-1)  #(B,N,3)
-  xyz_maps = pts.reshape(bs,H,W,3)
+  if rays is None:
+    us = torch.arange(0, W, device=depths.device, dtype=torch.float)[None]
+    vs = torch.arange(0, H, device=depths.device, dtype=torch.float)[None]
+    rays_x = (us-Ks[:,0,2,None])/Ks[:,0,0,None]  #(B,W)
+    rays_y = (vs-Ks[:,1,2,None])/Ks[:,1,1,None]  #(B,H)
+    xyz_maps = torch.stack([depths*rays_x[:,None,:], depths*rays_y[:,:,None], depths], dim=-1)
+  else:
+    xyz_maps = depths[...,None]*rays
   xyz_maps[invalid_mask] = 0
   return xyz_maps
 
 
 
+def compute_depth_roi(K, H, W, center, radius, mask=None):
+  '''Pixel box covering the projection of a sphere around the object, same projection as compute_crop_window_tf_batch box_3d
+  @center: (3,) object center in camera, np array or torch tensor. With a tensor the box is computed on its device and read back once
+  @radius: sphere radius
+  @mask: (H,W) the box is grown to also cover the mask
+  Return: (umin,vmin,umax,vmax) inclusive
+  '''
+  if torch.is_tensor(center):
+    center = center.reshape(3).float()
+    device = center.device
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
+    z = center[2].clamp(min=0.001)
+    uv = (K@center)[:2]/z
+    r = radius*K[[0,1],[0,1]].max()/z
+    box = torch.cat([torch.floor(uv-r), torch.ceil(uv+r)])
+    if mask is not None:
+      mask = torch.as_tensor(mask, device=device)>0
+      us = torch.arange(W, device=device, dtype=torch.float)
+      vs = torch.arange(H, device=device, dtype=torch.float)
+      mask_u = mask.any(dim=0)
+      mask_v = mask.any(dim=1)
+      mask_box = torch.stack([torch.where(mask_u, us, float(W)).min(), torch.where(mask_v, vs, float(H)).min(), torch.where(mask_u, us, -1.0).max(), torch.where(mask_v, vs, -1.0).max()])
+      box = torch.cat([torch.minimum(box[:2], mask_box[:2]), torch.maximum(box[2:], mask_box[2:])])
+    full = torch.tensor([0, 0, W-1, H-1], dtype=torch.float, device=device)
+    box = torch.where(center[2]<0.001, full, box)
+    box = torch.minimum(box.clamp(min=0), full[[2,3,2,3]])
+    return tuple(int(x) for x in box.tolist())
+
+  center = np.asarray(center, dtype=float).reshape(3)
+  if center[2]<0.001:
+    return (0, 0, W-1, H-1)
+  uv = (K@center)[:2]/center[2]
+  r = radius*max(K[0,0], K[1,1])/center[2]
+  umin, vmin = np.floor(uv-r)
+  umax, vmax = np.ceil(uv+r)
+  if mask is not None:
+    vs,us = np.where(mask>0)
+    if len(us)>0:
+      umin = min(umin, us.min())
+      umax = max(umax, us.max())
+      vmin = min(vmin, vs.min())
+      vmax = max(vmax, vs.max())
+  umin = int(np.clip(umin, 0, W-1))
+  umax = int(np.clip(umax, 0, W-1))
+  vmin = int(np.clip(vmin, 0, H-1))
+  vmax = int(np.clip(vmax, 0, H-1))
+  return (umin, vmin, umax, vmax)
+
+
+def filter_depth_roi(depth, K, roi, radius=2, device='cuda'):
+  '''erode_depth, bilateral_filter_depth and depth2xyzmap on the roi only. Pixels outside roi are left as invalid depth (0), pixels inside match full frame filtering
+  @depth: (H,W) np array or torch tensor
+  @roi: (umin,vmin,umax,vmax) inclusive, see compute_depth_roi
+  Return: depth (H,W), xyz_map (H,W,3) of the same type as input
+  '''
+  H,W = depth.shape[:2]
+  umin,vmin,umax,vmax = roi
+  margin = 2*radius  # Context so the two chained filters are exact inside roi
+  u0 = max(umin-margin, 0)
+  v0 = max(vmin-margin, 0)
+  u1 = min(umax+margin+1, W)
+  v1 = min(vmax+margin+1, H)
+  crop = erode_depth(depth[v0:v1,u0:u1], radius=radius, device=device)
+  crop = bilateral_filter_depth(crop, radius=radius, device=device)
+  crop = crop[vmin-v0:vmax-v0+1, umin-u0:umax-u0+1]
+
+  if isinstance(depth, np.ndarray):
+    depth_out = np.zeros((H,W), dtype=np.float32)
+    xyz_map = np.zeros((H,W,3), dtype=np.float32)
+    rays = get_ray_grid(H, W, K)[vmin:vmax+1, umin:umax+1]
+    xyz_roi = depth2xyzmap(crop, K, rays=rays)
+  else:
+    depth_out = torch.zeros((H,W), dtype=torch.float, device=crop.device)
+    xyz_map = torch.zeros((H,W,3), dtype=torch.float, device=crop.device)
+    rays = get_ray_grid(H, W, K, device=crop.device)[vmin:vmax+1, umin:umax+1]
+    xyz_roi = depth2xyzmap_batch(crop[None], None, zfar=np.inf, rays=rays)[0]
+  depth_out[vmin:vmax+1, umin:umax+1] = crop
+  xyz_map[vmin:vmax+1, umin:umax+1] = xyz_roi
+  return depth_out, xyz_map
+
+
+
 def rle_to_mask(rle: dict) -> np.ndarray:
   """Compute a binary mask from an uncompressed RLE."""
   h, w = rle["size"]
@@ -536,6 +1336,15 @@ def transform_pts(pts,tf):
   return (tf[...,:-1,:-1]@pts[...,None] + tf[...,:-1,-1:])[...,0]
 
 
+def transform_pts_batch(pts, tfs):
+  """Transform the same points by every tf as one batched GEMM, without the per point (B,N,4,4) broadcast of transform_pts
+  @pts: (N,3)
+  @tfs: (B,D,4), D=3 for poses or 4 for projections
+  Return: (B,N,D)
+  """
+  return torch.baddbmm(tfs[:,None,:,3], pts.expand(len(tfs),-1,-1), tfs[:,:,:3].transpose(1,2))
+
+
 def transform_dirs(dirs,tf):
   """
   @dirs: (...,3)
@@ -556,9 +1365,93 @@ def random_direction():
 
 
 
+def cluster_pose_ids(angle_diff, dist_diff, poses_in, symmetry_tfs, chunk=64):
+  '''Same greedy clustering as mycpp.cluster_poses: a pose is dropped if it is within dist_diff and, under any symmetry tf, within angle_diff of an earlier kept pose
+  @angle_diff: degree
+  @dist_diff: meter
+  @poses_in: (N,4,4) np array, or torch tensor to cluster on its device, see cluster_pose_ids_tensor
+  @symmetry_tfs: (S,4,4) np array or torch tensor
+  @chunk: poses per block of the (N,N,S) rotation distances, bounds memory for large symmetry sets
+  Return: (N,) bool np array of the kept poses, a tensor on the device of poses_in for tensor input
+  '''
+  if torch.is_tensor(poses_in):
+    return cluster_pose_ids_tensor(angle_diff, dist_diff, poses_in, symmetry_tfs, chunk=chunk)
+  poses_in = np.asarray(poses_in, dtype=np.float32)
+  symmetry_tfs = np.asarray(symmetry_tfs, dtype=np.float32)
+  R = poses_in[:,:3,:3]
+  cos_thres = np.cos(angle_diff/180.0*np.pi)
+  close = np.zeros((len(poses_in),len(poses_in)), dtype=bool)
+  for i in range(0, len(poses_in), chunk):
+    R_sym = np.einsum('nij,sjk->nsik', R[i:i+chunk], symmetry_tfs[:,:3,:3])
+    cos = (np.einsum('nsij,mij->nms', R_sym, R)-1)/2   # trace(R_sym@R.T)
+    close_t = np.linalg.norm(poses_in[i:i+chunk,None,:3,3]-poses_in[None,:,:3,3], axis=-1)<dist_diff
+    close[i:i+chunk] = (cos.clip(-1,1)>cos_thres).any(axis=-1) & close_t
+  keep = np.zeros(len(poses_in), dtype=bool)
+  keep[0] = True
+  for i in range(1, len(poses_in)):
+    keep[i] = not close[i,keep].any()
+  logging.info(f"num of pose after clustering: {keep.sum()}/{len(poses_in)}")
+  return keep
+
+
+def cluster_pose_ids_tensor(angle_diff, dist_diff, poses_in, symmetry_tfs, chunk=64):
+  '''cluster_pose_ids without reading the poses back to host, the greedy pass runs one small kernel per pose instead
+  @poses_in: (N,4,4) torch tensor
+  Return: (N,) bool tensor on the device of poses_in
+  '''
+  device = poses_in.device
+  poses_in = poses_in.float()
+  symmetry_tfs = torch.as_tensor(symmetry_tfs, device=device, dtype=torch.float)
+  R = poses_in[:,:3,:3]
+  cos_thres = np.cos(angle_diff/180.0*np.pi)
+  close = torch.zeros((len(poses_in),len(poses_in)), dtype=torch.bool, device=device)
+  for i in range(0, len(poses_in), chunk):
+    R_sym = torch.einsum('nij,sjk->nsik', R[i:i+chunk], symmetry_tfs[:,:3,:3])
+    cos = (torch.einsum('nsij,mij->nms', R_sym, R)-1)/2   # trace(R_sym@R.T)
+    close_t = (poses_in[i:i+chunk,None,:3,3]-poses_in[None,:,:3,3]).norm(dim=-1)<dist_diff
+    close[i:i+chunk] = (cos.clamp(-1,1)>cos_thres).any(dim=-1) & close_t
+  close = close.tril(diagonal=-1)   # Only earlier poses can drop a pose
+  keep = torch.zeros(len(poses_in), dtype=torch.bool, device=device)
+  for i in range(len(poses_in)):
+    keep[i] = ~(close[i] & keep).any()
+  return keep
+
+
+def cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs):
+  '''See cluster_pose_ids
+  Return: (M,4,4) kept poses in input order
+  '''
+  poses_in = np.asarray(poses_in, dtype=np.float32)
+  return poses_in[cluster_pose_ids(angle_diff, dist_diff, poses_in, symmetry_tfs)]
+
+
+_rotation_grids = {}
+
+def make_rotation_grid(min_n_views=40, inplane_step=60, symmetry_tfs=None):
+  '''Ob in cam rotations from icosphere views times in-plane rotations, clustered under the symmetries.
+  Cached per (min_n_views, inplane_step, symmetry_tfs), objects of the same symmetry class share the grid
+  @symmetry_tfs: (S,4,4) np array, None for no symmetry
+  Return: (M,4,4) np array
+  '''
+  if symmetry_tfs is None:
+    symmetry_tfs = np.eye(4)[None]
+  symmetry_tfs = np.asarray(symmetry_tfs, dtype=np.float32)
+  key = (min_n_views, inplane_step, hashlib.sha1(symmetry_tfs.round(5).tobytes()).hexdigest())
+  if key in _rotation_grids:
+    return _rotation_grids[key]
+  cam_in_obs = sample_views_icosphere(n_views=min_n_views)
+  logging.info(f'cam_in_obs:{cam_in_obs.shape}')
+  R_inplanes = np.stack([euler_matrix(0,0,inplane_rot) for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step))])
+  rot_grid = np.linalg.inv(cam_in_obs[:,None]@R_inplanes[None]).reshape(-1,4,4)
+  logging.info(f"rot_grid:{rot_grid.shape}")
+  rot_grid = cluster_poses(30, 99999, rot_grid, symmetry_tfs)
+  _rotation_grids[key] = rot_grid
+  return rot_grid
+
+
 def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
-  from sklearn.decomposition import TruncatedSVD
   if mesh is not None:
+    import scipy.linalg
     u, s, vh = scipy.linalg.svd(mesh.vertices, full_matrices=False)
     pts = u@s
     diameter = np.linalg.norm(pts.max(axis=0)-pts.min(axis=0))
@@ -574,6 +1467,22 @@ def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
   return diameter
 
 
+def unique_crop_ids(poses, frame_ids=None):
+  '''Hypotheses with the same translation in the same frame get the same box_3d crop window (compute_crop_window_tf_batch only looks at the translation), so their real image crops are identical
+  @poses: (B,4,4) tensor
+  @frame_ids: (B,) frame each pose belongs to
+  Return: ids (N_unique,) one representative per crop, inverse (B,) index into ids for every pose
+  '''
+  keys = poses[:,:3,3]
+  if frame_ids is not None:
+    keys = torch.cat([keys, torch.as_tensor(frame_ids, device=poses.device, dtype=torch.float).reshape(-1,1)], dim=1)
+  _, inverse = torch.unique(keys, dim=0, return_inverse=True)
+  n_unique = int(inverse.max())+1
+  ids = torch.full((n_unique,), len(poses), dtype=torch.long, device=poses.device)
+  ids = ids.scatter_reduce(0, inverse, torch.arange(len(poses), device=poses.device), reduce='amin')
+  return ids, inverse
+
+
 def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, crop_ratio=1.2, out_size=None, rgb=None, uvs=None, method='min_box', mesh_diameter=None):
   '''Project the points and find the cropping transform
   @pts: (N,3)
@@ -588,26 +1497,26 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
+  device = poses.device
   if method=='box_3d':
     radius = mesh_diameter*crop_ratio/2
     offsets = torch.tensor([0,0,0,
                         radius,0,0,
                         -radius,0,0,
                         0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
+                        0,-radius,0], dtype=torch.float, device=device).reshape(-1,3)
     pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
     projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
@@ -627,6 +1536,240 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
 
 
 
+class CropWorkspace:
+  '''Crop buffers of make_crop_data_batch that are kept across refine iterations and frames, so the hot loop fills them in place instead of allocating new tensors every round.
+  Buffers are keyed by name and shape, a new batch size or input_resize allocates once and is reused from then on
+  @max_entries: number of buffers kept alive, the least recently used one is dropped first
+  '''
+  def __init__(self, max_entries=12):
+    self.max_entries = max_entries
+    self.buffers = OrderedDict()
+    self.n_alloc = 0   # Buffers allocated so far, stays flat once the shapes are warm
+
+
+  def get(self, name, shape, dtype=torch.float, device='cuda'):
+    '''Uninitialized buffer, the caller overwrites all of it
+    '''
+    key = (name, tuple(shape), dtype, str(device))
+    if key in self.buffers:
+      self.buffers.move_to_end(key)
+      return self.buffers[key]
+    buf = torch.empty(shape, dtype=dtype, device=device)
+    self.n_alloc += 1
+    self.buffers[key] = buf
+    while len(self.buffers)>self.max_entries:
+      self.buffers.popitem(last=False)
+    return buf
+
+
+  def clear(self):
+    self.buffers.clear()
+
+
+
+def rotation_to_ray(t):
+  '''Rotations turning the optical axis onto the direction of t, about the axis perpendicular to both
+  @t: (B,3) torch tensor
+  Return: (B,3,3) torch tensor
+  '''
+  t = F.normalize(t, dim=-1)
+  axis = torch.stack([-t[:,1], t[:,0], torch.zeros_like(t[:,0])], dim=-1)   # z x t
+  s = axis.norm(dim=-1).reshape(-1,1,1)
+  k = axis/s.reshape(-1,1).clamp(min=1e-12)
+  cross = torch.zeros((len(t),3,3), dtype=t.dtype, device=t.device)
+  cross[:,0,2] = k[:,1]
+  cross[:,1,2] = -k[:,0]
+  cross[:,2,0] = -k[:,1]
+  cross[:,2,1] = k[:,0]
+  c = t[:,2].reshape(-1,1,1)
+  return torch.eye(3, dtype=t.dtype, device=t.device)[None] + s*cross + (1-c)*cross@cross
+
+
+
+class TemplateBank:
+  '''Crops of the rotation grid rendered once on the optical axis at canonical_depth, used instead of rendering the first refine iteration of register.
+  A hypothesis at center t uses the grid turned by rotation_to_ray(t) (see hypotheses), which the camera sees from the same side as the bank pose of the grid entry.
+  The bank crop is then exact up to a homography, applied in crops, except for:
+  - depth relief, rendered for canonical_depth instead of |t|
+  - lighting, which stays along the optical axis and so hits the object up to the off-axis angle differently
+  - uint8 colors, float16 xyz and the resampling of the warp
+  @rgba: (N,H,W,4) uint8 np array, color and object mask of each rot_grid entry
+  @xyz: (N,H,W,3) float16 np array, camera points relative to the object center
+  '''
+  canonical_depth = 4   # In unit of diameter
+  version = 1   # Bump when the rendering changes, invalidates banks on disk
+
+  def __init__(self, rot_grid, rgba, xyz, mesh_diameter, crop_ratio, max_off_axis=30):
+    self.rot_grid = rot_grid
+    self.rgba = rgba
+    self.xyz = xyz
+    self.max_off_axis = max_off_axis   # Deg, lighting error grows with it
+    self.resident = {}   # Copies per device, uploaded on first use
+    self.K, self.pose, self.tf_to_crop = self.canonical_view(rgba.shape[1:3], crop_ratio, mesh_diameter, device=rot_grid.device)
+
+
+  @classmethod
+  def canonical_view(cls, render_size, crop_ratio, mesh_diameter, device='cuda'):
+    '''Camera, object translation and crop transform the bank is rendered with
+    '''
+    H,W = render_size
+    K = np.array([[W,0,W/2],[0,W,H/2],[0,0,1]], dtype=float)   # Any camera works, crops are resampled to render_size
+    pose = torch.eye(4, device=device)[None]
+    pose[:,2,3] = mesh_diameter*cls.canonical_depth
+    tf_to_crop = compute_crop_window_tf_batch(H=H, W=W, poses=pose, K=K, crop_ratio=crop_ratio, out_size=(W,H), method='box_3d', mesh_diameter=mesh_diameter)
+    return K, pose[0], tf_to_crop[0]
+
+
+  @classmethod
+  def build(cls, rot_grid, mesh_tensors, mesh_diameter, render_size, crop_ratio, glctx=None, cache_dir=None, key=None, max_off_axis=30, bs=256):
+    '''Render the bank, or memory-map it if cache_dir already holds it
+    @rot_grid: (N,4,4) torch tensor
+    @render_size: (H,W) of the crops, cfg['input_resize']
+    @cache_dir: bank files go to cache_dir/<hash>/ next to the banks of other meshes, None keeps the bank in memory only
+    @key: identifies the mesh in cache_dir, e.g. mesh_hash
+    '''
+    device = rot_grid.device
+    rot_grid = rot_grid.float()
+    path = None
+    if cache_dir is not None:
+      h = hashlib.sha1(f'{key}_{tuple(render_size)}_{crop_ratio}_{cls.canonical_depth}_{cls.version}'.encode())
+      h.update(rot_grid.data.cpu().numpy().round(5).tobytes())
+      path = f'{cache_dir}/{h.hexdigest()}'
+      if os.path.exists(f'{path}/xyz.npy'):
+        logging.info(f'template bank from {path}')
+        return cls(rot_grid, np.load(f'{path}/rgba.npy', mmap_mode='r'), np.load(f'{path}/xyz.npy', mmap_mode='r'), mesh_diameter, crop_ratio, max_off_axis=max_off_axis)
+
+    H,W = render_size
+    K, pose, tf_to_crop = cls.canonical_view(render_size, crop_ratio, mesh_diameter, device=device)
+    poses = rot_grid.clone()
+    poses[:,:3,3] = pose[:3,3]
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, W-1, H-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d = transform_pts(bbox2d_crop, tf_to_crop.inverse()).reshape(1,4).expand(len(poses),-1)
+    rgba = np.empty((len(poses),H,W,4), dtype=np.uint8)
+    xyz = np.empty((len(poses),H,W,3), dtype=np.float16)
+    for b in range(0,len(poses),bs):
+      extra = {}
+      color, depth, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses[b:b+bs], context='cuda', glctx=glctx, mesh_tensors=mesh_tensors, output_size=render_size, bbox2d=bbox2d[b:b+bs], use_light=True, extra=extra, lod_size=min(render_size)/crop_ratio)
+      valid = depth[...,None]>0
+      rgba[b:b+bs,...,:3] = (color*255).round().byte().data.cpu().numpy()
+      rgba[b:b+bs,...,3] = valid[...,0].byte().mul(255).data.cpu().numpy()
+      xyz[b:b+bs] = torch.where(valid, extra['xyz_map']-pose[:3,3], 0).half().data.cpu().numpy()
+    logging.info(f'template bank rendered, {len(poses)} crops')
+
+    if path is not None:
+      os.makedirs(path, exist_ok=True)
+      for name, arr in [('rgba', rgba), ('xyz', xyz)]:   # xyz.npy last, it marks a complete bank
+        tmp = f'{path}/{name}.{uuid4()}.npy'
+        np.save(tmp, arr)
+        os.replace(tmp, f'{path}/{name}.npy')
+      logging.info(f'template bank saved to {path}')
+    return cls(rot_grid, rgba, xyz, mesh_diameter, crop_ratio, max_off_axis=max_off_axis)
+
+
+  def hypotheses(self, center):
+    '''rot_grid turned to face center, placed at center
+    @center: (3,) torch tensor
+    '''
+    poses = self.rot_grid.clone()
+    poses[:,:3,:3] = rotation_to_ray(center.reshape(1,3).float())@poses[:,:3,:3]
+    poses[:,:3,3] = center.reshape(1,3)
+    return poses
+
+
+  def covers(self, poses):
+    '''Whether all poses are within max_off_axis of the optical axis
+    @poses: (B,4,4) torch tensor
+    '''
+    t = poses[:,:3,3]
+    off_axis = torch.atan2(t[:,:2].norm(dim=-1), t[:,2])
+    return bool((off_axis<=np.deg2rad(self.max_off_axis)).all())
+
+
+  def crops(self, ids, poses, K, tf_to_crops):
+    '''Bank crops warped to the crop windows of poses, in the layout of the nvdiffrast_render outputs
+    @ids: (B,) rot_grid index of each pose, poses[i] must be hypotheses(t)[ids[i]]
+    @poses: (B,4,4) torch tensor
+    @K: (3,3) camera of the poses
+    @tf_to_crops: (B,3,3) crop transforms of the poses, see compute_crop_window_tf_batch
+    Return: color (B,H,W,3) in [0,1], depth (B,H,W), xyz_map (B,H,W,3)
+    '''
+    device = poses.device
+    if str(device) not in self.resident:
+      self.resident[str(device)] = (torch.as_tensor(np.array(self.rgba), device=device), torch.as_tensor(np.array(self.xyz), device=device))
+    rgba, xyz = self.resident[str(device)]
+    ids = torch.as_tensor(ids, device=device)
+    H,W = rgba.shape[1:3]
+    t = poses[:,:3,3]
+    R = rotation_to_ray(t)
+
+    ########## Bank crop pixel -> ray of the canonical camera -> scaled to depth |t| and turned to t -> crop pixel of the pose
+    scale = torch.ones((len(t),3), dtype=torch.float, device=device)
+    scale[:,2] = t.norm(dim=-1)/self.pose[2,3]
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
+    K_bank_inv = torch.as_tensor(np.linalg.inv(self.K), dtype=torch.float, device=device)
+    tfs = tf_to_crops@K@R@torch.diag_embed(scale)@K_bank_inv@self.tf_to_crop.inverse()
+
+    color = kornia.geometry.transform.warp_perspective(rgba[ids][...,:3].permute(0,3,1,2).float()/255, tfs, dsize=(H,W), mode='bilinear', align_corners=False)
+    xyz_valid = torch.cat([xyz[ids].float(), rgba[ids][...,3:].float()], dim=-1).permute(0,3,1,2)
+    xyz_valid = kornia.geometry.transform.warp_perspective(xyz_valid, tfs, dsize=(H,W), mode='nearest', align_corners=False).permute(0,2,3,1)
+    valid = xyz_valid[...,3:]>0
+    xyz_map = torch.where(valid, xyz_valid[...,:3]@R.transpose(1,2)[:,None]+t[:,None,None], 0)
+    return color.permute(0,2,3,1), xyz_map[...,2], xyz_map
+
+
+
+def sample_crops_frames(imgs, tfs, dsize, modes, frame_ids=None, out=None):
+  '''Same crops as kornia warp_perspective (align_corners=False, zero padding) of each frame, specialized to the axis aligned scale+translate transforms of compute_crop_window_tf_batch.
+  The sample positions are separable per row/column, so instead of a homography grid per hypothesis and image, one grid is built by broadcasting and shared by all images, and the crops of every frame are sampled in one grid_sample call with the frames on its batch axis
+  @imgs: list of (N_frame,H,W,C) channels last tensors of the same frame size, e.g. [rgb, xyz_map]
+  @tfs: (B,3,3) torch tensor, crop transforms
+  @dsize: (h,w) of the crops
+  @modes: 'bilinear' or 'nearest' per image
+  @frame_ids: (B,) index into imgs for each crop. None means all crops come from imgs[0]
+  @out: optional (B,sum(C),h,w) tensor, or list of (B,C,h,w) tensors one per image, to write the crops into
+  Return: out
+  '''
+  B = len(tfs)
+  N,H,W = imgs[0].shape[:3]
+  h,w = dsize
+  device = tfs.device
+  dtype = imgs[0].dtype
+  if out is None:
+    out = torch.empty((B, sum(img.shape[-1] for img in imgs), h, w), dtype=dtype, device=device)
+  outs = torch.split(out, [img.shape[-1] for img in imgs], dim=1) if torch.is_tensor(out) else out
+
+  ########## Crop pixel -> normalized source coordinate with the ops of kornia warp_perspective, so nearest sampling rounds the same way. x only depends on the column and y on the row
+  src_norm_trans_dst_norm = torch.linalg.inv(kornia.geometry.conversions.normalize_homography(tfs, (H,W), (h,w)))[:,None,None]
+  u = ((torch.linspace(0, w-1, w, device=device)/(w-1) - 0.5)*2).to(dtype)   # The normalized create_meshgrid row and column
+  v = ((torch.linspace(0, h-1, h, device=device)/(h-1) - 0.5)*2).to(dtype)
+  row = torch.stack([u, torch.full_like(u, -1)], dim=-1)
+  col = torch.stack([torch.full_like(v, -1), v], dim=-1)
+  xs = kornia.geometry.linalg.transform_points(src_norm_trans_dst_norm, row[None,None].expand(B,-1,-1,-1))[:,0,:,0]   #(B,w)
+  ys = kornia.geometry.linalg.transform_points(src_norm_trans_dst_norm, col[None,None].expand(B,-1,-1,-1))[:,0,:,1]   #(B,h)
+
+  ########## Crops of frame f go to slots 0..n_f-1 of batch item f, slots a frame does not fill sample outside the image
+  if frame_ids is None:
+    N = 1
+    frame_ids = np.zeros((B), dtype=int)
+  frame_ids = frame_ids.data.cpu().numpy() if torch.is_tensor(frame_ids) else np.asarray(frame_ids)
+  counts = np.bincount(frame_ids, minlength=N)
+  slot_ids = np.empty((B), dtype=int)
+  slot_ids[np.argsort(frame_ids, kind='stable')] = np.arange(B) - np.repeat(np.cumsum(counts)-counts, counts)
+  n_slot = counts.max()
+  frame_ids = torch.as_tensor(frame_ids, device=device)
+  slot_ids = torch.as_tensor(slot_ids, device=device)
+  grid = torch.full((N, n_slot, h, w, 2), 2, dtype=dtype, device=device)
+  grid[frame_ids, slot_ids, ..., 0] = xs[:,None,:]
+  grid[frame_ids, slot_ids, ..., 1] = ys[:,:,None]
+  grid = grid.reshape(N, n_slot*h, w, 2)
+
+  for img, mode, o in zip(imgs, modes, outs):
+    crop = F.grid_sample(img[:N].permute(0,3,1,2), grid, mode=mode, padding_mode='zeros', align_corners=False)   #(N,C,n_slot*h,w)
+    o.copy_(crop.reshape(N, -1, n_slot, h, w).permute(0,2,1,3,4)[frame_ids, slot_ids])
+  return out
+
+
+
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
   uv_top_left = np.array(uv_top_left, dtype=float)
@@ -834,6 +1977,133 @@ def symmetry_tfs_from_info(info, rot_angle_discrete=5):
   return symmetry_tfs
 
 
+def sample_mesh_surface(mesh, n_sample=20000, seed=0):
+  '''Area weighted surface points with the color interpolated from the vertex colors, textures are baked to vertex colors first
+  Return: pts (N,3), colors (N,3) float in [0,255], normals (N,3) of the faces the points lie on
+  '''
+  rng = np.random.default_rng(seed)
+  faces = np.asarray(mesh.faces)
+  area = np.asarray(mesh.area_faces)
+  face_ids = rng.choice(len(faces), size=n_sample, p=area/area.sum())
+  bary = rng.random((n_sample,2))
+  flip = bary.sum(axis=1)>1
+  bary[flip] = 1-bary[flip]
+  weights = np.concatenate([1-bary.sum(axis=1,keepdims=True), bary], axis=1)[...,None]  #(N,3,1)
+  pts = (np.asarray(mesh.vertices)[faces[face_ids]]*weights).sum(axis=1)
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    vertex_colors = mesh.visual.to_color().vertex_colors
+  else:
+    vertex_colors = mesh.visual.vertex_colors
+  colors = (np.asarray(vertex_colors)[faces[face_ids],:3].astype(np.float64)*weights).sum(axis=1)
+  return pts, colors, np.asarray(mesh.face_normals)[face_ids]
+
+
+def mesh_surface_moments(mesh):
+  '''Exact area weighted centroid and covariance of the mesh surface, summed over the triangles
+  Return: center (3,), cov (3,3)
+  '''
+  tris = np.asarray(mesh.triangles)
+  area = np.asarray(mesh.area_faces)
+  center = (area[:,None]*tris.mean(axis=1)).sum(axis=0)/area.sum()
+  tris = tris-center
+  corner_sum = tris.sum(axis=1)
+  cov = np.einsum('f,fvi,fvj->ij', area, tris, tris) + np.einsum('f,fi,fj->ij', area, corner_sum, corner_sum)
+  return center, cov/(12*area.sum())
+
+
+def close_symmetry_group(generators, max_size=500, angle_tol=1):
+  '''All products of the generators, identity first, elements closer than angle_tol degree are merged
+  '''
+  group = [np.eye(4)]
+  cos_tol = np.cos(np.deg2rad(angle_tol))
+  i = 0
+  while i<len(group) and len(group)<max_size:
+    for g in generators:
+      tf = group[i]@g
+      Rs = np.asarray(group)[:,:3,:3]
+      if ((np.einsum('nij,ij->n', Rs, tf[:3,:3])-1)/2<cos_tol).all():
+        group.append(tf)
+    i += 1
+  return np.asarray(group)
+
+
+_mesh_symmetries = {}
+
+def detect_symmetry_tfs(mesh, rot_angle_discrete=5, max_order=12, n_sample=20000, tol=0.001, color_tol=20):
+  '''Rotational symmetries of the mesh, in the same format as symmetry_tfs_from_info. Candidate axes through the surface centroid are
+  the mesh x,y,z axes plus the principal axes, both from the exact surface moments. An axis is symmetric if surface samples rotated about it
+  land on the surface, measured from their nearest sample to its tangent plane with a KD-tree, and keep their color. Cached per mesh hash
+  @rot_angle_discrete: degree, step of the discretized continuous symmetries
+  @tol: allowed mean distance off the surface, in unit of diameter
+  @color_tol: allowed mean color difference in [0,255]
+  Return: (S,4,4) np array, identity first
+  '''
+  key = (mesh_hash(mesh), rot_angle_discrete, max_order, tol, color_tol)
+  if key in _mesh_symmetries:
+    return _mesh_symmetries[key]
+
+  pts, colors, normals = sample_mesh_surface(mesh, n_sample=n_sample)
+  center, cov = mesh_surface_moments(mesh)
+  diameter = np.linalg.norm(pts.max(axis=0)-pts.min(axis=0))
+  kdtree = cKDTree(pts)
+  check_color = colors.std(axis=0).max()>1
+  query_pts, query_colors, _ = sample_mesh_surface(mesh, n_sample=n_sample//10, seed=1)   # Other samples, so exact symmetries are not scored on their own points
+
+  def is_symmetric(axis, angle):
+    '''Point to plane distances, exact symmetries leave only the curvature between samples'''
+    tf = rotation_matrix(angle, axis, center)
+    query = query_pts@tf[:3,:3].T+tf[:3,3]
+    _, ids = kdtree.query(query)
+    dists = np.abs(((query-pts[ids])*normals[ids]).sum(axis=1))
+    if dists.mean()>tol*diameter or np.quantile(dists, 0.9)>2*tol*diameter:
+      return False
+    return not check_color or np.abs(colors[ids]-query_colors).mean()<=color_tol
+
+  _, eigvecs = np.linalg.eigh(cov)
+  axes = []
+  for axis in list(np.eye(3))+list(eigvecs.T):   # Mesh axes first, most symmetric objects are modeled aligned with them
+    if all(abs(axis@other)<np.cos(np.deg2rad(1)) for other in axes):
+      axes.append(axis)
+
+  generators = []
+  continuous = [axis for axis in axes if all(is_symmetric(axis, np.deg2rad(angle)) for angle in [37, 90, 143])]
+  if len(continuous)>0:
+    axis = continuous[0]
+    logging.info(f"continuous symmetry about {axis}")
+    generators.append(rotation_matrix(np.deg2rad(rot_angle_discrete), axis, center))
+    for other in axes:   # With the rotations, one perpendicular flip gives all of them
+      if abs(other@axis)<np.sin(np.deg2rad(1)) and is_symmetric(other, np.pi):
+        generators.append(rotation_matrix(np.pi, other, center))
+        break
+  else:
+    for axis in axes:
+      for order in range(max_order, 1, -1):
+        if all(is_symmetric(axis, 2*np.pi*k/order) for k in range(1, order//2+1)):
+          logging.info(f"{order}-fold symmetry about {axis}")
+          generators.append(rotation_matrix(2*np.pi/order, axis, center))
+          if len(generators)==1 and order>2:   # Flips of a regular prism pass through its outermost vertex, which the principal axes miss when they are degenerate
+            offsets = np.asarray(mesh.vertices)-center
+            offsets -= (offsets@axis)[:,None]*axis
+            flip_axis = offsets[np.linalg.norm(offsets, axis=1).argmax()]
+            flip_axis /= np.linalg.norm(flip_axis)
+            if all(abs(flip_axis@other)<np.cos(np.deg2rad(1)) for other in axes):
+              axes.append(flip_axis)
+          break
+
+  # Slightly off axes that pass the check generate runaway groups, keep the generators that close into a valid group
+  max_size = 2*int(np.ceil(360/rot_angle_discrete)) if len(continuous)>0 else max(60, 2*max_order)
+  symmetry_tfs = np.eye(4)[None]
+  kept = []
+  for generator in generators:
+    group = close_symmetry_group(kept+[generator], max_size=max_size+1)
+    if len(group)<=max_size:
+      kept.append(generator)
+      symmetry_tfs = group
+  logging.info(f"detected {len(symmetry_tfs)} symmetry tfs")
+  _mesh_symmetries[key] = symmetry_tfs
+  return symmetry_tfs
+
+
 
 def pose_to_egocentric_delta_pose(A_in_cam, B_in_cam):
   '''Used for Pose Refinement. Given the object's two poses in camera, convert them to relative poses in camera's egocentric view
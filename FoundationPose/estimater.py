@@ -16,32 +16,44 @@ import yaml
 
 
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/'):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/', device='cuda', lod_face_budgets=None):
+    '''
+    @device: torch device the whole pipeline runs on, 'cpu' renders with rasterize_cpu_tiled instead of nvdiffrast
+    @lod_face_budgets: see reset_object
+    '''
+    self.device = device
     self.gt_pose = None
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
     os.makedirs(debug_dir, exist_ok=True)
 
-    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
-    self.make_rotation_grid(min_n_views=40, inplane_step=60)
-
-    self.glctx = glctx
-
     if scorer is not None:
       self.scorer = scorer
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=device)
 
     if refiner is not None:
       self.refiner = refiner
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=device)
+
+    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh, lod_face_budgets=lod_face_budgets)
+    self.make_rotation_grid(min_n_views=40, inplane_step=60)
+
+    self.glctx = glctx
 
     self.pose_last = None   # Used for tracking; per the centered mesh
+    self.use_depth_roi = True   # Only preprocess depth around the object, see get_depth_roi
+    self.roi_margin = 0.5   # Extra roi radius in unit of diameter, covers pose updates during refinement
+    self.collapse_angle = 5   # Deg, refined hypotheses equivalent within this under symmetry_tfs are scored once
+    self.collapse_dist = 0.02   # In unit of diameter
 
 
-  def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None):
+  def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, lod_face_budgets=None):
+    '''
+    @lod_face_budgets: face counts of the decimated meshes used for small crop renders, e.g. (100000, 30000, 10000). None renders the full mesh only. Decimating needs open3d
+    '''
     max_xyz = mesh.vertices.max(axis=0)
     min_xyz = mesh.vertices.min(axis=0)
     self.model_center = (min_xyz+max_xyz)/2
@@ -56,36 +68,42 @@ class FoundationPose:
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    pts, normals = voxel_downsample(np.asarray(model_pts), self.vox_size, normals=np.asarray(model_normals))
+    self.max_xyz = pts.max(axis=0)
+    self.min_xyz = pts.min(axis=0)
+    self.pts = torch.tensor(pts, dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(normals, dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
     self.mesh_path = None
     self.mesh = mesh
     if self.mesh is not None:
       self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
       self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
+    lod_size = max(min(predictor.cfg['input_resize'])/predictor.cfg['crop_ratio'] for predictor in [self.refiner, self.scorer])
+    self.mesh_tensors = make_mesh_tensors(self.mesh, device=self.device, lod_size=lod_size)
+    if lod_face_budgets is not None:
+      self.mesh_tensors['lods'] = make_mesh_lods(self.mesh, face_budgets=lod_face_budgets, device=self.device)
+
+    self.template_bank = None
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, device=self.device).float()[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
+
+    self.tf_to_centered_mesh = torch.eye(4, dtype=torch.float, device=self.device)
+    self.tf_to_centered_mesh[:3,3] = -torch.as_tensor(self.model_center, device=self.device, dtype=torch.float)
 
     logging.info("reset done")
 
 
 
   def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
-    return tf_to_center
+    return self.tf_to_centered_mesh
 
 
   def to_device(self, s='cuda:0'):
+    self.device = s
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
@@ -93,48 +111,61 @@ class FoundationPose:
         self.__dict__[k] = self.__dict__[k].to(s)
     for k in self.mesh_tensors:
       logging.info(f"Moving {k} to device {s}")
+      if k=='lods':
+        self.mesh_tensors[k] = [{kk: v.to(s) for kk,v in lod.items()} for lod in self.mesh_tensors[k]]
+        continue
+      if k=='tex_mips':
+        self.mesh_tensors[k] = [tex.to(s) for tex in self.mesh_tensors[k]]
+        continue
       self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
+    if 'tex_mips' in self.mesh_tensors:
+      self.mesh_tensors['tex'] = self.mesh_tensors['tex_mips'][0]
     if self.refiner is not None:
       self.refiner.model.to(s)
+      self.refiner.device = torch.device(s)
+      self.refiner.dataset.device = self.refiner.device
     if self.scorer is not None:
       self.scorer.model.to(s)
-    if self.glctx is not None:
+      self.scorer.device = torch.device(s)
+      self.scorer.dataset.device = self.scorer.device
+    if self.glctx is not None and not isinstance(self.glctx, CpuRasterizeContext) and torch.device(s).type=='cuda':
       self.glctx = dr.RasterizeCudaContext(s)
 
 
 
   def make_rotation_grid(self, min_n_views=40, inplane_step=60):
-    cam_in_obs = sample_views_icosphere(n_views=min_n_views)
-    logging.info(f'cam_in_obs:{cam_in_obs.shape}')
-    rot_grid = []
-    for i in range(len(cam_in_obs)):
-      for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
-        cam_in_ob = cam_in_obs[i]
-        R_inplane = euler_matrix(0,0,inplane_rot)
-        cam_in_ob = cam_in_ob@R_inplane
-        ob_in_cam = np.linalg.inv(cam_in_ob)
-        rot_grid.append(ob_in_cam)
-
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
+    rot_grid = make_rotation_grid(min_n_views=min_n_views, inplane_step=inplane_step, symmetry_tfs=self.symmetry_tfs.data.cpu().numpy())
     logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    self.rot_grid = torch.tensor(rot_grid, device=self.device, dtype=torch.float)
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
+    self.template_bank = None
+
+
+  def make_template_bank(self, cache_dir=None, max_off_axis=30):
+    '''Pre-render the rot_grid crops the first refine iteration of register starts from, see TemplateBank for the approximation. Off by default.
+    Register then starts from the grid turned towards the object center, which covers rotations as evenly as rot_grid
+    @cache_dir: keeps banks on disk per mesh, so estimators of a mesh seen before memory-map it instead of rendering. None keeps it in memory
+    @max_off_axis: deg, object centers further from the optical axis are rendered as before
+    '''
+    self.template_bank = TemplateBank.build(self.rot_grid, self.mesh_tensors, self.diameter, render_size=self.refiner.cfg['input_resize'], crop_ratio=self.refiner.cfg['crop_ratio'], glctx=self.glctx, cache_dir=cache_dir, key=mesh_hash(self.mesh), max_off_axis=max_off_axis)
 
 
+  @trace_span('hypothesis_generation')
   def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None):
     '''
     @scene_pts: torch tensor (N,3)
     '''
-    ob_in_cams = self.rot_grid.clone()
     center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    if self.template_bank is not None:
+      return self.template_bank.hypotheses(torch.as_tensor(center, device=self.device, dtype=torch.float))
+    ob_in_cams = self.rot_grid.clone()
+    ob_in_cams[:,:3,3] = torch.as_tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
     return ob_in_cams
 
 
   def guess_translation(self, depth, mask, K):
+    if torch.is_tensor(depth):
+      return self.guess_translation_tensor(depth=depth, mask=mask, K=K)
     vs,us = np.where(mask>0)
     if len(us)==0:
       logging.info(f'mask is all zero')
@@ -150,85 +181,129 @@ class FoundationPose:
     center = (np.linalg.inv(K)@np.asarray([uc,vc,1]).reshape(3,1))*zc
 
     if self.debug>=2:
-      pcd = toOpen3dCloud(center.reshape(1,3))
-      o3d.io.write_point_cloud(f'{self.debug_dir}/init_center.ply', pcd)
+      get_debug_writer().write_point_cloud(f'{self.debug_dir}/init_center.ply', center.reshape(1,3))
 
     return center.reshape(3)
 
 
+  def guess_translation_tensor(self, depth, mask, K):
+    '''Same as guess_translation but stays on the device of depth, nothing is read back to host
+    @depth: (H,W) torch tensor
+    Return: (3,) torch tensor
+    '''
+    device = depth.device
+    H,W = depth.shape[-2:]
+    mask = torch.as_tensor(mask, device=device)>0
+    us = torch.arange(W, device=device, dtype=torch.float)
+    vs = torch.arange(H, device=device, dtype=torch.float)
+    mask_u = mask.any(dim=0)
+    mask_v = mask.any(dim=1)
+    uc = (torch.where(mask_u, us, float(W)).min()+torch.where(mask_u, us, -1.0).max())/2.0
+    vc = (torch.where(mask_v, vs, float(H)).min()+torch.where(mask_v, vs, -1.0).max())/2.0
+    valid = mask & (depth>=0.001)
+    zc = torch.nanquantile(torch.where(valid, depth, np.nan).reshape(-1), 0.5)  # np.median of the valid depths
+    K_inv = torch.as_tensor(np.linalg.inv(K), device=device, dtype=torch.float)
+    center = (K_inv@torch.stack([uc, vc, torch.ones_like(uc)]))*zc
+    center = torch.where(valid.any(), center, torch.zeros_like(center))
+
+    if self.debug>=2:
+      get_debug_writer().write_point_cloud(f'{self.debug_dir}/init_center.ply', center.reshape(1,3))
+
+    return center
+
+
+  def get_depth_roi(self, K, H, W, center, mask=None):
+    '''Pixel box holding every crop window (compute_crop_window_tf_batch) the refiner and scorer can request around center
+    @center: (3,) object center in camera
+    '''
+    if not self.use_depth_roi:
+      return (0, 0, W-1, H-1)
+    crop_ratio = max(self.refiner.cfg['crop_ratio'], self.scorer.cfg['crop_ratio'])
+    radius = self.diameter*(crop_ratio/2+self.roi_margin)
+    return compute_depth_roi(K, H, W, center=center, radius=radius, mask=mask)
+
+
+  @trace_span('preprocess_depth')
+  def preprocess_depth(self, depth, K, center, mask=None):
+    '''Filter depth and compute the xyz map only inside the roi around the object
+    '''
+    H,W = depth.shape[:2]
+    roi = self.get_depth_roi(K, H, W, center=center, mask=mask)
+    logging.debug('depth roi:%s', roi)
+    return filter_depth_roi(depth, K, roi, radius=2, device=self.device)
+
+
+  @trace_span('register')
   def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
     '''Copmute pose from given pts to self.pcd
     @pts: (N,3) np array, downsampled scene points
     '''
     set_seed(0)
-    logging.info('Welcome')
 
     if self.glctx is None:
       if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
-        # self.glctx = dr.RasterizeGLContext()
+        if torch.device(self.device).type=='cuda':
+          self.glctx = dr.RasterizeCudaContext()
+          # self.glctx = dr.RasterizeGLContext()
       else:
         self.glctx = glctx
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    # Single transfer in, everything below stays on device until the best pose is returned
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    mask_tensor = torch.as_tensor(ob_mask, device=self.device)>0
+
+    center = self.guess_translation(depth=depth_tensor, mask=mask_tensor, K=K)
+    depth_tensor, xyz_map = self.preprocess_depth(depth_tensor, K, center=center, mask=mask_tensor)
 
     if self.debug>=2:
-      xyz_map = depth2xyzmap(depth, K)
-      valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
-      o3d.io.write_point_cloud(f'{self.debug_dir}/scene_raw.ply',pcd)
-      cv2.imwrite(f'{self.debug_dir}/ob_mask.png', (ob_mask*255.0).clip(0,255))
+      writer = get_debug_writer()
+      writer.write_point_cloud(f'{self.debug_dir}/scene_raw.ply', xyz_map, rgb)
+      writer.write_image(f'{self.debug_dir}/ob_mask.png', lambda: (ob_mask*255.0).clip(0,255))
 
     normal_map = None
-    valid = (depth>=0.001) & (ob_mask>0)
+    valid = (depth_tensor>=0.001) & mask_tensor
     if valid.sum()<4:
       logging.info(f'valid too small, return')
-      pose = np.eye(4)
-      pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-      return pose
+      pose = torch.eye(4, device=self.device)
+      pose[:3,3] = center
+      return pose.data.cpu().numpy()
 
     if self.debug>=2:
-      imageio.imwrite(f'{self.debug_dir}/color.png', rgb)
-      cv2.imwrite(f'{self.debug_dir}/depth.png', (depth*1000).astype(np.uint16))
-      valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
-      o3d.io.write_point_cloud(f'{self.debug_dir}/scene_complete.ply',pcd)
+      writer.write_image(f'{self.debug_dir}/color.png', rgb)
+      writer.write_image(f'{self.debug_dir}/depth.png', lambda: (depth_tensor.data.cpu().numpy()*1000).astype(np.uint16))
+      writer.write_point_cloud(f'{self.debug_dir}/scene_complete.ply', xyz_map, rgb)
 
     self.H, self.W = depth.shape[:2]
     self.K = K
     self.ob_id = ob_id
     self.ob_mask = ob_mask
 
-    poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    poses = poses.data.cpu().numpy()
-    logging.info(f'poses:{poses.shape}')
-    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
+    poses = self.generate_random_pose_hypo(K=K, rgb=rgb_tensor, depth=depth_tensor, mask=mask_tensor, scene_pts=None)
+    logging.debug('poses:%s', poses.shape)
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
+    logging.debug("after viewpoint, add_errs min:%s", add_errs.min())
 
-    xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
+    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb_tensor, depth=depth_tensor, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2, templates=self.template_bank, template_ids=np.arange(len(poses)))
     if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
+      get_debug_writer().write_image(f'{self.debug_dir}/vis_refiner.png', vis)
 
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
+    poses = self.collapse_symmetric_poses(poses)
+
+    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb_tensor, depth=depth_tensor, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
     if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
+      get_debug_writer().write_image(f'{self.debug_dir}/vis_score.png', vis)
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"final, add_errs min:{add_errs.min()}")
+    logging.debug("final, add_errs min:%s", add_errs.min())
 
-    ids = torch.as_tensor(scores).argsort(descending=True)
-    logging.info(f'sort ids:{ids}')
+    ids = scores.argsort(descending=True)
+    logging.debug('sort ids:%s', ids)
     scores = scores[ids]
     poses = poses[ids]
 
-    logging.info(f'sorted scores:{scores}')
+    logging.debug('sorted scores:%s', scores)
 
     best_pose = poses[0]@self.get_tf_to_centered_mesh()
     self.pose_last = poses[0]
@@ -240,31 +315,123 @@ class FoundationPose:
     return best_pose.data.cpu().numpy()
 
 
+  @trace_span('register_batch')
+  def register_batch(self, K, rgbs, depths, ob_masks, glctx=None, iteration=5):
+    '''Register several unrelated frames of this object at once. Hypotheses of all frames are refined and scored together, each frame keeps its own score tournament
+    @rgbs: list of (H,W,3) np array, all frames share K and resolution
+    @depths: list of (H,W) np array
+    @ob_masks: list of (H,W) np array
+    Return: list of (4,4) np array, one per frame
+    '''
+    set_seed(0)
+    logging.debug('n_frame:%s', len(rgbs))
+
+    if self.glctx is None:
+      if glctx is None:
+        if torch.device(self.device).type=='cuda':
+          self.glctx = dr.RasterizeCudaContext()
+      else:
+        self.glctx = glctx
+
+    best_poses = [None]*len(rgbs)
+    valid_ids = []
+    rgbs_valid = []
+    depths_valid = []
+    xyz_maps = []
+    poses = []
+    for i in range(len(rgbs)):
+      depth = torch.as_tensor(depths[i], device=self.device, dtype=torch.float)
+      mask = torch.as_tensor(ob_masks[i], device=self.device)>0
+      center = self.guess_translation(depth=depth, mask=mask, K=K)
+      depth, xyz_map = self.preprocess_depth(depth, K, center=center, mask=mask)
+      valid = (depth>=0.001) & mask
+      if valid.sum()<4:
+        logging.info(f'frame {i} valid too small')
+        pose = torch.eye(4, device=self.device)
+        pose[:3,3] = center
+        best_poses[i] = pose.data.cpu().numpy()
+        continue
+      valid_ids.append(i)
+      rgbs_valid.append(torch.as_tensor(rgbs[i], device=self.device, dtype=torch.float))
+      depths_valid.append(depth)
+      xyz_maps.append(xyz_map)
+      poses.append(self.generate_random_pose_hypo(K=K, rgb=rgbs_valid[-1], depth=depth, mask=mask, scene_pts=None))
+
+    if len(valid_ids)==0:
+      return best_poses
+
+    n_hypo = len(poses[0])
+    poses = torch.cat(poses, dim=0)
+    frame_ids = np.repeat(np.arange(len(valid_ids)), n_hypo)
+    rgbs_valid = torch.stack(rgbs_valid, dim=0)
+    depths_valid = torch.stack(depths_valid, dim=0)
+    xyz_maps = torch.stack(xyz_maps, dim=0)
+    logging.debug('poses:%s', poses.shape)
+
+    poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgbs_valid, depth=depths_valid, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_maps, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, frame_ids=frame_ids, templates=self.template_bank, template_ids=np.tile(np.arange(n_hypo), len(valid_ids)))
+
+    poses = self.collapse_symmetric_poses(poses.reshape(len(valid_ids), n_hypo, 4, 4))
+    n_hypo = poses.shape[1]
+    poses = poses.reshape(-1, 4, 4)
+    frame_ids = np.repeat(np.arange(len(valid_ids)), n_hypo)
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgbs_valid, depth=depths_valid, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, frame_ids=frame_ids)
+
+    poses = poses.reshape(len(valid_ids), n_hypo, 4, 4)
+    best_ids = scores.reshape(len(valid_ids), n_hypo).argmax(dim=1)
+    best = poses[torch.arange(len(valid_ids), device=poses.device), best_ids]@self.get_tf_to_centered_mesh()
+    best = best.data.cpu().numpy()
+    for j,i in enumerate(valid_ids):
+      best_poses[i] = best[j]
+    return best_poses
+
+
+  def collapse_symmetric_poses(self, poses):
+    '''Keep one of each group of hypotheses that are the same pose up to symmetry_tfs, so the scorer does not compare equivalent poses
+    @poses: (N,4,4) torch tensor, or (F,N,4,4) with the hypotheses of F frames collapsed per frame. All frames then keep as many poses as the frame keeping the most, the others pad with copies of their first kept pose, which get its score and never win over it
+    '''
+    if len(self.symmetry_tfs)<=1:
+      return poses
+    if poses.ndim==3:
+      keep = cluster_pose_ids(self.collapse_angle, self.collapse_dist*self.diameter, poses, self.symmetry_tfs)
+      kept = poses[keep]   # The only sync, for the number of poses left
+      logging.debug(f'collapsed symmetric poses {len(poses)} -> {len(kept)}')
+      return kept
+    n_frame, n_hypo = poses.shape[:2]
+    keep = torch.stack([cluster_pose_ids(self.collapse_angle, self.collapse_dist*self.diameter, frame_poses, self.symmetry_tfs) for frame_poses in poses])
+    n_kept = keep.sum(dim=1, keepdim=True)
+    n_keep = int(n_kept.max())   # The only sync
+    hypo_ids = torch.arange(n_hypo, device=poses.device)
+    order = torch.argsort((~keep)*n_hypo + hypo_ids, dim=1)[:,:n_keep]   # Kept ones first, in their original order
+    order = torch.where(hypo_ids[:n_keep]<n_kept, order, order[:,:1])
+    kept = poses[torch.arange(n_frame, device=poses.device)[:,None], order]
+    logging.debug(f'collapsed symmetric poses {n_hypo} -> {n_keep} per frame')
+    return kept
+
+
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
 
 
+  @trace_span('track')
   def track_one(self, rgb, depth, K, iteration, extra={}):
+    '''
+    @extra: with debug>=2 gets 'vis', a function building the refiner debug canvas, see vis_refine_crops
+    '''
     if self.pose_last is None:
       logging.info("Please init pose by register first")
       raise RuntimeError
-    logging.info("Welcome")
-
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
-    logging.info("depth processing done")
 
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    depth, xyz_map = self.preprocess_depth(depth, K, center=self.pose_last[:3,3])
 
-    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
-    logging.info("pose done")
+    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
     if self.debug>=2:
       extra['vis'] = vis
-    self.pose_last = pose
+    self.pose_last = pose.reshape(4,4)   # Same (4,4) as register keeps, the refiner returns a batch of one
     return (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
 
 
@@ -86,6 +86,8 @@ class BatchPoseData:
     poseA = None  #(B,4,4)
     poseB = None
     targets = None  # Score targets, torch tensor (B)
+    inputAs = None  # (B,C,H,W) stacked network inputs when the crops live in a CropWorkspace
+    inputBs = None
 
     def __init__(self, rgbAs=None, rgbBs=None, depthAs=None, depthBs=None, normalAs=None, normalBs=None, maskAs=None, maskBs=None, poseA=None, poseB=None, xyz_mapAs=None, xyz_mapBs=None, tf_to_crops=None, Ks=None, crop_masks=None, model_pts=None, mesh_diameters=None, labels=None):
         self.rgbAs = rgbAs
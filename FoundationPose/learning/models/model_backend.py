@@ -0,0 +1,337 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,logging,copy,inspect,math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+try:
+  import onnxruntime as ort
+except:
+  ort = None
+
+
+BACKENDS = ['torch', 'onnx', 'int8', 'compiled']
+EXPORT_VERSION = 3   # Part of the exported artifact names, bump when the graph inputs change so stale caches are redone
+CONV_STACKS = {'refine': ['encodeA', 'encodeAB'], 'score': ['encoderA', 'encoderAB']}
+
+
+class ScoreNetExport(nn.Module):
+  '''ScoreNetMultiPair with the pairs as an explicit axis, so that L is a dynamic input dim instead of a python int
+  '''
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, A, B, B_ids):
+    '''
+    @A: (B,L,C,H,W)
+    @B: (N,C,H,W) distinct real image crops
+    @B_ids: (B,L) crop of each pair
+    '''
+    bs, L = A.shape[:2]
+    feats = self.model.extract_feat(A.reshape(-1,*A.shape[2:]), B, B_ids=B_ids.reshape(-1))
+    x = feats.reshape(bs,L,-1)
+    x, _ = self.model.att_cross(x, x, x)
+    return self.model.linear(x).reshape(bs,L)
+
+
+class RefineNetExport(nn.Module):
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, A, B, B_ids):
+    output = self.model(A, B, B_ids=B_ids)
+    return output['trans'], output['rot']
+
+
+class MultiheadAttentionExport(nn.Module):
+  '''batch_first nn.MultiheadAttention spelled out in plain ops. The tracing exporter of torch 2.0 has no symbolics for the unflatten and scaled_dot_product_attention calls it dispatches to
+  '''
+  def __init__(self, att):
+    super().__init__()
+    self.att = att
+
+  def forward(self, query, key, value, **kwargs):
+    att = self.att
+    head_dim = att.embed_dim//att.num_heads
+    w_q, w_k, w_v = att.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = att.in_proj_bias.chunk(3)
+    q = F.linear(query, w_q, b_q).reshape(query.shape[0], -1, att.num_heads, head_dim).transpose(1,2)
+    k = F.linear(key, w_k, b_k).reshape(key.shape[0], -1, att.num_heads, head_dim).transpose(1,2)
+    v = F.linear(value, w_v, b_v).reshape(value.shape[0], -1, att.num_heads, head_dim).transpose(1,2)
+    weights = torch.softmax(q@k.transpose(-2,-1)/math.sqrt(head_dim), dim=-1)
+    out = (weights@v).transpose(1,2).reshape(query.shape[0], -1, att.embed_dim)
+    return att.out_proj(out), None
+
+
+class TransformerEncoderLayerExport(nn.Module):
+  '''Eval time nn.TransformerEncoderLayer on top of MultiheadAttentionExport, without the fused fast path
+  '''
+  def __init__(self, layer):
+    super().__init__()
+    self.layer = layer
+    self.self_attn = MultiheadAttentionExport(layer.self_attn)
+
+  def forward(self, x):
+    layer = self.layer
+    ff = lambda x: layer.linear2(layer.activation(layer.linear1(x)))
+    if layer.norm_first:
+      x = x + self.self_attn(layer.norm1(x), layer.norm1(x), layer.norm1(x))[0]
+      return x + ff(layer.norm2(x))
+    x = layer.norm1(x + self.self_attn(x, x, x)[0])
+    return layer.norm2(x + ff(x))
+
+
+def plain_attention(module):
+  '''Copy of the model with the attention layers swapped for their plain op versions. These also never take the transformer fast path, which does not accept dynamically quantized Linear layers
+  '''
+  module = copy.deepcopy(module)
+  def swap(parent):
+    for name, child in parent.named_children():
+      if isinstance(child, nn.TransformerEncoderLayer):
+        setattr(parent, name, TransformerEncoderLayerExport(child))
+      elif isinstance(child, nn.MultiheadAttention):
+        setattr(parent, name, MultiheadAttentionExport(child))
+      else:
+        swap(child)
+  swap(module)
+  return module
+
+
+def export_onnx(model, onnx_file, kind, cfg):
+  '''Export the eager model with a dynamic batch (and for the scorer a dynamic L), B holds the distinct crops with their own dynamic count and B_ids picks the one of each pair. Uses the tracing exporter with dynamic_axes that torch 2.0 ships, on a copy with the attention layers in plain ops
+  @kind: refine or score
+  '''
+  H, W = cfg['input_resize'][1], cfg['input_resize'][0]
+  c_in = cfg['c_in']
+  model = model.float().eval()
+  device = next(model.parameters()).device
+  os.makedirs(os.path.dirname(onnx_file), exist_ok=True)
+  tmp_file = f'{onnx_file}.{os.getpid()}.tmp'
+  kwargs = {}
+  if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+    kwargs['dynamo'] = False   # Newer torch defaults to the torch.export based exporter
+  model = plain_attention(model)
+  B = torch.rand((2,c_in,H,W), device=device)
+  if kind=='refine':
+    A = torch.rand((3,c_in,H,W), device=device)
+    B_ids = torch.tensor([0,1,1], device=device)
+    dynamic_axes = {'A': {0:'batch'}, 'B': {0:'crops'}, 'B_ids': {0:'batch'}, 'trans': {0:'batch'}, 'rot': {0:'batch'}}
+    torch.onnx.export(RefineNetExport(model), (A, B, B_ids), tmp_file, input_names=['A','B','B_ids'], output_names=['trans','rot'], dynamic_axes=dynamic_axes, opset_version=17, **kwargs)
+  elif kind=='score':
+    A = torch.rand((3,4,c_in,H,W), device=device)
+    B_ids = torch.tensor([0,1,1,0], device=device).repeat(3,1)
+    dynamic_axes = {'A': {0:'batch', 1:'L'}, 'B': {0:'crops'}, 'B_ids': {0:'batch', 1:'L'}, 'score_logit': {0:'batch', 1:'L'}}
+    torch.onnx.export(ScoreNetExport(model), (A, B, B_ids), tmp_file, input_names=['A','B','B_ids'], output_names=['score_logit'], dynamic_axes=dynamic_axes, opset_version=17, **kwargs)
+  else:
+    raise RuntimeError(f'Unknown model kind {kind}')
+  os.replace(tmp_file, onnx_file)  # Atomic, concurrent workers never load a half written file
+  logging.info(f'exported {kind} model to {onnx_file}')
+
+
+class OnnxModel:
+  '''Runs an exported graph with ONNX Runtime behind the same call signature and output dict as the eager model
+  '''
+  def __init__(self, onnx_file, kind, device='cpu', num_threads=None):
+    if ort is None:
+      raise ImportError('onnxruntime is not installed')
+    self.onnx_file = onnx_file
+    self.kind = kind
+    self.device = torch.device(device)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads is None:
+      num_threads = torch.get_num_threads()
+    options.intra_op_num_threads = num_threads
+    providers = ['CPUExecutionProvider']
+    if self.device.type=='cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+      providers = ['CUDAExecutionProvider'] + providers
+    self.session = ort.InferenceSession(onnx_file, sess_options=options, providers=providers)
+
+  def to(self, device):
+    self.device = torch.device(device)
+    return self
+
+  def eval(self):
+    return self
+
+  def run(self, **inputs):
+    inputs = {k: v.detach().cpu().numpy() if k=='B_ids' else v.detach().float().cpu().numpy() for k,v in inputs.items()}
+    outputs = self.session.run(None, inputs)
+    return [torch.as_tensor(out, device=self.device) for out in outputs]
+
+  def __call__(self, A, B, L=None, B_ids=None):
+    if B_ids is None:
+      B_ids = torch.arange(len(B), device=B.device)
+    if self.kind=='refine':
+      trans, rot = self.run(A=A, B=B, B_ids=B_ids)
+      return {'trans': trans, 'rot': rot}
+    bs = A.shape[0]//L
+    score_logit, = self.run(A=A.reshape(bs,L,*A.shape[1:]), B=B, B_ids=B_ids.reshape(bs,L))
+    return {'score_logit': score_logit}
+
+
+def record_calibration_inputs(model, batches, max_per_call=16):
+  '''Keep a random subset of the (A,B) inputs of every forward call of model, for quantize_model
+  @batches: list the (A,B) cpu tensors are appended to
+  Return: hook handle, remove it when done
+  '''
+  def hook(module, args):
+    A, B = args[:2]
+    ids = torch.randperm(len(A))[:max_per_call].to(A.device)
+    batches.append((A[ids].float().cpu(), B[ids].float().cpu()))
+  return model.register_forward_pre_hook(hook)
+
+
+def quantize_model(model, kind, calib_batches):
+  '''Static post training quantization of the conv encoders, observed over calib_batches, and dynamic quantization of the Linear layers. The attention in_proj weights are plain parameters and stay fp32. CPU only
+  @calib_batches: list of (A,B) model inputs, see record_calibration_inputs
+  '''
+  model = plain_attention(model).cpu().float().eval()
+  example_inputs = {}
+  def make_hook(name):
+    def hook(module, args):
+      example_inputs.setdefault(name, args)
+    return hook
+  handles = [getattr(model, name).register_forward_pre_hook(make_hook(name)) for name in CONV_STACKS[kind]]
+  A, B = calib_batches[0]
+  with torch.inference_mode():
+    model(A, B, **({} if kind=='refine' else {'L':len(A)}))
+  for handle in handles:
+    handle.remove()
+
+  from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+  qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+  for name in CONV_STACKS[kind]:
+    setattr(model, name, prepare_fx(getattr(model, name), qconfig_mapping, example_inputs[name]))
+  with torch.inference_mode():
+    for A, B in calib_batches:
+      model(A, B, **({} if kind=='refine' else {'L':len(A)}))
+  for name in CONV_STACKS[kind]:
+    setattr(model, name, convert_fx(getattr(model, name)))
+  model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+  return model.eval()
+
+
+def fold_conv_bn(model):
+  '''Fold every eval mode BatchNorm2d into the conv before it and replace the BN by Identity, for use_BN checkpoints. Covers ConvBNReLU and ResnetBasicBlock
+  '''
+  for module in model.modules():
+    if isinstance(module, nn.Sequential):
+      for i in range(len(module)-1):
+        if isinstance(module[i], nn.Conv2d) and isinstance(module[i+1], nn.BatchNorm2d):
+          module[i] = fuse_conv_bn_eval(module[i], module[i+1])
+          module[i+1] = nn.Identity()
+    for conv_name, bn_name in [('conv1','bn1'), ('conv2','bn2')]:
+      if isinstance(getattr(module, conv_name, None), nn.Conv2d) and isinstance(getattr(module, bn_name, None), nn.BatchNorm2d):
+        setattr(module, conv_name, fuse_conv_bn_eval(getattr(module, conv_name), getattr(module, bn_name)))
+        setattr(module, bn_name, nn.Identity())
+  return model
+
+
+def compile_model(model, kind, cfg, cache_file):
+  '''Fold conv+BN, switch to channels_last and freeze a TorchScript trace of the model. Saved to cache_file
+  '''
+  H, W = cfg['input_resize'][1], cfg['input_resize'][0]
+  model = fold_conv_bn(copy.deepcopy(model).float().eval())
+  device = next(model.parameters()).device
+  model = model.to(memory_format=torch.channels_last)
+  B = torch.rand((2,cfg['c_in'],H,W), device=device).contiguous(memory_format=torch.channels_last)
+  if kind=='refine':
+    wrapper = RefineNetExport(model)
+    A = torch.rand((3,cfg['c_in'],H,W), device=device).contiguous(memory_format=torch.channels_last)
+    B_ids = torch.tensor([0,1,1], device=device)
+  else:
+    wrapper = ScoreNetExport(model)
+    A = torch.rand((3,4,cfg['c_in'],H,W), device=device)
+    B_ids = torch.tensor([0,1,1,0], device=device).repeat(3,1)
+  with torch.no_grad():
+    traced = torch.jit.freeze(torch.jit.trace(wrapper.eval(), (A, B, B_ids)))
+  os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+  torch.jit.save(traced, f'{cache_file}.{os.getpid()}.tmp')
+  os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+  logging.info(f'saved compiled {kind} model to {cache_file}')
+  return traced
+
+
+class CompiledModel:
+  '''Runs the frozen TorchScript module behind the same call signature and output dict as the eager model
+  '''
+  def __init__(self, module, kind):
+    self.module = module
+    self.kind = kind
+
+  def to(self, device):
+    self.module.to(device)
+    return self
+
+  def eval(self):
+    return self
+
+  def __call__(self, A, B, L=None, B_ids=None):
+    if B_ids is None:
+      B_ids = torch.arange(len(B), device=B.device)
+    B = B.contiguous(memory_format=torch.channels_last)
+    if self.kind=='refine':
+      trans, rot = self.module(A.contiguous(memory_format=torch.channels_last), B, B_ids)
+      return {'trans': trans, 'rot': rot}
+    bs = A.shape[0]//L
+    score_logit = self.module(A.reshape(bs,L,*A.shape[1:]), B, B_ids.reshape(bs,L))
+    return {'score_logit': score_logit}
+
+
+def make_model_backend(model, kind, cfg, ckpt_dir, backend='torch', device='cpu'):
+  '''Wrap the loaded eager model into the requested inference backend. Exported artifacts are cached next to the checkpoint and redone when the checkpoint is newer
+  @model: eager RefineNet or ScoreNetMultiPair with weights loaded
+  @backend: one of BACKENDS
+  '''
+  if backend=='torch':
+    return model
+  if backend not in BACKENDS:
+    raise RuntimeError(f'Unknown backend {backend}, choose from {BACKENDS}')
+
+  base = os.path.splitext(ckpt_dir)[0]
+  if backend=='onnx':
+    onnx_file = f'{base}_v{EXPORT_VERSION}.onnx'
+    if not os.path.exists(onnx_file) or os.path.getmtime(onnx_file)<os.path.getmtime(ckpt_dir):
+      export_onnx(model, onnx_file, kind=kind, cfg=cfg)
+    return OnnxModel(onnx_file, kind=kind, device=device)
+
+  if backend=='int8':
+    if torch.device(device).type!='cpu':
+      raise RuntimeError('int8 backend runs on cpu only')
+    int8_file = f'{base}_int8.pth'
+    calib_file = f'{base}_calib.pth'
+    if os.path.exists(int8_file) and os.path.getmtime(int8_file)>=os.path.getmtime(ckpt_dir):
+      # Rebuild the quantized structure from a dummy batch, scales and zero points come from the cached state dict
+      H, W = cfg['input_resize'][1], cfg['input_resize'][0]
+      dummy = torch.rand((2,cfg['c_in'],H,W))
+      model = quantize_model(model, kind=kind, calib_batches=[(dummy, dummy.clone())])
+      model.load_state_dict(torch.load(int8_file, map_location='cpu'))
+      return model
+    if not os.path.exists(calib_file):
+      raise RuntimeError(f'No calibration data at {calib_file}, record it with run_benchmark.py --mode calibrate')
+    model = quantize_model(model, kind=kind, calib_batches=torch.load(calib_file))
+    torch.save(model.state_dict(), f'{int8_file}.{os.getpid()}.tmp')
+    os.replace(f'{int8_file}.{os.getpid()}.tmp', int8_file)
+    logging.info(f'saved quantized {kind} model to {int8_file}')
+    return model
+
+  if backend=='compiled':
+    cache_file = f'{base}_compiled_v{EXPORT_VERSION}_{torch.device(device).type}.pt'
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file)>=os.path.getmtime(ckpt_dir):
+      module = torch.jit.load(cache_file, map_location=device)
+    else:
+      module = compile_model(model, kind=kind, cfg=cfg, cache_file=cache_file)
+    return CompiledModel(module, kind=kind)
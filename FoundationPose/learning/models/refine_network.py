@@ -70,17 +70,22 @@ class RefineNet(nn.Module):
     )
 
 
-  def forward(self, A, B):
+  def forward(self, A, B, B_ids=None):
     """
     @A: (B,C,H,W)
+    @B_ids: (B,) when given, B only holds the distinct real image crops and B_ids picks the one of each pair, so every crop is encoded once
     """
-    bs = len(A)
+    bs = A.shape[0]
     output = {}
 
-    x = torch.cat([A,B], dim=0)
-    x = self.encodeA(x)
-    a = x[:bs]
-    b = x[bs:]
+    if B_ids is None:
+      x = torch.cat([A,B], dim=0)
+      x = self.encodeA(x)
+      a = x[:bs]
+      b = x[bs:]
+    else:
+      a = self.encodeA(A)
+      b = self.encodeA(B)[B_ids]
 
     ab = torch.cat((a,b),1).contiguous()
     ab = self.encodeAB(ab)  #(B,C,H,W)
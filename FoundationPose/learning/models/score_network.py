@@ -57,16 +57,21 @@ class ScoreNetMultiPair(nn.Module):
     self.linear = nn.Linear(embed_dim, 1)
 
 
-  def extract_feat(self, A, B):
+  def extract_feat(self, A, B, B_ids=None):
     """
     @A: (B*L,C,H,W) L is num of pairs
+    @B_ids: (B*L,) when given, B only holds the distinct real image crops and B_ids picks the one of each pair, so every crop is encoded once
     """
     bs = A.shape[0]  # B*L
 
-    x = torch.cat([A,B], dim=0)
-    x = self.encoderA(x)
-    a = x[:bs]
-    b = x[bs:]
+    if B_ids is None:
+      x = torch.cat([A,B], dim=0)
+      x = self.encoderA(x)
+      a = x[:bs]
+      b = x[bs:]
+    else:
+      a = self.encoderA(A)
+      b = self.encoderA(B)[B_ids]
     ab = torch.cat((a,b), dim=1)
     ab = self.encoderAB(ab)
     ab = self.pos_embed(ab.reshape(bs, ab.shape[1], -1).permute(0,2,1))
@@ -74,17 +79,24 @@ class ScoreNetMultiPair(nn.Module):
     return ab.mean(dim=1).reshape(bs,-1)
 
 
-  def forward(self, A, B, L):
+  def forward(self, A, B, L, B_ids=None):
     """
     @A: (B*L,C,H,W) L is num of pairs
     @L: num of pairs
+    @B_ids: see extract_feat
     """
     output = {}
-    bs = A.shape[0]//L
-    feats = self.extract_feat(A, B)   #(B*L, C)
-    x = feats.reshape(bs,L,-1)
-    x, _ = self.att_cross(x, x, x)
-
-    output['score_logit'] = self.linear(x).reshape(bs,L)  # (B,L)
+    feats = self.extract_feat(A, B, B_ids=B_ids)   #(B*L, C)
+    output['score_logit'] = self.score_feats(feats, L)  # (B,L)
 
     return output
+
+
+  def score_feats(self, feats, L):
+    """Cross attention between the pooled features of the L pairs of each group
+    @feats: (B*L,C) from extract_feat, can be computed in chunks
+    """
+    bs = feats.shape[0]//L
+    x = feats.reshape(bs,L,-1)
+    x, _ = self.att_cross(x, x, x)
+    return self.linear(x).reshape(bs,L)
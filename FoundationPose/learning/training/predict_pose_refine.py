@@ -16,6 +16,7 @@ import numpy as np
 import torch
 from omegaconf import OmegaConf
 from learning.models.refine_network import RefineNet
+from learning.models.model_backend import make_model_backend
 from learning.datasets.h5_dataset import *
 from Utils import *
 from datareader import *
@@ -23,17 +24,29 @@ from datareader import *
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
-  logging.info("Welcome make_crop_data_batch")
-  H,W = depth.shape[:2]
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, frame_ids=None, device='cuda', workspace:CropWorkspace=None, templates:TemplateBank=None, template_ids=None):
+  '''
+  @frame_ids: (B,) np array, when given rgb/depth/xyz_map/normal_map are stacked frames (N_frame,H,W,...) and each pose is cropped from frame_ids[i]
+  @workspace: when given the crops are written into its buffers and stay valid until the next call, pose_data.inputAs/inputBs are the stacked network inputs
+  @templates: TemplateBank whose crops replace the renders, template_ids[i] is the bank index of ob_in_cams[i]
+  '''
+  H,W = depth.shape[-2:]
+  if frame_ids is None:
+    rgb = rgb[None]
+    xyz_map = xyz_map[None]
+    if normal_map is not None:
+      normal_map = normal_map[None]
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-
-  logging.info("make tf_to_crops done")
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poseA, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
 
   B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+  if cfg['use_normal'] or tuple(cfg['input_resize'])!=tuple(render_size):
+    workspace = None
+  if workspace is not None:
+    inputAs = workspace.get('inputA', (B,6,render_size[0],render_size[1]), device=device)
+    inputBs = workspace.get('inputB', (B,6,render_size[0],render_size[1]), device=device)
 
   bs = 512
   rgb_rs = []
@@ -41,59 +54,108 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   normal_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
 
+  lod_size = min(cfg['input_resize'])/crop_ratio   # Crop windows span crop_ratio*diameter
   for b in range(0,len(poseA),bs):
     extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    with tracer.span('render', n_pose=len(poseA[b:b+bs])):
+      if templates is not None:
+        rgb_r, depth_r, extra['xyz_map'] = templates.crops(template_ids[b:b+bs], poseA[b:b+bs], K, tf_to_crops[b:b+bs])
+        normal_r = None
+      else:
+        rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra, lod_size=lod_size)
+    if workspace is not None:
+      inputAs[b:b+bs,:3] = rgb_r.permute(0,3,1,2)
+      inputAs[b:b+bs,3:] = extra['xyz_map'].permute(0,3,1,2)
+      continue
     rgb_rs.append(rgb_r)
     depth_rs.append(depth_r[...,None])
     normal_rs.append(normal_r)
     xyz_map_rs.append(extra['xyz_map'])
+
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3)
+  if workspace is not None:
+    rgbAs = inputAs[:,:3].mul_(255)
+    xyz_mapAs = inputAs[:,3:]
+    with tracer.span('warp', n_pose=B):
+      sample_crops_frames([torch.as_tensor(rgb, dtype=torch.float, device=device), torch.as_tensor(xyz_map, dtype=torch.float, device=device)], tf_to_crops, dsize=render_size, modes=('bilinear','nearest'), frame_ids=frame_ids, out=inputBs)
+      rgbBs = inputBs[:,:3]
+      xyz_mapBs = inputBs[:,3:]
+      mesh_diameters = torch.full((B,), mesh_diameter, dtype=torch.float, device=device)
+      pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, poseA=poseA, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+      pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, inplace=True)
+    pose_data.inputAs = inputAs
+    pose_data.inputBs = inputBs
+    return pose_data
+
   rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
   depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
   xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
   if cfg['use_normal']:
     normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
 
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
+  with tracer.span('warp', n_pose=B):
+    imgBs = [torch.as_tensor(rgb, dtype=torch.float, device=device), torch.as_tensor(xyz_map, dtype=torch.float, device=device)]
+    if cfg['use_normal']:
+      imgBs.append(torch.as_tensor(normal_map, dtype=torch.float, device=device))
+    cropBs = sample_crops_frames(imgBs, tf_to_crops, dsize=render_size, modes=('bilinear','nearest','nearest'), frame_ids=frame_ids)
+    rgbBs = cropBs[:,:3]
+    xyz_mapBs = cropBs[:,3:6]
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
+
+    if cfg['use_normal']:
+      normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+      normalBs = cropBs[:,6:]
+    else:
+      normalAs = None
+      normalBs = None
+
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
 
-  if cfg['use_normal']:
-    normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    normalAs = None
-    normalBs = None
-
-  logging.info("warp done")
+  return pose_data
 
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
 
-  logging.info("pose batch data done")
 
-  return pose_data
+def vis_refine_crops(crops_init, crops_refined, padding=2):
+  '''Debug canvas of the refiner, rendered and real crops with their depth, at the first iteration on the left and at the refined poses on the right
+  @crops_init: capture_vis_crops of the first iteration
+  @crops_refined: capture_vis_crops of the refined poses
+  '''
+  canvases = []
+  for crops in [crops_init, crops_refined]:
+    crops = {k: v.data.cpu().numpy() for k,v in crops.items()}
+    canvas = []
+    for id in range(len(crops['rgbA'])):
+      depthA = crops['zA'][id].astype(np.float32)
+      depthB = crops['zB'][id].astype(np.float32)
+      zmin = min(depthA.min(), depthB.min())
+      zmax = max(depthA.max(), depthB.max())
+      row = [crops['rgbA'][id], crops['rgbB'][id], depth_to_vis(depthA, zmin=zmin, zmax=zmax, inverse=False), depth_to_vis(depthB, zmin=zmin, zmax=zmax, inverse=False)]
+      row = make_grid_image(row, nrow=len(row), padding=padding, pad_value=255)
+      if crops is crops_init:
+        row = cv_draw_text(row, text=f'id:{id}', uv_top_left=(10,10), color=(0,255,0), fontScale=0.5)
+      canvas.append(row)
+    canvases.append(make_grid_image(canvas, nrow=1, padding=padding, pad_value=255))
+  return make_grid_image(canvases, nrow=2, padding=padding, pad_value=255)
 
 
 
 class PoseRefinePredictor:
-  def __init__(self,):
+  def __init__(self, device='cuda', backend='torch'):
     logging.info("welcome")
-    self.amp = True
+    self.device = torch.device(device)
+    self.amp = self.device.type=='cuda'
     self.run_name = "2023-10-28-18-33-37"
     model_name = 'model_best.pth'
     code_dir = os.path.dirname(os.path.realpath(__file__))
@@ -131,67 +193,86 @@ class PoseRefinePredictor:
       self.cfg['normal_uint8'] = False
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
-    self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test', device=self.device)
+    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
+    self.backend = backend
+    self.model = make_model_backend(self.model, kind='refine', cfg=self.cfg, ckpt_dir=ckpt_dir, backend=backend, device=self.device)
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
+    self.share_crops = True   # Encode identical real image crops once, see unique_crop_ids
+    self.workspace = CropWorkspace()   # Crop buffers reused across iterations and frames
 
 
+  @trace_span('refine')
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, frame_ids=None, templates:TemplateBank=None, template_ids=None):
     '''
-    @rgb: np array (H,W,3)
+    @rgb: np array (H,W,3), or (N_frame,H,W,3) when frame_ids is given
     @ob_in_cams: np array (N,4,4)
+    @frame_ids: (N,) np array, frame each pose belongs to, see make_crop_data_batch
+    @templates: TemplateBank used for the first iteration instead of rendering, if it covers all ob_in_cams
+    @template_ids: (N,) np array, bank index of each pose
+    Return: refined poses, and with get_vis a function building the debug canvas from the crops of the first iteration and of the refined poses
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
-    logging.info(f'ob_in_cams:{ob_in_cams.shape}')
     tf_to_center = np.eye(4)
     ob_centered_in_cams = ob_in_cams
     mesh_centered = mesh
 
-    logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
       normal_map = None
 
     crop_ratio = self.cfg['crop_ratio']
-    logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
     bs = 1024
 
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float)
 
 
     if mesh_tensors is None:
       mesh_tensors = make_mesh_tensors(mesh_centered)
 
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
     trans_normalizer = self.cfg['trans_normalizer']
     if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
+      trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
+
+    if templates is not None and (self.cfg['use_normal'] or not templates.covers(B_in_cams)):
+      logging.info("hypotheses not covered by the template bank, rendering")
+      templates = None
 
-    for _ in range(iteration):
-      logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+    vis_crops = []
+    for i in range(iteration):
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, workspace=self.workspace, templates=templates if i==0 else None, template_ids=template_ids)
+      if get_vis and i==0:
+        vis_crops.append(capture_vis_crops(pose_data))
       B_in_cams = []
       for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
+        if pose_data.inputAs is not None:
+          A = pose_data.inputAs[b:b+bs]
+          B = pose_data.inputBs[b:b+bs]
+        else:
+          A = torch.cat([pose_data.rgbAs[b:b+bs].to(self.device), pose_data.xyz_mapAs[b:b+bs].to(self.device)], dim=1).float()
+          B = torch.cat([pose_data.rgbBs[b:b+bs].to(self.device), pose_data.xyz_mapBs[b:b+bs].to(self.device)], dim=1).float()
+        B_ids = None
+        if self.share_crops:
+          crop_ids, inverse = unique_crop_ids(pose_data.poseA[b:b+bs], frame_ids=None if frame_ids is None else frame_ids[b:b+bs])
+          if len(crop_ids)<len(B):   # E.g. first iteration of register, all hypotheses share one center
+            B = B[crop_ids]
+            B_ids = inverse
+        with tracer.span('forward', n_pose=len(A)), torch.autocast(device_type=self.device.type, enabled=self.amp):
+          output = self.model(A, B, B_ids=B_ids)
         for k in output:
           output[k] = output[k].float()
-        logging.info("forward done")
         if self.cfg['trans_rep']=='tracknet':
           if not self.cfg['normalize_xyz']:
             trans_delta = torch.tanh(output["trans"])*trans_normalizer
@@ -209,9 +290,9 @@ class PoseRefinePredictor:
           z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
           uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
           uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().to(self.device))
+          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+          center_pred = (pose_data.Ks[b:b+bs].inverse().to(self.device)@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
           trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
 
         else:
@@ -233,64 +314,17 @@ class PoseRefinePredictor:
 
       B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
 
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
+    if get_vis:   # The last iteration cropped the poses before its update, render the refined ones
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, workspace=self.workspace)
+      vis_crops.append(capture_vis_crops(pose_data))
+
+    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device=self.device, dtype=torch.float)
+    empty_cache(self.device)
     self.last_trans_update = trans_delta
     self.last_rot_update = rot_mat_delta
 
     if get_vis:
-      logging.info("get_vis...")
-      canvas = []
-      padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      for id in range(0, len(B_in_cams)):
-        rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
-        rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
-        row = [rgbA_vis, rgbB_vis]
-        H,W = rgbA_vis.shape[:2]
-        if pose_data.depthAs is not None:
-          depthA = pose_data.depthAs[id].data.cpu().numpy().reshape(H,W)
-          depthB = pose_data.depthBs[id].data.cpu().numpy().reshape(H,W)
-        elif pose_data.xyz_mapAs is not None:
-          depthA = pose_data.xyz_mapAs[id][2].data.cpu().numpy().reshape(H,W)
-          depthB = pose_data.xyz_mapBs[id][2].data.cpu().numpy().reshape(H,W)
-        zmin = min(depthA.min(), depthB.min())
-        zmax = max(depthA.max(), depthB.max())
-        depthA_vis = depth_to_vis(depthA, zmin=zmin, zmax=zmax, inverse=False)
-        depthB_vis = depth_to_vis(depthB, zmin=zmin, zmax=zmax, inverse=False)
-        row += [depthA_vis, depthB_vis]
-        if pose_data.normalAs is not None:
-          pass
-        row = make_grid_image(row, nrow=len(row), padding=padding, pad_value=255)
-        row = cv_draw_text(row, text=f'id:{id}', uv_top_left=(10,10), color=(0,255,0), fontScale=0.5)
-        canvas.append(row)
-      canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
-
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      canvas_refined = []
-      for id in range(0, len(B_in_cams)):
-        rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
-        rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
-        row = [rgbA_vis, rgbB_vis]
-        H,W = rgbA_vis.shape[:2]
-        if pose_data.depthAs is not None:
-          depthA = pose_data.depthAs[id].data.cpu().numpy().reshape(H,W)
-          depthB = pose_data.depthBs[id].data.cpu().numpy().reshape(H,W)
-        elif pose_data.xyz_mapAs is not None:
-          depthA = pose_data.xyz_mapAs[id][2].data.cpu().numpy().reshape(H,W)
-          depthB = pose_data.xyz_mapBs[id][2].data.cpu().numpy().reshape(H,W)
-        zmin = min(depthA.min(), depthB.min())
-        zmax = max(depthA.max(), depthB.max())
-        depthA_vis = depth_to_vis(depthA, zmin=zmin, zmax=zmax, inverse=False)
-        depthB_vis = depth_to_vis(depthB, zmin=zmin, zmax=zmax, inverse=False)
-        row += [depthA_vis, depthB_vis]
-        row = make_grid_image(row, nrow=len(row), padding=padding, pad_value=255)
-        canvas_refined.append(row)
-
-      canvas_refined = make_grid_image(canvas_refined, nrow=1, padding=padding, pad_value=255)
-      canvas = make_grid_image([canvas, canvas_refined], nrow=2, padding=padding, pad_value=255)
-      torch.cuda.empty_cache()
-      return B_in_cams_out, canvas
+      return B_in_cams_out, functools.partial(vis_refine_crops, vis_crops[0], vis_crops[-1])
 
     return B_in_cams_out, None
 
@@ -19,34 +19,37 @@ code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(f'{code_dir}/../../../')
 from learning.datasets.h5_dataset import *
 from learning.models.score_network import *
+from learning.models.model_backend import make_model_backend
 from learning.datasets.pose_dataset import *
 from Utils import *
 from datareader import *
 
 
-def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
+def vis_batch_data_scores(crops, ids, scores, pad_margin=5):
+  '''
+  @crops: capture_vis_crops of the scored batch
+  @ids: rows to draw, in order
+  '''
   assert len(scores)==len(ids)
+  crops = {k: v.data.cpu().numpy() for k,v in crops.items()}
+  ids = to_debug_array(ids)
+  scores = to_debug_array(scores)
   canvas = []
   for id in ids:
-    rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
-    rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
-    H,W = rgbA_vis.shape[:2]
-    zmin = pose_data.depthAs[id].data.cpu().numpy().reshape(H,W).min()
-    zmax = pose_data.depthAs[id].data.cpu().numpy().reshape(H,W).max()
-    depthA_vis = depth_to_vis(pose_data.depthAs[id].data.cpu().numpy().reshape(H,W), zmin=zmin, zmax=zmax, inverse=False)
-    depthB_vis = depth_to_vis(pose_data.depthBs[id].data.cpu().numpy().reshape(H,W), zmin=zmin, zmax=zmax, inverse=False)
-    if pose_data.normalAs is not None:
-      pass
-    pad = np.ones((rgbA_vis.shape[0],pad_margin,3))*255
-    if pose_data.normalAs is not None:
-      pass
-    else:
-      row = np.concatenate([rgbA_vis, pad, depthA_vis, pad, rgbB_vis, pad, depthB_vis], axis=1)
+    rgbA_vis = crops['rgbA'][id]
+    rgbB_vis = crops['rgbB'][id]
+    zA = crops['zA'][id].astype(np.float32)
+    zmin = zA.min()
+    zmax = zA.max()
+    depthA_vis = depth_to_vis(zA, zmin=zmin, zmax=zmax, inverse=False)
+    depthB_vis = depth_to_vis(crops['zB'][id].astype(np.float32), zmin=zmin, zmax=zmax, inverse=False)
+    pad = np.full((rgbA_vis.shape[0],pad_margin,3), 255, dtype=np.uint8)
+    row = np.concatenate([rgbA_vis, pad, depthA_vis, pad, rgbB_vis, pad, depthB_vis], axis=1)
     s = 100/row.shape[0]
     row = cv2.resize(row, fx=s, fy=s, dsize=None)
     row = cv_draw_text(row, text=f'id:{id}, score:{scores[id]:.3f}', uv_top_left=(10,10), color=(0,255,0), fontScale=0.5)
     canvas.append(row)
-    pad = np.ones((pad_margin, row.shape[1], 3))*255
+    pad = np.full((pad_margin, row.shape[1], 3), 255, dtype=np.uint8)
     canvas.append(pad)
   canvas = np.concatenate(canvas, axis=0).astype(np.uint8)
   return canvas
@@ -54,69 +57,101 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
-  logging.info("Welcome make_crop_data_batch")
-  H,W = depth.shape[:2]
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, frame_ids=None, device='cuda', workspace:CropWorkspace=None):
+  '''
+  @frame_ids: (B,) np array, when given rgb/depth are stacked frames (N_frame,H,W,...) and each pose is cropped from frame_ids[i]
+  @workspace: when given the crops are written into its buffers and stay valid until the next call, pose_data.inputAs/inputBs are the stacked network inputs
+  '''
+  H,W = depth.shape[-2:]
+  if frame_ids is None:
+    rgb = rgb[None]
+    depth = depth[None]
 
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-  logging.info("make tf_to_crops done")
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poseAs, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
 
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+  if cfg['use_normal'] or tuple(cfg['input_resize'])!=tuple(render_size):
+    workspace = None
+  if workspace is not None:
+    inputAs = workspace.get('inputA', (B,6,render_size[0],render_size[1]), device=device)
+    inputBs = workspace.get('inputB', (B,6,render_size[0],render_size[1]), device=device)
 
   bs = 512
   rgb_rs = []
   depth_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
 
+  lod_size = min(cfg['input_resize'])/crop_ratio   # Crop windows span crop_ratio*diameter
   for b in range(0,len(ob_in_cams),bs):
     extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    with tracer.span('render', n_pose=len(poseAs[b:b+bs])):
+      rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra, lod_size=lod_size)
+    if workspace is not None:
+      inputAs[b:b+bs,:3] = rgb_r.permute(0,3,1,2)
+      inputAs[b:b+bs,3:] = extra['xyz_map'].permute(0,3,1,2)
+      continue
     rgb_rs.append(rgb_r)
     depth_rs.append(depth_r[...,None])
     xyz_map_rs.append(extra['xyz_map'])
 
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-    depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-    depthAs = depth_rs
-
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
+  if workspace is not None:
+    rgbAs = inputAs[:,:3].mul_(255)
+    rgbBs = inputBs[:,:3]
+    depthBs = workspace.get('depthB', (B,1,render_size[0],render_size[1]), device=device)
+    with tracer.span('warp', n_pose=B):
+      sample_crops_frames([torch.as_tensor(rgb, dtype=torch.float, device=device), torch.as_tensor(depth, dtype=torch.float, device=device)[...,None]], tf_to_crops, dsize=render_size, modes=('bilinear','nearest'), frame_ids=frame_ids, out=[rgbBs, depthBs])
+      Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(B,3,3)
+      mesh_diameters = torch.full((B,), mesh_diameter, dtype=torch.float, device=device)
+      pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthBs=depthBs, poseA=poseAs, xyz_mapAs=inputAs[:,3:], tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+      pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, inplace=True)
+      inputBs[:,3:] = pose_data.xyz_mapBs   # Back-projected from depthBs, not a view yet
+    pose_data.xyz_mapBs = inputBs[:,3:]
+    pose_data.inputAs = inputAs
+    pose_data.inputBs = inputBs
+    return pose_data
+
+  with tracer.span('warp', n_pose=B):
+    rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
+    depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
+    xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+
+    cropBs = sample_crops_frames([torch.as_tensor(rgb, dtype=torch.float, device=device), torch.as_tensor(depth, dtype=torch.float, device=device)[...,None]], tf_to_crops, dsize=render_size, modes=('bilinear','nearest'), frame_ids=frame_ids)
+    rgbBs = cropBs[:,:3]
+    depthBs = cropBs[:,3:]
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+      depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+      depthAs = depth_rs
 
-  normalAs = None
-  normalBs = None
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+    normalAs = None
+    normalBs = None
 
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
+    Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(len(rgbAs),3,3)
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
 
-  logging.info("pose batch data done")
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
 
   return pose_data
 
 
 class ScorePredictor:
-  def __init__(self, amp=True):
-    self.amp = amp
+  def __init__(self, amp=True, device='cuda', backend='torch', max_memory_mb=None):
+    self.device = torch.device(device)
+    self.amp = amp and self.device.type=='cuda'
     self.run_name = "2024-01-11-20-02-45"
 
     model_name = 'model_best.pth'
@@ -144,84 +179,190 @@ class ScorePredictor:
 
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
-    self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1, device=self.device)
+    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
+    self.share_crops = True   # Encode identical real image crops once, see unique_crop_ids
+    self.max_memory_mb = max_memory_mb   # Memory ceiling of the crops and encoder, None scores all hypotheses in one shot
+    self.workspace = CropWorkspace()   # Crop buffers reused across frames
+    self.bytes_per_hypo = None   # Measured on first use, see get_bytes_per_hypo
+    self.backend = backend
+    self.model = make_model_backend(self.model, kind='score', cfg=self.cfg, ckpt_dir=ckpt_dir, backend=backend, device=self.device)
+    if self.max_memory_mb is not None and not hasattr(self.model, 'score_feats'):
+      logging.warning(f'chunked scoring is not supported by the {backend} backend, max_memory_mb is ignored')
     logging.info("init done")
 
 
+  def make_network_input(self, pose_data:BatchPoseData, frame_ids=None):
+    '''Stack the crops into the network input, identical real image crops are kept once (see unique_crop_ids)
+    Return: A, B, B_ids
+    '''
+    if pose_data.inputAs is not None:
+      A = pose_data.inputAs
+      B = pose_data.inputBs
+    else:
+      A = torch.cat([pose_data.rgbAs.to(self.device), pose_data.xyz_mapAs.to(self.device)], dim=1).float()
+      B = torch.cat([pose_data.rgbBs.to(self.device), pose_data.xyz_mapBs.to(self.device)], dim=1).float()
+    if pose_data.normalAs is not None:
+      A = torch.cat([A, pose_data.normalAs.to(self.device).float()], dim=1)
+      B = torch.cat([B, pose_data.normalBs.to(self.device).float()], dim=1)
+    B_ids = None
+    if self.share_crops:
+      crop_ids, inverse = unique_crop_ids(pose_data.poseA, frame_ids=frame_ids)
+      if len(crop_ids)<len(B):
+        B = B[crop_ids]
+        B_ids = inverse
+    return A, B, B_ids
+
+
+  def get_bytes_per_hypo(self):
+    '''Memory one hypothesis takes in the chunked path, measured once with a probe batch through the encoder and cached. The crops of both sides (network inputs plus the rgb, xyz and depth maps) are sized from cfg, the encoder activations are the allocator peak on cuda and elsewhere the largest output plus the inputs still held by the modules around it
+    '''
+    if self.bytes_per_hypo is not None:
+      return self.bytes_per_hypo
+    W, H = self.cfg['input_resize']
+    n_probe = 4
+    A = torch.zeros((n_probe,self.cfg['c_in'],H,W), device=self.device)
+    B = torch.zeros_like(A)
+    if self.device.type=='cuda':
+      torch.cuda.synchronize(self.device)
+      base = torch.cuda.memory_allocated(self.device)
+      torch.cuda.reset_peak_memory_stats(self.device)
+      with torch.inference_mode(), torch.autocast(device_type='cuda', enabled=self.amp):
+        self.model.extract_feat(A, B)
+      torch.cuda.synchronize(self.device)
+      activation_bytes = torch.cuda.max_memory_allocated(self.device)-base
+    else:
+      peak = [0]
+      inputs = []
+      def pre_hook(module, args):
+        inputs.append([x for x in args if torch.is_tensor(x)])
+      def hook(module, args, output):
+        live = {x.data_ptr(): x.nbytes for xs in inputs for x in xs}   # Inputs of the enclosing modules are still referenced, e.g. residuals
+        outputs = output if isinstance(output, tuple) else (output,)
+        peak[0] = max(peak[0], sum(live.values())+sum(x.nbytes for x in outputs if torch.is_tensor(x)))
+        inputs.pop()
+      handles = []
+      for m in self.model.modules():
+        handles += [m.register_forward_pre_hook(pre_hook), m.register_forward_hook(hook)]
+      try:
+        with torch.inference_mode():
+          self.model.extract_feat(A, B)
+      finally:
+        for handle in handles:
+          handle.remove()
+      activation_bytes = peak[0]
+    crop_bytes = 4*H*W*(2*self.cfg['c_in'] + 14)
+    self.bytes_per_hypo = crop_bytes + int(np.ceil(activation_bytes/n_probe))
+    logging.info(f'scorer needs {self.bytes_per_hypo/1024**2:.2f} MB per hypothesis')
+    return self.bytes_per_hypo
+
+
+  def get_chunk_size(self):
+    '''Hypotheses that fit under self.max_memory_mb, see get_bytes_per_hypo
+    '''
+    if self.max_memory_mb is None or not hasattr(self.model, 'score_feats'):
+      return np.inf
+    return max(1, int(self.max_memory_mb*1024**2//self.get_bytes_per_hypo()))
+
+
+  def predict_chunked(self, rgb, depth, K, ob_in_cams, mesh, mesh_tensors, glctx, mesh_diameter, frame_ids, n_group, chunk_size, get_vis=False):
+    '''Stream the hypotheses through the encoder chunk by chunk, keeping only the pooled features, then run the cross attention on all features at once. Same scores as the one shot forward
+    @get_vis: also keep the capture_vis_crops of every chunk, on cpu so they do not count against the memory ceiling
+    Return: scores, and the vis crops of all hypotheses or None
+    '''
+    if not hasattr(self.model, 'score_feats'):
+      raise RuntimeError(f'chunked scoring is not supported by the {self.backend} backend')
+    feats = []
+    vis_crops = []
+    for b in range(0, len(ob_in_cams), chunk_size):
+      frame_ids_chunk = None if frame_ids is None else np.asarray(frame_ids)[b:b+chunk_size]
+      pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams[b:b+chunk_size], mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, frame_ids=frame_ids_chunk, device=self.device, workspace=self.workspace)
+      A, B, B_ids = self.make_network_input(pose_data, frame_ids=frame_ids_chunk)
+      if get_vis:
+        vis_crops.append({k: v.cpu() for k,v in capture_vis_crops(pose_data).items()})
+      del pose_data
+      with tracer.span('forward', n_pose=len(A)), torch.autocast(device_type=self.device.type, enabled=self.amp):
+        feats.append(self.model.extract_feat(A, B, B_ids=B_ids).float())
+      del A, B
+    feats = torch.cat(feats, dim=0)
+    with tracer.span('forward', n_pose=len(feats)), torch.autocast(device_type=self.device.type, enabled=self.amp):
+      scores = self.model.score_feats(feats, L=len(ob_in_cams)//n_group).float()
+    if get_vis:
+      vis_crops = {k: torch.cat([crops[k] for crops in vis_crops], dim=0) for k in vis_crops[0]}
+    return scores.reshape(-1) + 100, vis_crops if get_vis else None
+
+
+  @trace_span('score')
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, frame_ids=None):
     '''
-    @rgb: np array (H,W,3)
+    @rgb: np array (H,W,3), or (N_frame,H,W,3) when frame_ids is given
+    @frame_ids: (N,) np array, frame each pose belongs to. Poses of a frame must be contiguous and every frame must have the same number of poses; each frame gets its own score tournament
+    Return: scores, and with get_vis a function building the debug canvas of the crops sorted by score
     '''
-    logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
 
-    logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
       normal_map = None
 
-    logging.info("making cropped data")
-
     if mesh_tensors is None:
       mesh_tensors = make_mesh_tensors(mesh)
 
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+
+    if frame_ids is None:
+      n_group = 1
+    else:
+      n_group = len(np.unique(frame_ids))
+      assert len(ob_in_cams)%n_group==0 and (np.asarray(frame_ids).reshape(n_group,-1)==np.asarray(frame_ids).reshape(n_group,-1)[:,:1]).all(), 'frame_ids must be contiguous with equal poses per frame'
+
+    chunk_size = self.get_chunk_size()
+    if chunk_size<len(ob_in_cams):
+      scores, vis_crops = self.predict_chunked(rgb, depth, K, ob_in_cams, mesh=mesh, mesh_tensors=mesh_tensors, glctx=glctx, mesh_diameter=mesh_diameter, frame_ids=frame_ids, n_group=n_group, chunk_size=chunk_size, get_vis=get_vis)
+      empty_cache(self.device)
+      if get_vis:
+        return scores, functools.partial(vis_batch_data_scores, vis_crops, ids=scores.argsort(descending=True), scores=scores)
+      return scores, None
 
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
+    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, workspace=self.workspace)
 
     def find_best_among_pairs(pose_data:BatchPoseData):
-      logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
-      ids = []
-      scores = []
-      bs = pose_data.rgbAs.shape[0]
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A, B, L=len(A))
-        scores_cur = output["score_logit"].float().reshape(-1)
-        ids.append(scores_cur.argmax()+b)
-        scores.append(scores_cur)
-      ids = torch.stack(ids, dim=0).reshape(-1)
-      scores = torch.cat(scores, dim=0).reshape(-1)
-      return ids, scores
+      '''Each group of L consecutive poses is one tournament, all groups are scored in one forward pass
+      '''
+      L = pose_data.rgbAs.shape[0]//n_group
+      A, B, B_ids = self.make_network_input(pose_data, frame_ids=None if frame_ids is None else torch.as_tensor(frame_ids, device=self.device)[global_ids])
+      with tracer.span('forward', n_pose=len(A)), torch.autocast(device_type=self.device.type, enabled=self.amp):
+        output = self.model(A, B, L=L, B_ids=B_ids)
+      scores = output["score_logit"].float().reshape(n_group, L)
+      ids = scores.argmax(dim=1) + torch.arange(0, n_group*L, L, device=scores.device)
+      return ids, scores.reshape(-1)
 
     pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
+    global_ids = torch.arange(len(ob_in_cams), device=self.device, dtype=torch.long)
+    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device=self.device)
 
     while 1:
       ids, scores = find_best_among_pairs(pose_data_iter)
-      if len(ids)==1:
+      if len(ids)==n_group:
         scores_global[global_ids] = scores + 100
         break
       global_ids = global_ids[ids]
       pose_data_iter = pose_data.select_by_indices(global_ids)
 
     scores = scores_global
-
-    logging.info(f'forward done')
-    torch.cuda.empty_cache()
+    empty_cache(self.device)
 
     if get_vis:
-      logging.info("get_vis...")
-      canvas = []
-      ids = scores.argsort(descending=True)
-      canvas = vis_batch_data_scores(pose_data, ids=ids, scores=scores)
-      return scores, canvas
+      return scores, functools.partial(vis_batch_data_scores, capture_vis_crops(pose_data), ids=scores.argsort(descending=True), scores=scores)
 
     return scores, None
 
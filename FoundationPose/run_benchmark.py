@@ -0,0 +1,567 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+from estimater import *
+from datareader import *
+from learning.models.model_backend import make_model_backend, record_calibration_inputs, BACKENDS
+import argparse
+import warnings
+
+
+def sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_stage(timings, name, device, fn, *args, **kwargs):
+    sync(device)
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    sync(device)
+    timings[name].append(time.perf_counter() - start)
+    return out
+
+
+def benchmark_register_track(est, reader, device, est_refine_iter=5, track_refine_iter=2, n_repeat=3):
+    """Time every stage of register and track_one on the first two frames of the scene"""
+    timings = defaultdict(list)
+    K = reader.K
+    color = reader.get_color(0)
+    depth = reader.get_depth(0)
+    mask = reader.get_mask(0).astype(bool)
+    for _ in range(n_repeat):
+        depth_f = time_stage(timings, "erode_depth", device, erode_depth, depth, radius=2, device=device)
+        depth_f = time_stage(timings, "bilateral_filter_depth", device, bilateral_filter_depth, depth_f, radius=2, device=device)
+        xyz_map = time_stage(timings, "depth2xyzmap", device, depth2xyzmap, depth_f, K)
+        poses = time_stage(timings, "hypothesis_generation", device, est.generate_random_pose_hypo, K=K, rgb=color, depth=depth_f, mask=mask)
+        poses, _ = time_stage(timings, "refine", device, est.refiner.predict, mesh=est.mesh, mesh_tensors=est.mesh_tensors, rgb=color, depth=depth_f, K=K, ob_in_cams=poses.data.cpu().numpy(), xyz_map=xyz_map, glctx=est.glctx, mesh_diameter=est.diameter, iteration=est_refine_iter)
+        time_stage(timings, "score", device, est.scorer.predict, mesh=est.mesh, rgb=color, depth=depth_f, K=K, ob_in_cams=poses.data.cpu().numpy(), mesh_tensors=est.mesh_tensors, glctx=est.glctx, mesh_diameter=est.diameter)
+        time_stage(timings, "register_total", device, est.register, K=K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
+        if len(reader.color_files) > 1:
+            time_stage(timings, "track_one", device, est.track_one, rgb=reader.get_color(1), depth=reader.get_depth(1), K=K, iteration=track_refine_iter)
+    return timings
+
+
+def benchmark_depth_filters(device, n_repeat=10):
+    """Compare the warp kernels with the torch fallback of erode_depth/bilateral_filter_depth"""
+    rng = np.random.default_rng(0)
+    for H, W in [(480, 640), (720, 1280), (1080, 1920)]:
+        depth = (1 + 0.003 * rng.standard_normal((H, W))).astype(np.float32)
+        depth[rng.random((H, W)) < 0.1] = 0
+        depth_t = torch.as_tensor(depth, device=device)
+        impls = [("torch", erode_depth_torch, bilateral_filter_depth_torch)]
+        if wp is not None:
+            impls.append(("warp", erode_depth_warp, bilateral_filter_depth_warp))
+        outs = {}
+        for impl, erode, bilateral in impls:
+            timings = defaultdict(list)
+            for _ in range(n_repeat):
+                eroded = time_stage(timings, "erode", device, erode, depth_t, radius=2, device=device)
+                outs[impl] = time_stage(timings, "bilateral", device, bilateral, eroded, radius=2, device=device)
+            print(f"{H}x{W} {impl:<6s} erode {np.mean(timings['erode'])*1000:8.2f} ms   bilateral {np.mean(timings['bilateral'])*1000:8.2f} ms")
+        if len(outs) == 2:
+            print(f"{H}x{W} max abs diff torch vs warp: {(outs['torch']-outs['warp']).abs().max().item():.3e}")
+
+
+def benchmark_depth_roi(device, n_repeat=10, roi_size=200):
+    """Compare full frame depth preprocessing with filter_depth_roi on a fixed size object roi"""
+    rng = np.random.default_rng(0)
+    for H, W in [(480, 640), (720, 1280), (1080, 1920)]:
+        depth = (1 + 0.003 * rng.standard_normal((H, W))).astype(np.float32)
+        depth[rng.random((H, W)) < 0.1] = 0
+        depth_t = torch.as_tensor(depth, device=device)
+        K = np.array([[W, 0, W / 2], [0, W, H / 2], [0, 0, 1]], dtype=float)
+        K_t = torch.as_tensor(K, dtype=torch.float, device=device)[None]
+        roi = (W // 2 - roi_size // 2, H // 2 - roi_size // 2, W // 2 + roi_size // 2 - 1, H // 2 + roi_size // 2 - 1)
+        timings = defaultdict(list)
+        for _ in range(n_repeat):
+            sync(device)
+            start = time.perf_counter()
+            full = bilateral_filter_depth(erode_depth(depth_t, radius=2, device=device), radius=2, device=device)
+            depth2xyzmap_batch(full[None], K_t, zfar=np.inf)
+            sync(device)
+            timings["full"].append(time.perf_counter() - start)
+            depth_roi, _ = time_stage(timings, "roi", device, filter_depth_roi, depth_t, K, roi, radius=2, device=device)
+        umin, vmin, umax, vmax = roi
+        diff = (full - depth_roi)[vmin:vmax + 1, umin:umax + 1].abs().max().item()
+        print(f"{H}x{W} full {np.mean(timings['full'])*1000:8.2f} ms   roi {roi_size}x{roi_size} {np.mean(timings['roi'])*1000:8.2f} ms   max abs diff in roi {diff:.3e}")
+
+
+def warp_perspective_frames(imgs, tfs, dsize, mode, frame_ids=None):
+    """Reference for sample_crops_frames: kornia warp_perspective of the crop of each hypothesis out of the frame it belongs to
+    @imgs: (N_frame,C,H,W) torch tensor
+    @tfs: (B,3,3) torch tensor, crop transforms
+    @frame_ids: (B,) np array, index into imgs for each crop. None means all crops come from imgs[0]
+    """
+    B = len(tfs)
+    if frame_ids is None:
+        return kornia.geometry.transform.warp_perspective(imgs[:1].expand(B, -1, -1, -1), tfs, dsize=dsize, mode=mode, align_corners=False)
+    out = torch.zeros((B, imgs.shape[1], dsize[0], dsize[1]), dtype=imgs.dtype, device=imgs.device)
+    for f in np.unique(frame_ids):
+        ids = torch.as_tensor(np.nonzero(frame_ids == f)[0], device=imgs.device)
+        out[ids] = kornia.geometry.transform.warp_perspective(imgs[f:f + 1].expand(len(ids), -1, -1, -1), tfs[ids], dsize=dsize, mode=mode, align_corners=False)
+    return out
+
+
+def benchmark_crop_sampler(device, n_hypo=250, n_repeat=10, crop_size=(160, 160)):
+    """Compare sample_crops_frames with the kornia warp_perspective_frames it replaces, on the rgb (bilinear) and xyz map (nearest) crops of n_hypo hypotheses"""
+    rng = np.random.default_rng(0)
+    for H, W in [(480, 640), (720, 1280)]:
+        K = np.array([[W, 0, W / 2], [0, W, H / 2], [0, 0, 1]], dtype=float)
+        for n_frame in [1, 4]:
+            rgb = torch.as_tensor(rng.random((n_frame, H, W, 3)) * 255, dtype=torch.float, device=device)
+            xyz_map = torch.as_tensor(rng.random((n_frame, H, W, 3)), dtype=torch.float, device=device)
+            poses = torch.eye(4, device=device)[None].repeat(n_hypo, 1, 1)
+            poses[:, :3, 3] = torch.as_tensor(rng.normal([0, 0, 0.8], [0.2, 0.15, 0.1], (n_hypo, 3)), dtype=torch.float, device=device)
+            tfs = compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=1.2, out_size=crop_size[::-1], method="box_3d", mesh_diameter=0.2)
+            frame_ids = None if n_frame == 1 else np.sort(rng.integers(0, n_frame, n_hypo))
+            timings = defaultdict(list)
+            for _ in range(n_repeat):
+                sync(device)
+                start = time.perf_counter()
+                rgbBs = warp_perspective_frames(rgb.permute(0, 3, 1, 2), tfs, dsize=crop_size, mode="bilinear", frame_ids=frame_ids)
+                xyz_mapBs = warp_perspective_frames(xyz_map.permute(0, 3, 1, 2), tfs, dsize=crop_size, mode="nearest", frame_ids=frame_ids)
+                sync(device)
+                timings["kornia"].append(time.perf_counter() - start)
+                crops = time_stage(timings, "roi", device, sample_crops_frames, [rgb, xyz_map], tfs, dsize=crop_size, modes=("bilinear", "nearest"), frame_ids=frame_ids)
+            rgb_diff = (crops[:, :3] - rgbBs).abs().max().item()
+            xyz_mismatch = ((crops[:, 3:] - xyz_mapBs).abs() > 0).float().mean().item()
+            print(f"{H}x{W} frames {n_frame} hypotheses {n_hypo}   kornia {np.mean(timings['kornia'])*1000:8.2f} ms   roi {np.mean(timings['roi'])*1000:8.2f} ms   rgb max abs diff {rgb_diff:.3e}   xyz nearest mismatch {xyz_mismatch*100:.3f}%")
+
+
+def make_crop_hypotheses(mesh, device, n_hypo=252, crop_size=(160, 160), crop_ratio=1.2):
+    """Random rotations of the mesh in front of a synthetic camera, with the roi each hypothesis crop renders"""
+    diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=1000)
+    H, W = 480, 640
+    K = np.array([[600, 0, W / 2], [0, 600, H / 2], [0, 0, 1]], dtype=float)
+    rng = np.random.default_rng(0)
+    poses = torch.eye(4, device=device)[None].repeat(n_hypo, 1, 1)
+    poses[:, :3, :3] = torch.as_tensor(np.stack([random_rotation_matrix(rng.random(3))[:3, :3] for _ in range(n_hypo)]), dtype=torch.float, device=device)
+    poses[:, :3, 3] = torch.as_tensor([0, 0, 3 * diameter], dtype=torch.float, device=device)
+    tfs = compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=crop_ratio, out_size=crop_size[::-1], method="box_3d", mesh_diameter=diameter)
+    bbox2d = transform_pts(torch.as_tensor([[0, 0], [crop_size[1] - 1, crop_size[0] - 1]], dtype=torch.float, device=device), tfs.inverse()[:, None]).reshape(-1, 4)
+    return K, H, W, poses, bbox2d
+
+
+def benchmark_rasterizers(mesh, device, n_hypo=252, n_repeat=3, crop_size=(160, 160)):
+    """Render the crops of n_hypo random hypotheses with every available rasterizer, with timing and pixel parity against the first one (nvdiffrast on cuda, the reference cpu rasterizer otherwise)"""
+    rasterizers = ["nvdiffrast"] if torch.device(device).type == "cuda" and dr is not None else []
+    rasterizers += ["reference", "tiled"]
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    K, H, W, poses, bbox2d = make_crop_hypotheses(mesh, device, n_hypo=n_hypo, crop_size=crop_size)
+    outs = {}
+    for rasterizer in rasterizers:
+        glctx = make_raster_context(rasterizer, device=device)
+        timings = defaultdict(list)
+        for _ in range(n_repeat):
+            extra = {}
+            color, depth, _ = time_stage(timings, rasterizer, device, nvdiffrast_render, K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=crop_size, bbox2d=bbox2d, use_light=True, extra=extra)
+        outs[rasterizer] = (color, depth)
+        color_ref, depth_ref = outs[rasterizers[0]]
+        n_color = ((color - color_ref).abs().amax(dim=-1) > 1 / 255).sum().item()
+        n_mask = ((depth > 0) != (depth_ref > 0)).sum().item()
+        print(f"{rasterizer:<10s} {np.mean(timings[rasterizer])*1000/n_hypo:8.2f} ms/hypothesis   pixels off vs {rasterizers[0]}: color {n_color} ({n_color/color.numel()*3*100:.4f}%)   mask {n_mask}")
+
+
+def benchmark_mesh_lod(mesh, device, face_budgets=(100000, 30000, 10000), n_hypo=252, n_repeat=3, crop_size=(160, 160), crop_ratio=1.2):
+    """Render the hypothesis crops from the full mesh and from each decimated level, with timing and the color / depth / mask error of every level against the full mesh"""
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    mesh_tensors["lods"] = make_mesh_lods(mesh, face_budgets=face_budgets, device=device)
+    lod_size = min(crop_size) / crop_ratio
+    picked = select_mesh_lod(mesh_tensors, lod_size)
+    print(f"lod_size {lod_size:.1f} px picks the {len(picked['faces'])} face level")
+    K, H, W, poses, bbox2d = make_crop_hypotheses(mesh, device, n_hypo=n_hypo, crop_size=crop_size, crop_ratio=crop_ratio)
+    glctx = make_raster_context(device=device)
+    color_ref = depth_ref = None
+    for level in [mesh_tensors] + mesh_tensors["lods"][::-1]:
+        name = f"{len(level['faces'])} faces"
+        timings = defaultdict(list)
+        for _ in range(n_repeat):
+            color, depth, _ = time_stage(timings, name, device, nvdiffrast_render, K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=level, output_size=crop_size, bbox2d=bbox2d, use_light=True)
+        if color_ref is None:
+            color_ref, depth_ref = color, depth
+        mask, mask_ref = depth > 0, depth_ref > 0
+        both = mask & mask_ref
+        iou = (both.sum() / (mask | mask_ref).sum().clamp(min=1)).item()
+        color_err = (color - color_ref).abs()[both].mean().item() * 255
+        depth_err = (depth - depth_ref).abs()[both].mean().item() * 1000
+        print(f"{name:>14s} {np.mean(timings[name])*1000/n_hypo:8.2f} ms/hypothesis   mask iou {iou:.4f}   color err {color_err:6.2f}/255   depth err {depth_err:.3f} mm")
+
+
+def benchmark_template_bank(mesh, device, off_axis_angles=(0, 10, 20, 30, 45), depths=(2, 4, 8), n_repeat=3, crop_size=(160, 160), crop_ratio=1.2):
+    """Bank crops of the rotation grid against rendering them, per off-axis angle and depth in diameters: build / lookup / render time and the mask, color and xyz error of the bank"""
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=1000)
+    rot_grid = torch.as_tensor(make_rotation_grid(), dtype=torch.float, device=device)
+    glctx = make_raster_context(device=device)
+    timings = defaultdict(list)
+    bank = time_stage(timings, "build", device, TemplateBank.build, rot_grid, mesh_tensors, diameter, render_size=crop_size, crop_ratio=crop_ratio, glctx=glctx)
+    print(f"{len(rot_grid)} crops, build {np.mean(timings['build'])*1000:.1f} ms, {(bank.rgba.nbytes + bank.xyz.nbytes)/1e6:.1f} MB")
+    H, W = 480, 640
+    K = np.array([[600, 0, W / 2], [0, 600, H / 2], [0, 0, 1]], dtype=float)
+    ids = np.arange(len(rot_grid))
+    for depth in depths:
+        for angle in off_axis_angles:
+            poses = bank.hypotheses(torch.as_tensor([np.sin(np.deg2rad(angle)), 0, np.cos(np.deg2rad(angle))], dtype=torch.float, device=device) * depth * diameter)
+            tfs = compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=crop_ratio, out_size=crop_size[::-1], method="box_3d", mesh_diameter=diameter)
+            bbox2d = transform_pts(torch.as_tensor([[0, 0], [crop_size[1] - 1, crop_size[0] - 1]], dtype=torch.float, device=device), tfs.inverse()[:, None]).reshape(-1, 4)
+            timings = defaultdict(list)
+            for _ in range(n_repeat):
+                extra = {}
+                color_ref, depth_ref, _ = time_stage(timings, "render", device, nvdiffrast_render, K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=crop_size, bbox2d=bbox2d, use_light=True, extra=extra, lod_size=min(crop_size) / crop_ratio)
+                color, _, xyz_map = time_stage(timings, "bank", device, bank.crops, ids, poses, K, tfs)
+            mask, mask_ref = xyz_map[..., 2] > 0, depth_ref > 0
+            both = mask & mask_ref
+            iou = (both.sum() / (mask | mask_ref).sum().clamp(min=1)).item()
+            color_err = (color - color_ref).abs()[both].mean().item() * 255
+            xyz_err = (xyz_map - extra["xyz_map"]).norm(dim=-1)[both].mean().item() / diameter
+            print(f"depth {depth:2d} diameters, {angle:3d} deg off-axis   render {np.mean(timings['render'])*1000:8.2f} ms   bank {np.mean(timings['bank'])*1000:8.2f} ms   mask iou {iou:.4f}   color err {color_err:6.2f}/255   xyz err {xyz_err:.4f} diameters")
+
+
+def benchmark_render_memory(mesh, device, batch_sizes=(64, 252, 512), n_repeat=3, crop_size=(160, 160)):
+    """Latency and peak cuda memory of one nvdiffrast_render call per hypothesis batch size"""
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    glctx = make_raster_context(device=device)
+    print(f"{len(mesh_tensors['pos'])} vertices, {len(mesh_tensors['faces'])} faces")
+    for bs in batch_sizes:
+        K, H, W, poses, bbox2d = make_crop_hypotheses(mesh, device, n_hypo=bs, crop_size=crop_size)
+        timings = defaultdict(list)
+        for _ in range(n_repeat):
+            extra = {}
+            time_stage(timings, "render", device, nvdiffrast_render, K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=crop_size, bbox2d=bbox2d, use_light=True, extra=extra, track_memory=True)
+        peak = f"{extra['peak_memory_mb']:8.1f} MB" if "peak_memory_mb" in extra else "     n/a"
+        print(f"batch {bs:4d}   {np.mean(timings['render'])*1000:8.2f} ms   peak memory {peak}")
+
+
+def benchmark_backends(device, backends, batch_sizes=(1, 64, 252), n_repeat=3):
+    """Per hypothesis latency of the refiner and scorer networks for each inference backend, with the max abs output diff vs eager torch as parity check"""
+    refiner = PoseRefinePredictor(device=device)
+    scorer = ScorePredictor(device=device)
+    for kind, predictor in [("refine", refiner), ("score", scorer)]:
+        cfg = predictor.cfg
+        H, W = cfg["input_resize"][1], cfg["input_resize"][0]
+        models = {backend: make_model_backend(predictor.model, kind=kind, cfg=cfg, ckpt_dir=cfg["ckpt_dir"], backend=backend, device=device) for backend in backends}
+        for bs in batch_sizes:
+            A = torch.rand((bs, cfg["c_in"], H, W), device=device)
+            B = torch.rand((bs, cfg["c_in"], H, W), device=device)
+            kwargs = {} if kind == "refine" else {"L": bs}
+            with torch.inference_mode():
+                ref = predictor.model(A, B, **kwargs)
+                for backend, model in models.items():
+                    timings = defaultdict(list)
+                    for _ in range(n_repeat):
+                        out = time_stage(timings, backend, device, model, A, B, **kwargs)
+                    diff = max((out[k].float() - ref[k].float()).abs().max().item() for k in ref)
+                    print(f"{kind:<6s} {backend:<8s} batch {bs:4d}   {np.mean(timings[backend])*1000/bs:8.2f} ms/hypothesis   max abs diff vs torch {diff:.3e}")
+
+
+DEBUG_ONLY_MODULES = ["open3d", "pandas", "matplotlib", "pytorch3d.renderer", "torchvision", "sklearn", "scipy.interpolate", "joblib", "ruamel.yaml", "pyrender"]
+
+
+def run_fresh(code):
+    """Run code in a fresh interpreter in code_dir, on top of torch, numpy and cv2, which any worker needs anyway.
+    Returns the seconds code took and the comma separated DEBUG_ONLY_MODULES loaded by its end"""
+    script = "\n".join([
+        "import sys, time",
+        "import torch, numpy, cv2",
+        "t = time.perf_counter()",
+        code,
+        "t = time.perf_counter() - t",
+        f"print('IMPORT', t, ','.join(m for m in {DEBUG_ONLY_MODULES!r} if m in sys.modules))",
+    ])
+    out = subprocess.run([sys.executable, "-c", script], cwd=code_dir, capture_output=True, text=True, check=True).stdout
+    fields = [l for l in out.splitlines() if l.startswith("IMPORT")][-1].split(" ")
+    return float(fields[1]), fields[2] if len(fields) > 2 else ""
+
+
+def benchmark_import_time(modules=("Utils", "estimater"), budget=1.0, n_repeat=3):
+    """Import time of each module with run_fresh.
+    Returns False when a module takes more than budget seconds or pulls in one of DEBUG_ONLY_MODULES"""
+    ok = True
+    for module in modules:
+        times = []
+        for _ in range(n_repeat):
+            t, loaded = run_fresh(f"import {module}")
+            times.append(t)
+        t = np.median(times)
+        ok &= t <= budget and loaded == ""
+        print(f"{module:<10s} {t:6.3f} s (budget {budget:.1f} s)   debug only modules loaded: {loaded or 'none'}")
+    return ok
+
+
+def load_mesh(mesh_file):
+    mesh = trimesh.load(mesh_file)
+    if isinstance(mesh, trimesh.Scene):
+        mesh = list(mesh.geometry.values())[0]
+    return mesh
+
+
+def iter_saved_requests(requests_dir, max_requests=20):
+    """Yield (request_dir, mesh, reader) for the requests saved by pose_api_server.py"""
+    for request_dir in sorted(glob.glob(f"{requests_dir}/*"))[:max_requests]:
+        mesh_files = sorted(glob.glob(f"{request_dir}/mesh/*"))
+        if len(mesh_files) == 0:
+            continue
+        yield request_dir, load_mesh(mesh_files[0]), YcbineoatReader(request_dir, shorter_side=None, zfar=np.inf)
+
+
+def make_estimator(mesh, refiner, scorer, device, debug_dir, symmetry_tfs=None):
+    return FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, symmetry_tfs=symmetry_tfs, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=0, device=device)
+
+
+def calibrate(device, requests_dir, debug_dir, est_refine_iter=5, max_requests=20):
+    """Record the refiner/scorer inputs seen while registering saved requests, used by the int8 backend to calibrate the quantized encoders"""
+    refiner = PoseRefinePredictor(device=device)
+    scorer = ScorePredictor(device=device)
+    batches = {"refine": [], "score": []}
+    handles = [record_calibration_inputs(refiner.model, batches["refine"]), record_calibration_inputs(scorer.model, batches["score"])]
+    for request_dir, mesh, reader in iter_saved_requests(requests_dir, max_requests=max_requests):
+        est = make_estimator(mesh, refiner, scorer, device, debug_dir)
+        est.register(K=reader.K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+    for handle in handles:
+        handle.remove()
+    for kind, predictor in [("refine", refiner), ("score", scorer)]:
+        calib_file = f"{os.path.splitext(predictor.cfg['ckpt_dir'])[0]}_calib.pth"
+        torch.save(batches[kind], calib_file)
+        print(f"{kind}: saved {sum(len(A) for A, _ in batches[kind])} calibration samples to {calib_file}")
+
+
+def benchmark_int8_accuracy(device, requests_dir, debug_dir, est_refine_iter=5, max_requests=20):
+    """Pose deltas and register time of the int8 refiner/scorer vs fp32 on saved requests"""
+    predictors = {
+        "fp32": (PoseRefinePredictor(device=device), ScorePredictor(device=device)),
+        "int8": (PoseRefinePredictor(device=device, backend="int8"), ScorePredictor(device=device, backend="int8")),
+    }
+    t_errs, r_errs, times = [], [], defaultdict(list)
+    for request_dir, mesh, reader in iter_saved_requests(requests_dir, max_requests=max_requests):
+        poses = {}
+        for name, (refiner, scorer) in predictors.items():
+            est = make_estimator(mesh, refiner, scorer, device, debug_dir)
+            poses[name] = time_stage(times, name, device, est.register, K=reader.K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+        t_errs.append(np.linalg.norm(poses["int8"][:3, 3] - poses["fp32"][:3, 3]) * 1000)
+        R = poses["int8"][:3, :3].T @ poses["fp32"][:3, :3]
+        r_errs.append(np.rad2deg(np.arccos(np.clip((np.trace(R) - 1) / 2, -1, 1))))
+        print(f"{os.path.basename(request_dir)}   dt {t_errs[-1]:7.2f} mm   dR {r_errs[-1]:6.2f} deg   fp32 {times['fp32'][-1]:6.2f} s   int8 {times['int8'][-1]:6.2f} s")
+    if len(t_errs) > 0:
+        print(f"mean dt {np.mean(t_errs):.2f} mm (max {np.max(t_errs):.2f})   mean dR {np.mean(r_errs):.2f} deg (max {np.max(r_errs):.2f})   register speedup {np.mean(times['fp32'])/np.mean(times['int8']):.2f}x")
+
+
+def pose_error_up_to_symmetry(pose, pose_ref, symmetry_tfs):
+    """Translation (mm) and rotation (deg) error of pose vs pose_ref, for the symmetric copy of pose closest in rotation"""
+    poses = pose[None] @ symmetry_tfs
+    cos = (np.einsum("sij,ij->s", poses[:, :3, :3], pose_ref[:3, :3]) - 1) / 2
+    best = cos.argmax()
+    return np.linalg.norm(poses[best, :3, 3] - pose_ref[:3, 3]) * 1000, np.rad2deg(np.arccos(np.clip(cos[best], -1, 1)))
+
+
+def benchmark_symmetry(device, requests_dir, debug_dir, est_refine_iter=5, max_requests=20):
+    """Register the saved requests of symmetric objects with and without their symmetry_tfs, from symmetries.json or detect_symmetry_tfs: hypothesis counts, register time and the pose difference up to symmetry"""
+    refiner = PoseRefinePredictor(device=device)
+    scorer = ScorePredictor(device=device)
+    times = defaultdict(list)
+    for request_dir, mesh, reader in iter_saved_requests(requests_dir, max_requests=max_requests):
+        if os.path.exists(f"{request_dir}/symmetries.json"):
+            with open(f"{request_dir}/symmetries.json") as f:
+                symmetry_tfs = symmetry_tfs_from_info(json.load(f))
+        else:
+            symmetry_tfs = detect_symmetry_tfs(mesh)
+        if len(symmetry_tfs) == 1:
+            continue
+        poses, n_hypo = {}, {}
+        for name, tfs in [("plain", None), ("symmetric", symmetry_tfs)]:
+            est = make_estimator(mesh, refiner, scorer, device, debug_dir, symmetry_tfs=tfs)
+            poses[name] = time_stage(times, name, device, est.register, K=reader.K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+            n_hypo[name] = f"{len(est.rot_grid)}/{len(est.poses)}"
+        t_err, r_err = pose_error_up_to_symmetry(poses["symmetric"], poses["plain"], symmetry_tfs)
+        print(f"{os.path.basename(request_dir)}   {len(symmetry_tfs)} symmetries   hypotheses refined/scored {n_hypo['plain']} -> {n_hypo['symmetric']}   dt {t_err:7.2f} mm   dR {r_err:6.2f} deg   {times['plain'][-1]:6.2f} s -> {times['symmetric'][-1]:6.2f} s")
+
+
+def count_syncs(fn, *args, **kwargs):
+    """Run fn with the cuda sync debug mode on, return its output and the number of host-device synchronizations it triggered"""
+    torch.cuda.synchronize()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
+        try:
+            out = fn(*args, **kwargs)
+        finally:
+            torch.cuda.set_sync_debug_mode("default")
+    return out, len(caught)
+
+
+def benchmark_syncs(est, reader, device, est_refine_iter=5, track_refine_iter=2):
+    """Count the host-device synchronizations of register and track_one, only meaningful on cuda"""
+    if torch.device(device).type != "cuda":
+        print("sync counting needs a cuda device")
+        return
+    K = reader.K
+    mask = reader.get_mask(0).astype(bool)
+    est.register(K=K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=mask, iteration=est_refine_iter)  # Warm up
+    _, n_sync = count_syncs(est.register, K=K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=mask, iteration=est_refine_iter)
+    print(f"register   syncs per frame: {n_sync}")
+    for i in range(1, min(len(reader.color_files), 6)):
+        _, n_sync = count_syncs(est.track_one, rgb=reader.get_color(i), depth=reader.get_depth(i), K=K, iteration=track_refine_iter)
+        print(f"track_one  frame {i} syncs: {n_sync}")
+
+
+def benchmark_workspace(est, reader, device, est_refine_iter=5, track_refine_iter=2):
+    """Check that the crop workspaces stop allocating once warm: the buffer counts must stay flat from the second frame on"""
+    K = reader.K
+    est.register(K=K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+    warm = (est.refiner.workspace.n_alloc, est.scorer.workspace.n_alloc)
+    print(f"after register   refiner buffers: {warm[0]}, scorer buffers: {warm[1]}")
+    for i in range(1, min(len(reader.color_files), 6)):
+        n_cuda = torch.cuda.memory_stats(device)["allocation.all.allocated"] if torch.device(device).type == "cuda" else None
+        est.track_one(rgb=reader.get_color(i), depth=reader.get_depth(i), K=K, iteration=track_refine_iter)
+        msg = f"track_one frame {i} refiner buffers: {est.refiner.workspace.n_alloc}"
+        if n_cuda is not None:
+            msg += f", cuda allocations: {torch.cuda.memory_stats(device)['allocation.all.allocated'] - n_cuda}"
+        print(msg)
+    est.register(K=K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+    print(f"register again   refiner buffers: {est.refiner.workspace.n_alloc}, scorer buffers: {est.scorer.workspace.n_alloc}")
+
+
+def benchmark_debug_overhead(est, reader, device, est_refine_iter=5, track_refine_iter=2, n_repeat=3, debug_levels=(0, 2)):
+    """register and track_one latency per debug level, the files are written by the debug writer in the background. Also reports how long the writer needs to drain and how many jobs it dropped"""
+    K = reader.K
+    color, depth, mask = reader.get_color(0), reader.get_depth(0), reader.get_mask(0).astype(bool)
+    writer = get_debug_writer()
+    for debug in debug_levels:
+        est.debug = debug
+        timings = defaultdict(list)
+        for _ in range(n_repeat):
+            time_stage(timings, "register", device, est.register, K=K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
+            if len(reader.color_files) > 1:
+                time_stage(timings, "track_one", device, est.track_one, rgb=reader.get_color(1), depth=reader.get_depth(1), K=K, iteration=track_refine_iter)
+            time_stage(timings, "writer_drain", device, writer.flush)
+        print(f"debug {debug}   " + "   ".join(f"{name} {np.mean(ts)*1000:8.1f} ms" for name, ts in timings.items()) + f"   dropped {writer.n_dropped}")
+    est.debug = 0
+
+
+def benchmark_trace(est, reader, device, est_refine_iter=5, track_refine_iter=2, n_span=100000, debug_dir="debug"):
+    """Cost of a disabled span, then register and track_one with tracing on. The spans are exported to debug_dir/trace.json and summed per name"""
+    tracer.enabled = False
+    begin = time.perf_counter()
+    for _ in range(n_span):
+        with tracer.span("render", n_pose=1):
+            pass
+    print(f"disabled span {(time.perf_counter()-begin)/n_span*1e9:6.1f} ns")
+
+    K = reader.K
+    tracer.enabled = True
+    tracer.sync = device != "cpu"
+    trace_start = tracer.now()
+    est.register(K=K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=est_refine_iter)
+    for i in range(1, min(len(reader.color_files), 5)):
+        est.track_one(rgb=reader.get_color(i), depth=reader.get_depth(i), K=K, iteration=track_refine_iter)
+    tracer.enabled = False
+    os.makedirs(debug_dir, exist_ok=True)
+    trace = tracer.export_chrome_trace(f"{debug_dir}/trace.json", since=trace_start)
+    totals = defaultdict(list)
+    for event in trace["traceEvents"]:
+        totals[event["name"]].append(event["dur"])
+    for name, durs in totals.items():
+        print(f"{name:<24s} n {len(durs):5d}   total {np.sum(durs)/1000:9.1f} ms")
+    print(f"trace written to {debug_dir}/trace.json")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    parser.add_argument(
+        "--mesh_file",
+        type=str,
+        default=f"{code_dir}/demo_data/mustard0/mesh/textured_simple.obj",
+    )
+    parser.add_argument(
+        "--test_scene_dir", type=str, default=f"{code_dir}/demo_data/mustard0"
+    )
+    parser.add_argument("--requests_dir", type=str, default=os.path.join(os.environ.get("DIR", code_dir), "saved_requests"))
+    parser.add_argument("--max_requests", type=int, default=20)
+    parser.add_argument("--mode", type=str, default="pipeline", choices=["pipeline", "depth_filter", "depth_roi", "sync", "backend", "calibrate", "int8_accuracy", "workspace", "crop_sampler", "rasterizer", "mesh_lod", "render_memory", "import_time", "symmetry", "template_bank", "debug_overhead", "trace"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--backends", type=str, nargs="+", default=["torch"], choices=BACKENDS)
+    parser.add_argument("--n_repeat", type=int, default=3)
+    parser.add_argument("--est_refine_iter", type=int, default=5)
+    parser.add_argument("--track_refine_iter", type=int, default=2)
+    parser.add_argument("--debug_dir", type=str, default=f"{code_dir}/debug")
+    parser.add_argument("--import_budget", type=float, default=1.0)
+    args = parser.parse_args()
+
+    set_logging_format(logging.WARNING)
+    set_seed(0)
+    if args.device == "cpu":
+        set_num_threads(args.num_threads)
+
+    if args.mode == "import_time":
+        sys.exit(0 if benchmark_import_time(budget=args.import_budget, n_repeat=args.n_repeat) else 1)
+    if args.mode == "depth_filter":
+        benchmark_depth_filters(args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "depth_roi":
+        benchmark_depth_roi(args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "crop_sampler":
+        benchmark_crop_sampler(args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "backend":
+        benchmark_backends(args.device, args.backends, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "calibrate":
+        calibrate(args.device, args.requests_dir, args.debug_dir, est_refine_iter=args.est_refine_iter, max_requests=args.max_requests)
+        sys.exit(0)
+    if args.mode == "symmetry":
+        benchmark_symmetry(args.device, args.requests_dir, args.debug_dir, est_refine_iter=args.est_refine_iter, max_requests=args.max_requests)
+        sys.exit(0)
+    if args.mode == "int8_accuracy":
+        benchmark_int8_accuracy(args.device, args.requests_dir, args.debug_dir, est_refine_iter=args.est_refine_iter, max_requests=args.max_requests)
+        sys.exit(0)
+
+    mesh = load_mesh(args.mesh_file)
+    if args.mode == "rasterizer":
+        benchmark_rasterizers(mesh, args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "mesh_lod":
+        benchmark_mesh_lod(mesh, args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "render_memory":
+        benchmark_render_memory(mesh, args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "template_bank":
+        benchmark_template_bank(mesh, args.device, n_repeat=args.n_repeat)
+        sys.exit(0)
+    est = FoundationPose(
+        model_pts=mesh.vertices,
+        model_normals=mesh.vertex_normals,
+        mesh=mesh,
+        debug_dir=args.debug_dir,
+        debug=0,
+        device=args.device,
+    )
+    reader = YcbineoatReader(args.test_scene_dir, shorter_side=None, zfar=np.inf)
+
+    if args.mode == "sync":
+        benchmark_syncs(est, reader, args.device, est_refine_iter=args.est_refine_iter, track_refine_iter=args.track_refine_iter)
+        sys.exit(0)
+    if args.mode == "workspace":
+        benchmark_workspace(est, reader, args.device, est_refine_iter=args.est_refine_iter, track_refine_iter=args.track_refine_iter)
+        sys.exit(0)
+    if args.mode == "debug_overhead":
+        benchmark_debug_overhead(est, reader, args.device, est_refine_iter=args.est_refine_iter, track_refine_iter=args.track_refine_iter, n_repeat=args.n_repeat)
+        sys.exit(0)
+    if args.mode == "trace":
+        benchmark_trace(est, reader, args.device, est_refine_iter=args.est_refine_iter, track_refine_iter=args.track_refine_iter, debug_dir=args.debug_dir)
+        sys.exit(0)
+
+    timings = benchmark_register_track(est, reader, args.device, est_refine_iter=args.est_refine_iter, track_refine_iter=args.track_refine_iter, n_repeat=args.n_repeat)
+    print(f"device:{args.device}, num_threads:{torch.get_num_threads()}, n_hypo:{len(est.rot_grid)}")
+    for name, ts in timings.items():
+        ts = np.asarray(ts) * 1000
+        print(f"{name:<24s} mean {ts.mean():9.1f} ms   min {ts.min():9.1f} ms")
@@ -31,9 +31,22 @@ if __name__ == "__main__":
     set_logging_format()
     set_seed(0)
 
-scorer = ScorePredictor()
-refiner = PoseRefinePredictor()
-glctx = dr.RasterizeCudaContext()
+device = os.environ.get("POSE_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+if device == "cpu":
+    set_num_threads()
+scorer_max_memory_mb = os.environ.get("POSE_SCORER_MAX_MEMORY_MB")
+scorer = ScorePredictor(
+    device=device,
+    backend=os.environ.get("POSE_SCORER_BACKEND", "torch"),
+    max_memory_mb=None if scorer_max_memory_mb is None else float(scorer_max_memory_mb),
+)
+refiner = PoseRefinePredictor(device=device, backend=os.environ.get("POSE_REFINER_BACKEND", "torch"))
+glctx = make_raster_context(os.environ.get("POSE_RASTERIZER"), device=device)
+lod_face_budgets = (100000, 30000, 10000) if os.environ.get("POSE_MESH_LOD", "0") == "1" else None
+detect_symmetry = os.environ.get("POSE_DETECT_SYMMETRY", "1") == "1"
+template_dir = os.environ.get("POSE_TEMPLATE_DIR")
+tracer.enabled = os.environ.get("POSE_TRACE", "0") == "1"
+tracer.sync = os.environ.get("POSE_TRACE_SYNC", "0") == "1"
 
 
 def run_pose_estimation(
@@ -43,7 +56,12 @@ def run_pose_estimation(
     est_refine_iter=5,
     track_refine_iter=2,
     debug=1,
+    symmetry_info=None,
 ):
+    """
+    @symmetry_info: BOP models_info style dict with symmetries_discrete / symmetries_continuous, see symmetry_tfs_from_info. Detected from the mesh if None, unless POSE_DETECT_SYMMETRY=0
+    """
+    trace_start = tracer.now()
 
     mesh = trimesh.load(mesh_file)
     if isinstance(mesh, trimesh.Scene):
@@ -56,7 +74,16 @@ def run_pose_estimation(
     ):
         mesh.compute_vertex_normals()
 
+    if symmetry_info is not None:
+        symmetry_tfs = symmetry_tfs_from_info(symmetry_info)
+    elif detect_symmetry:
+        symmetry_tfs = detect_symmetry_tfs(mesh)
+    else:
+        symmetry_tfs = None
+
     debug_dir = debug_dir
+    if debug >= 2:   # Only debug>=2 writes through the writer, its files of the previous request land before the directory is cleared
+        get_debug_writer().flush()
     os.system(
         f"rm -rf {debug_dir}/* && mkdir -p {debug_dir}/track_vis {debug_dir}/ob_in_cam"
     )
@@ -64,19 +91,24 @@ def run_pose_estimation(
     est = FoundationPose(
         model_pts=mesh.vertices,
         model_normals=mesh.vertex_normals,
+        symmetry_tfs=symmetry_tfs,
         mesh=mesh,
         scorer=scorer,
         refiner=refiner,
         debug_dir=debug_dir,
         debug=debug,
         glctx=glctx,
+        device=device,
+        lod_face_budgets=lod_face_budgets,
     )
+    if template_dir is not None:
+        est.make_template_bank(cache_dir=template_dir)
     logging.info("estimator initialization done")
 
     reader = YcbineoatReader(test_scene_dir, shorter_side=None, zfar=np.inf)
 
     for i in range(len(reader.color_files)):
-        logging.info(f"i:{i}")
+        logging.debug("i:%s", i)
         color = reader.get_color(i)
         depth = reader.get_depth(i)
         if i == 0:
@@ -90,13 +122,9 @@ def run_pose_estimation(
             )
 
             if debug >= 3:
-                m = mesh.copy()
-                m.apply_transform(pose)
-                m.export(f"{debug_dir}/model_tf.obj")
-                xyz_map = depth2xyzmap(depth, reader.K)
-                valid = depth >= 0.001
-                pcd = toOpen3dCloud(xyz_map[valid], color[valid])
-                o3d.io.write_point_cloud(f"{debug_dir}/scene_complete.ply", pcd)
+                writer = get_debug_writer()
+                writer.write_mesh(f"{debug_dir}/model_tf.obj", lambda pose=pose: mesh.copy().apply_transform(pose))
+                writer.write_point_cloud(f"{debug_dir}/scene_complete.ply", partial(depth2xyzmap, depth, reader.K), color)
         else:
             pose = est.track_one(
                 rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter
@@ -104,3 +132,6 @@ def run_pose_estimation(
 
         os.makedirs(f"{debug_dir}/ob_in_cam", exist_ok=True)
         np.savetxt(f"{debug_dir}/ob_in_cam/{reader.id_strs[i]}.txt", pose.reshape(4, 4))
+
+    if tracer.enabled:
+        tracer.export_chrome_trace(f"{debug_dir}/trace.json", since=trace_start)
@@ -0,0 +1,156 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(code_dir))
+
+torch = pytest.importorskip("torch")
+
+
+WEIGHTS_DIR = os.path.join(os.path.dirname(code_dir), "weights")
+requires_weights = pytest.mark.skipif(not os.path.isdir(WEIGHTS_DIR), reason="needs the pretrained weights in FoundationPose/weights")
+requires_cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a cuda device")
+
+
+class IdentityRefiner:
+    """Stands in for PoseRefinePredictor where a test exercises the estimator around the network: returns the poses it is given"""
+
+    def __init__(self, crop_ratio=1.2, input_resize=(160, 160)):
+        self.cfg = {"crop_ratio": crop_ratio, "input_resize": input_resize}
+        self.calls = []
+
+    def predict(self, ob_in_cams, get_vis=False, **kwargs):
+        poses = torch.as_tensor(ob_in_cams, dtype=torch.float).reshape(-1, 4, 4).clone()
+        self.calls.append(poses)
+        return poses, None
+
+
+class ConstantScorer:
+    """Stands in for ScorePredictor, every hypothesis gets the same score"""
+
+    def __init__(self, crop_ratio=1.2, input_resize=(160, 160)):
+        self.cfg = {"crop_ratio": crop_ratio, "input_resize": input_resize}
+
+    def predict(self, ob_in_cams, get_vis=False, **kwargs):
+        return torch.full((len(ob_in_cams),), 100.0, device=ob_in_cams.device), None
+
+
+def make_cfg(use_BN=False, c_in=6, input_resize=(32, 32), normalize_xyz=False):
+    """Hand written predictor config with the defaults the predictors fill in, in place of the config.yml of the weights"""
+    OmegaConf = pytest.importorskip("omegaconf").OmegaConf
+    return OmegaConf.create({
+        "use_BN": use_BN, "c_in": c_in, "input_resize": list(input_resize), "rot_rep": "axis_angle", "trans_rep": "tracknet",
+        "use_normal": False, "normalize_xyz": normalize_xyz, "zfar": np.inf, "crop_ratio": 1.2,
+    })
+
+
+def make_network(kind, tmp_path, use_BN=False, c_in=6, input_resize=(32, 32), seed=0):
+    """Randomly initialised RefineNet or ScoreNetMultiPair in eval mode, with make_cfg and a checkpoint in tmp_path
+    for make_model_backend to cache its artifacts next to. Needs no weights"""
+    RefineNet = pytest.importorskip("learning.models.refine_network").RefineNet
+    ScoreNetMultiPair = pytest.importorskip("learning.models.score_network").ScoreNetMultiPair
+
+    torch.manual_seed(seed)
+    cfg = make_cfg(use_BN=use_BN, c_in=c_in, input_resize=input_resize)
+    model = RefineNet(cfg=cfg, c_in=c_in) if kind == "refine" else ScoreNetMultiPair(cfg=cfg, c_in=c_in)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):   # Non trivial statistics, so folding them is exercised
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    model = model.eval()
+    ckpt_dir = str(tmp_path / f"{kind}_model_best.pth")
+    torch.save({"model": model.state_dict()}, ckpt_dir)
+    return model, cfg, ckpt_dir
+
+
+def make_refine_predictor(tmp_path, backend="torch"):
+    """PoseRefinePredictor around make_network instead of the pretrained weights, set up as its __init__ does"""
+    predict_pose_refine = pytest.importorskip("learning.training.predict_pose_refine")
+    from learning.models.model_backend import make_model_backend
+
+    model, cfg, ckpt_dir = make_network("refine", tmp_path)
+    cfg.trans_normalizer = [0.02, 0.02, 0.05]
+    cfg.rot_normalizer = 0.35
+    refiner = predict_pose_refine.PoseRefinePredictor.__new__(predict_pose_refine.PoseRefinePredictor)
+    refiner.device = torch.device("cpu")
+    refiner.amp = False
+    refiner.cfg = cfg
+    refiner.dataset = predict_pose_refine.PoseRefinePairH5Dataset(cfg=cfg, h5_file="", mode="test", device="cpu")
+    refiner.backend = backend
+    refiner.model = make_model_backend(model, kind="refine", cfg=cfg, ckpt_dir=ckpt_dir, backend=backend, device="cpu")
+    refiner.last_trans_update = None
+    refiner.last_rot_update = None
+    refiner.share_crops = True
+    refiner.workspace = predict_pose_refine.CropWorkspace()
+    return refiner
+
+
+def make_score_predictor(tmp_path, backend="torch", max_memory_mb=None, device="cpu"):
+    """ScorePredictor around make_network instead of the pretrained weights, set up as its __init__ does"""
+    predict_score = pytest.importorskip("learning.training.predict_score")
+    from learning.models.model_backend import make_model_backend
+
+    model, cfg, ckpt_dir = make_network("score", tmp_path)
+    scorer = predict_score.ScorePredictor.__new__(predict_score.ScorePredictor)
+    scorer.device = torch.device(device)
+    scorer.amp = False
+    scorer.cfg = cfg
+    scorer.dataset = predict_score.ScoreMultiPairH5Dataset(cfg=cfg, mode="test", h5_file=None, max_num_key=1, device=device)
+    scorer.share_crops = True
+    scorer.max_memory_mb = max_memory_mb
+    scorer.workspace = predict_score.CropWorkspace()
+    scorer.bytes_per_hypo = None
+    scorer.backend = backend
+    scorer.model = make_model_backend(model.to(device), kind="score", cfg=cfg, ckpt_dir=ckpt_dir, backend=backend, device=device)
+    return scorer
+
+
+@pytest.fixture
+def box_mesh():
+    trimesh = pytest.importorskip("trimesh")
+    mesh = trimesh.creation.box(extents=(0.1, 0.06, 0.04))
+    mesh.visual.vertex_colors = np.tile(np.array([[200, 80, 40, 255]], dtype=np.uint8), (len(mesh.vertices), 1))
+    return mesh
+
+
+def make_scene(H=120, W=160, z=0.5, half_size=15):
+    """Pinhole camera looking at a fronto-parallel plane at depth z, with a square object mask at the image center"""
+    K = np.array([[200, 0, W / 2], [0, 200, H / 2], [0, 0, 1]], dtype=float)
+    rgb = np.full((H, W, 3), 128, dtype=np.uint8)
+    depth = np.full((H, W), z, dtype=np.float32)
+    mask = np.zeros((H, W), dtype=bool)
+    mask[H // 2 - half_size:H // 2 + half_size, W // 2 - half_size:W // 2 + half_size] = True
+    return K, rgb, depth, mask
+
+
+@pytest.fixture
+def scene():
+    return make_scene()
+
+
+@pytest.fixture
+def make_estimator(box_mesh, tmp_path):
+    """FoundationPose around the stand-in predictors, on cpu unless device is given. Needs no weights"""
+    estimater = pytest.importorskip("estimater")
+
+    def make(symmetry_tfs=None, refiner=None, scorer=None, device="cpu", **kwargs):
+        kwargs.setdefault("glctx", estimater.CpuRasterizeContext())   # Unused by the stand-ins, keeps register off nvdiffrast
+        return estimater.FoundationPose(
+            model_pts=box_mesh.vertices,
+            model_normals=box_mesh.vertex_normals,
+            symmetry_tfs=symmetry_tfs,
+            mesh=box_mesh,
+            refiner=refiner or IdentityRefiner(),
+            scorer=scorer or ConstantScorer(),
+            debug_dir=str(tmp_path / "debug"),
+            debug=0,
+            device=device,
+            **kwargs,
+        )
+
+    return make
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+run_benchmark = pytest.importorskip("run_benchmark")
+
+H, W = 96, 128
+
+
+def make_inputs(n_frame, n_hypo=40, crop_size=(32, 32), seed=0):
+    rng = np.random.default_rng(seed)
+    K = np.array([[W, 0, W / 2], [0, W, H / 2], [0, 0, 1]], dtype=float)
+    rgb = torch.as_tensor(rng.random((n_frame, H, W, 3)) * 255, dtype=torch.float)
+    xyz_map = torch.as_tensor(rng.random((n_frame, H, W, 3)), dtype=torch.float)
+    poses = torch.eye(4)[None].repeat(n_hypo, 1, 1)
+    poses[:, :3, 3] = torch.as_tensor(rng.normal([0, 0, 0.8], [0.3, 0.2, 0.2], (n_hypo, 3)), dtype=torch.float)   # Some crops reach past the image border
+    tfs = Utils.compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=1.2, out_size=crop_size[::-1], method="box_3d", mesh_diameter=0.2)
+    return rgb, xyz_map, tfs
+
+
+@pytest.mark.parametrize("crop_size", [(32, 32), (24, 40)])
+@pytest.mark.parametrize("frame_ids", [None, "sorted", "shuffled", "tensor"])
+def test_sample_crops_frames_matches_kornia(crop_size, frame_ids):
+    n_frame = 1 if frame_ids is None else 4
+    rgb, xyz_map, tfs = make_inputs(n_frame, crop_size=crop_size)
+    if frame_ids is not None:
+        ids = np.sort(np.random.default_rng(1).choice([0, 1, 3], len(tfs), p=[0.6, 0.3, 0.1]))   # Uneven, frame 2 has no crops
+        if frame_ids == "shuffled":
+            ids = np.random.default_rng(2).permutation(ids)
+        frame_ids = torch.as_tensor(ids) if frame_ids == "tensor" else ids
+    ref_ids = None if frame_ids is None else np.asarray(frame_ids)
+    rgb_ref = run_benchmark.warp_perspective_frames(rgb.permute(0, 3, 1, 2), tfs, dsize=crop_size, mode="bilinear", frame_ids=ref_ids)
+    xyz_ref = run_benchmark.warp_perspective_frames(xyz_map.permute(0, 3, 1, 2), tfs, dsize=crop_size, mode="nearest", frame_ids=ref_ids)
+
+    crops = Utils.sample_crops_frames([rgb, xyz_map], tfs, dsize=crop_size, modes=("bilinear", "nearest"), frame_ids=frame_ids)
+    torch.testing.assert_close(crops[:, :3], rgb_ref, atol=1e-3, rtol=0)
+    torch.testing.assert_close(crops[:, 3:], xyz_ref, atol=0, rtol=0)   # Nearest picks the same source pixel
+
+    outs = [torch.empty_like(rgb_ref), torch.empty_like(xyz_ref)]
+    assert Utils.sample_crops_frames([rgb, xyz_map], tfs, dsize=crop_size, modes=("bilinear", "nearest"), frame_ids=frame_ids, out=outs) is outs
+    torch.testing.assert_close(torch.cat(outs, dim=1), crops, atol=0, rtol=0)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from conftest import make_cfg, make_scene, requires_weights
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+predict_pose_refine = pytest.importorskip("learning.training.predict_pose_refine")
+predict_score = pytest.importorskip("learning.training.predict_score")
+
+N_POSE = 10
+N_FRAME = 4
+
+
+def make_frames(box_mesh, n_view, seed=0):
+    """Inputs of N_FRAME consecutive calls, poses and images change every frame, the shapes do not.
+    n_view > 1 stacks that many images, with the poses split evenly over them through frame_ids"""
+    rng = np.random.default_rng(seed)
+    K, rgb, depth, _ = make_scene()
+    common = dict(mesh=box_mesh, mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cpu"), glctx=Utils.CpuRasterizeContext(), mesh_diameter=0.125, K=K, crop_ratio=1.2, device="cpu")
+    frames = []
+    for _ in range(N_FRAME):
+        poses = torch.eye(4)[None].repeat(N_POSE, 1, 1)
+        poses[:, :3, :3] = torch.as_tensor(np.array([Utils.random_rotation_matrix(rng.random(3))[:3, :3] for _ in range(N_POSE)]), dtype=torch.float)
+        poses[:, :3, 3] = torch.as_tensor(rng.normal([0, 0, 0.5], 0.01, (N_POSE, 3)), dtype=torch.float)
+        rgbs = torch.as_tensor(rgb[None] + rng.integers(0, 60, (n_view, *rgb.shape), dtype=np.uint8), dtype=torch.float)
+        depths = torch.as_tensor(depth[None] + rng.normal(0, 0.002, (n_view, *depth.shape)), dtype=torch.float)
+        frame = dict(common, ob_in_cams=poses, rgb=rgbs[0], depth=depths[0])
+        if n_view > 1:
+            frame.update(rgb=rgbs, depth=depths, frame_ids=np.repeat(np.arange(n_view), N_POSE // n_view))
+        frames.append(frame)
+    return frames
+
+
+def network_inputs(pose_data):
+    if pose_data.inputAs is not None:
+        return pose_data.inputAs, pose_data.inputBs
+    return torch.cat([pose_data.rgbAs, pose_data.xyz_mapAs], dim=1), torch.cat([pose_data.rgbBs, pose_data.xyz_mapBs], dim=1)
+
+
+@pytest.mark.parametrize("kind", ["refine", "score"])
+@pytest.mark.parametrize("n_view", [1, 2])
+@pytest.mark.parametrize("normalize_xyz", [False, True])
+def test_workspace_allocations_stay_flat_across_frames(box_mesh, kind, n_view, normalize_xyz):
+    cfg = make_cfg(normalize_xyz=normalize_xyz)
+    render_size = tuple(cfg["input_resize"])
+    if kind == "refine":
+        dataset = predict_pose_refine.PoseRefinePairH5Dataset(cfg=cfg, h5_file="", mode="test", device="cpu")
+        make_crop_data_batch = predict_pose_refine.make_crop_data_batch
+    else:
+        dataset = predict_score.ScoreMultiPairH5Dataset(cfg=cfg, h5_file="", mode="test", device="cpu")
+        make_crop_data_batch = predict_score.make_crop_data_batch
+
+    workspace = Utils.CropWorkspace()
+    n_alloc = []
+    for frame in make_frames(box_mesh, n_view):
+        if kind == "refine":
+            frame["xyz_map"] = Utils.depth2xyzmap_batch(frame["depth"].reshape(n_view, *frame["depth"].shape[-2:]), torch.as_tensor(frame["K"], dtype=torch.float)[None].expand(n_view, 3, 3), zfar=np.inf).squeeze(0)
+        reference = make_crop_data_batch(render_size, cfg=cfg, dataset=dataset, **frame)
+        pose_data = make_crop_data_batch(render_size, cfg=cfg, dataset=dataset, workspace=workspace, **frame)
+        for x, x_ref in zip(network_inputs(pose_data), network_inputs(reference)):
+            torch.testing.assert_close(x, x_ref)
+        n_alloc.append(workspace.n_alloc)
+    assert n_alloc[0] > 0
+    assert n_alloc == n_alloc[:1] * N_FRAME, n_alloc
+
+
+@requires_weights
+def test_pipeline_workspace_allocations_stay_flat_across_frames(box_mesh, tmp_path):
+    estimater = pytest.importorskip("estimater")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    K, rgb, depth, mask = make_scene()
+    est = estimater.FoundationPose(model_pts=box_mesh.vertices, model_normals=box_mesh.vertex_normals, mesh=box_mesh, debug_dir=str(tmp_path), debug=0, device=device)
+    est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=2)
+    est.track_one(rgb=rgb, depth=depth, K=K, iteration=2)
+    n_alloc = est.refiner.workspace.n_alloc, est.scorer.workspace.n_alloc
+    for _ in range(3):
+        est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=2)
+        est.track_one(rgb=rgb, depth=depth, K=K, iteration=2)
+    assert (est.refiner.workspace.n_alloc, est.scorer.workspace.n_alloc) == n_alloc
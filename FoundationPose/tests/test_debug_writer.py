@@ -0,0 +1,84 @@
+import logging
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import make_refine_predictor, make_score_predictor
+from test_score_chunking import N_POSE, make_inputs
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+cv2 = pytest.importorskip("cv2")
+
+
+def test_debug_writer_resolves_arguments_on_its_thread(tmp_path):
+    writer = Utils.DebugWriter()
+    threads = []
+
+    def make_image():
+        threads.append(threading.current_thread().name)
+        return torch.full((8, 6), 7, dtype=torch.uint8)
+
+    assert writer.write_image(str(tmp_path / "a.png"), make_image)
+    assert writer.write_image(str(tmp_path / "b.png"), np.full((8, 6), 9, dtype=np.uint8))
+    writer.flush()
+    assert threads == ["DebugWriter"]
+    np.testing.assert_array_equal(cv2.imread(str(tmp_path / "a.png"), cv2.IMREAD_UNCHANGED), np.full((8, 6), 7))
+    np.testing.assert_array_equal(cv2.imread(str(tmp_path / "b.png"), cv2.IMREAD_UNCHANGED), np.full((8, 6), 9))
+
+
+def test_debug_writer_drops_jobs_when_the_queue_is_full(tmp_path, caplog):
+    writer = Utils.DebugWriter(max_queue=1)
+    started, release = threading.Event(), threading.Event()
+    writer.submit(lambda: started.set() or release.wait())
+    started.wait()
+    assert writer.write_image(str(tmp_path / "queued.png"), np.zeros((4, 4), dtype=np.uint8))
+    with caplog.at_level(logging.WARNING):
+        assert not writer.write_image(str(tmp_path / "dropped.png"), np.zeros((4, 4), dtype=np.uint8))
+    assert writer.n_dropped == 1 and "dropped" in caplog.text
+    release.set()
+    writer.flush()
+    assert (tmp_path / "queued.png").exists() and not (tmp_path / "dropped.png").exists()
+
+
+def test_debug_writer_survives_failing_jobs(tmp_path, caplog):
+    writer = Utils.DebugWriter()
+    with caplog.at_level(logging.WARNING):
+        writer.write_image(str(tmp_path / "bad.png"), lambda: 1 / 0)
+        writer.flush()
+    assert "failed" in caplog.text
+    writer.write_image(str(tmp_path / "good.png"), np.zeros((4, 4), dtype=np.uint8))
+    writer.flush()
+    assert (tmp_path / "good.png").exists()
+
+
+def test_score_vis_keeps_its_crops_when_the_workspace_is_reused(box_mesh, tmp_path):
+    scorer = make_score_predictor(tmp_path)
+    inputs = make_inputs(box_mesh)
+    _, vis = scorer.predict(get_vis=True, **inputs)
+    canvas = vis()
+    scorer.predict(get_vis=False, **make_inputs(box_mesh, seed=1))   # Overwrites the CropWorkspace buffers
+    np.testing.assert_array_equal(vis(), canvas)
+    assert canvas.dtype == np.uint8 and canvas.shape[0] == N_POSE * 105
+
+
+def test_refine_vis_shows_the_refined_poses(box_mesh, tmp_path, monkeypatch):
+    predict_pose_refine = pytest.importorskip("learning.training.predict_pose_refine")
+    refiner = make_refine_predictor(tmp_path)
+    inputs = make_inputs(box_mesh)
+    calls = []
+    capture_vis_crops = predict_pose_refine.capture_vis_crops
+    monkeypatch.setattr(predict_pose_refine, "capture_vis_crops", lambda pose_data: calls.append(pose_data.poseA.clone()) or capture_vis_crops(pose_data))
+    xyz_map = Utils.depth2xyzmap(inputs["depth"], inputs["K"])
+    poses, vis = refiner.predict(xyz_map=xyz_map, iteration=2, get_vis=True, **inputs)
+    assert len(calls) == 2   # The first iteration, and one batch rendered at the refined poses
+    torch.testing.assert_close(calls[0], torch.as_tensor(inputs["ob_in_cams"]))
+    torch.testing.assert_close(calls[1], poses)
+    refiner.predict(xyz_map=xyz_map, iteration=2, get_vis=False, **inputs)
+    assert len(calls) == 2
+    pytest.importorskip("torchvision")
+    canvas = vis()
+    H, W = refiner.cfg["input_resize"]
+    assert canvas.dtype == np.uint8
+    assert canvas.shape[0] > N_POSE * H and canvas.shape[1] > 2 * 4 * W   # Both columns, rgb and z of both crops
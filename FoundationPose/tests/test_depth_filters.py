@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+requires_warp = pytest.mark.skipif(Utils.wp is None, reason="needs warp")
+
+
+def make_depth(H=24, W=32, seed=0):
+    rng = np.random.default_rng(seed)
+    depth = (1 + 0.003 * rng.standard_normal((H, W))).astype(np.float32)
+    depth[rng.random((H, W)) < 0.15] = 0
+    depth[:, W // 2:] += 0.05
+    depth[:4, :4] = 200   # Beyond zfar
+    return depth
+
+
+def erode_depth_reference(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100):
+    """Per pixel transcription of erode_depth_kernel"""
+    H, W = depth.shape
+    out = np.zeros_like(depth)
+    for h in range(H):
+        for w in range(W):
+            d_ori = depth[h, w]
+            window = depth[max(h - radius, 0):h + radius + 1, max(w - radius, 0):w + radius + 1]
+            bad = (window < 0.001) | (window >= zfar) | (np.abs(window - d_ori) > depth_diff_thres)
+            out[h, w] = 0 if bad.sum() / window.size > ratio_thres else d_ori
+    return out
+
+
+def bilateral_filter_depth_reference(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000):
+    """Per pixel transcription of bilateral_filter_depth_kernel"""
+    H, W = depth.shape
+    out = np.zeros_like(depth)
+    for h in range(H):
+        for w in range(W):
+            v0, u0 = max(h - radius, 0), max(w - radius, 0)
+            window = depth[v0:h + radius + 1, u0:w + radius + 1].astype(np.float64)
+            valid = (window >= 0.001) & (window < zfar)
+            if not valid.any():
+                continue
+            mean_depth = window[valid].mean()
+            vs, us = np.meshgrid(np.arange(v0, v0 + window.shape[0]), np.arange(u0, u0 + window.shape[1]), indexing="ij")
+            weight = np.exp(-((us - w) ** 2 + (vs - h) ** 2) / (2 * sigmaD**2) - (depth[h, w] - window) ** 2 / (2 * sigmaR**2))
+            weight = weight * (valid & (np.abs(window - mean_depth) < 0.01))
+            if weight.sum() > 0:
+                out[h, w] = (weight * window).sum() / weight.sum()
+    return out
+
+
+def test_erode_depth_torch_matches_kernel():
+    depth = make_depth()
+    np.testing.assert_array_equal(Utils.erode_depth_torch(depth, radius=2, device="cpu"), erode_depth_reference(depth))
+
+
+def test_bilateral_filter_depth_torch_matches_kernel():
+    depth = erode_depth_reference(make_depth())
+    np.testing.assert_allclose(Utils.bilateral_filter_depth_torch(depth, radius=2, device="cpu"), bilateral_filter_depth_reference(depth), atol=1e-5)
+
+
+@requires_warp
+@pytest.mark.parametrize("device", ["cpu"] + (["cuda"] if torch.cuda.is_available() else []))
+def test_torch_filters_match_warp(device):
+    depth = torch.as_tensor(make_depth(H=120, W=160), device=device)
+    eroded = Utils.erode_depth_torch(depth, radius=2, device=device)
+    torch.testing.assert_close(eroded, Utils.erode_depth_warp(depth, radius=2, device=device), atol=0, rtol=0)
+    torch.testing.assert_close(Utils.bilateral_filter_depth_torch(eroded, radius=2, device=device), Utils.bilateral_filter_depth_warp(eroded, radius=2, device=device), atol=1e-5, rtol=0)
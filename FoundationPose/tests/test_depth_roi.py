@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+H, W = 60, 80
+K = np.array([[70, 0, W / 2], [0, 70, H / 2], [0, 0, 1]], dtype=float)
+
+
+def make_depth(seed=0):
+    rng = np.random.default_rng(seed)
+    depth = (1 + 0.003 * rng.standard_normal((H, W))).astype(np.float32)
+    depth[rng.random((H, W)) < 0.1] = 0
+    depth[:, W // 2:] += 0.05   # A depth edge the erosion acts on
+    return depth
+
+
+@pytest.mark.parametrize("roi", [(20, 15, 50, 40), (0, 0, 10, 10), (70, 50, W - 1, H - 1), (0, 0, W - 1, H - 1)])
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_filter_depth_roi_matches_full_frame_inside_roi(roi, as_tensor):
+    depth = make_depth()
+    if as_tensor:
+        depth = torch.as_tensor(depth)
+    full = Utils.bilateral_filter_depth(Utils.erode_depth(depth, radius=2, device="cpu"), radius=2, device="cpu")
+    full_xyz = Utils.depth2xyzmap(np.asarray(full), K)
+    depth_roi, xyz_roi = Utils.filter_depth_roi(depth, K, roi, radius=2, device="cpu")
+    assert type(depth_roi) is type(depth) and type(xyz_roi) is type(depth)
+    depth_roi, xyz_roi = np.asarray(depth_roi), np.asarray(xyz_roi)
+
+    umin, vmin, umax, vmax = roi
+    inside = np.zeros((H, W), dtype=bool)
+    inside[vmin:vmax + 1, umin:umax + 1] = True
+    np.testing.assert_allclose(depth_roi[inside], np.asarray(full)[inside], atol=1e-6)
+    np.testing.assert_allclose(xyz_roi[inside], full_xyz[inside], atol=1e-6)
+    assert (depth_roi[~inside] == 0).all() and (xyz_roi[~inside] == 0).all()
+
+
+def test_compute_depth_roi_covers_crop_windows_and_mask():
+    rng = np.random.default_rng(0)
+    mask = np.zeros((H, W), dtype=bool)
+    mask[5:12, 60:70] = True
+    diameter, crop_ratio = 0.15, 1.2
+    centers = rng.normal([0, 0, 1], [0.2, 0.15, 0.2], (20, 3))
+    poses = torch.eye(4)[None].repeat(len(centers), 1, 1)
+    poses[:, :3, 3] = torch.as_tensor(centers, dtype=torch.float)
+    tfs = Utils.compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=crop_ratio, out_size=(160, 160), method="box_3d", mesh_diameter=diameter)
+    corners = Utils.transform_pts(torch.tensor([[0, 0], [159, 159]], dtype=torch.float), tfs.inverse()[:, None]).reshape(-1, 2, 2).numpy()
+    for center, corner in zip(centers, corners):
+        for m in [None, mask]:
+            roi = Utils.compute_depth_roi(K, H, W, center=center, radius=diameter * crop_ratio / 2, mask=m)
+            roi_tensor = Utils.compute_depth_roi(K, H, W, center=torch.as_tensor(center, dtype=torch.float), radius=diameter * crop_ratio / 2, mask=m)
+            assert np.abs(np.subtract(roi, roi_tensor)).max() <= 1   # float32 vs float64 rounding
+            umin, vmin, umax, vmax = roi
+            (u0, v0), (u1, v1) = np.clip(corner, 0, [W - 1, H - 1])
+            assert umin <= np.ceil(u0) and vmin <= np.ceil(v0) and umax >= np.floor(u1) and vmax >= np.floor(v1)
+            if m is not None:
+                vs, us = np.nonzero(m)
+                assert us.min() >= umin and us.max() <= umax and vs.min() >= vmin and vs.max() <= vmax
+
+
+def test_compute_depth_roi_behind_camera_is_full_frame():
+    for center in [np.array([0, 0, -1.0]), torch.tensor([0, 0, 0.0])]:
+        assert Utils.compute_depth_roi(K, H, W, center=center, radius=0.1) == (0, 0, W - 1, H - 1)
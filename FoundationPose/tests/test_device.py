@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+def test_register_and_track_on_cpu(make_estimator, scene):
+    K, rgb, depth, mask = scene
+    est = make_estimator(device="cpu")
+    assert est.rot_grid.device.type == "cpu" and est.mesh_tensors["pos"].device.type == "cpu"
+    pose = est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1)
+    assert pose.shape == (4, 4)
+    np.testing.assert_allclose(pose[:3, 3], [0, 0, 0.5], atol=2e-3)   # Translation guess at the mask center, half a pixel off
+    for _ in range(2):
+        pose = est.track_one(rgb=rgb, depth=depth, K=K, iteration=1)
+        assert isinstance(pose, np.ndarray) and pose.shape == (4, 4)
+
+
+def test_cpu_render_of_a_box(box_mesh, scene):
+    """A box facing the camera renders as a rectangle at the depth of its front face, in its vertex color"""
+    K, _, depth, _ = scene
+    H, W = depth.shape
+    pose = torch.eye(4)[None]
+    pose[0, 2, 3] = 0.5
+    color, depth, _ = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=pose, mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cpu"))
+    mask = depth[0] > 0
+    z_front = 0.5 - 0.02
+    vs, us = torch.nonzero(mask, as_tuple=True)
+    half_w, half_h = K[0, 0] * 0.05 / z_front, K[1, 1] * 0.03 / z_front
+    assert abs(us.min().item() - (K[0, 2] - half_w)) <= 1 and abs(us.max().item() - (K[0, 2] + half_w)) <= 1
+    assert abs(vs.min().item() - (K[1, 2] - half_h)) <= 1 and abs(vs.max().item() - (K[1, 2] + half_h)) <= 1
+    assert mask.sum().item() == pytest.approx(4 * half_w * half_h, rel=0.05)
+    torch.testing.assert_close(depth[0][mask], torch.full((mask.sum(),), z_front), atol=1e-5, rtol=0)
+    torch.testing.assert_close(color[0][mask], torch.tensor([200, 80, 40], dtype=torch.float).expand(mask.sum(), 3) / 255, atol=1e-5, rtol=0)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+run_benchmark = pytest.importorskip("run_benchmark")
+
+IMPORT_BUDGET = 1.0   # Seconds on top of torch, numpy and cv2, as run_benchmark.py --mode import_time
+
+
+@pytest.mark.parametrize("module", ["Utils", "estimater"])
+def test_import_stays_under_budget_without_debug_only_modules(module):
+    runs = [run_benchmark.run_fresh(f"import {module}") for _ in range(3)]
+    assert [loaded for _, loaded in runs] == [""] * 3
+    assert np.median([t for t, _ in runs]) <= IMPORT_BUDGET
+
+
+def test_lazy_import_loads_on_first_use():
+    module = Utils.lazy_import("colorsys")
+    func = Utils.lazy_import("colorsys", "rgb_to_hsv")
+    assert module._obj is None and func._obj is None
+    assert module.rgb_to_hsv(1, 0, 0) == func(1, 0, 0) == (0, 1, 1)
+    assert module._obj is not None and func._obj is not None
+    with pytest.raises(AttributeError):
+        module.__wrapped__
+
+
+def test_estimator_setup_loads_no_debug_only_modules(tmp_path):
+    code = "\n".join([
+        "sys.path.insert(0, 'tests')",
+        "import trimesh, estimater",
+        "from conftest import ConstantScorer, IdentityRefiner",
+        "mesh = trimesh.creation.box(extents=(0.1, 0.06, 0.04))",
+        f"est = estimater.FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, refiner=IdentityRefiner(), scorer=ConstantScorer(), glctx=estimater.CpuRasterizeContext(), debug_dir={str(tmp_path)!r}, debug=0, device='cpu')",
+        "est.reset_object(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh)",
+    ])
+    _, loaded = run_benchmark.run_fresh(code)
+    assert loaded == ""
+
+
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_voxel_downsample_matches_open3d(as_tensor):
+    o3d = pytest.importorskip("open3d")
+    rng = np.random.default_rng(0)
+    pts = rng.normal(0, 0.05, (5000, 3))
+    normals = rng.normal(0, 1, (5000, 3))
+    cloud = o3d.geometry.PointCloud()
+    cloud.points = o3d.utility.Vector3dVector(pts)
+    cloud.normals = o3d.utility.Vector3dVector(normals)
+    ref = cloud.voxel_down_sample(0.01)
+    ref = np.concatenate([np.asarray(ref.points), np.asarray(ref.normals)], axis=1)
+
+    pts_down, normals_down = Utils.voxel_downsample(torch.as_tensor(pts) if as_tensor else pts, 0.01, normals=normals)
+    assert torch.is_tensor(pts_down) == as_tensor
+    out = np.concatenate([np.asarray(pts_down), np.asarray(normals_down)], axis=1)
+    order, order_ref = np.lexsort(out[:, :3].T), np.lexsort(ref[:, :3].T)   # Same voxels in another order
+    np.testing.assert_allclose(out[order], ref[order_ref], atol=1e-12)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+trimesh = pytest.importorskip("trimesh")
+Utils = pytest.importorskip("Utils")
+run_benchmark = pytest.importorskip("run_benchmark")
+
+CROP_SIZE = (64, 64)
+
+
+@pytest.fixture(scope="module")
+def dense_mesh():
+    rng = np.random.default_rng(0)
+    mesh = trimesh.creation.icosphere(subdivisions=5, radius=0.05)   # 20480 faces
+    mesh.vertices *= np.array([1, 0.7, 0.5])
+    mesh.visual.vertex_colors = np.tile(rng.integers(0, 255, (1, 4), dtype=np.uint8), (len(mesh.vertices), 1))
+    return mesh
+
+
+def test_mesh_lod_renders_match_full_mesh(dense_mesh):
+    pytest.importorskip("open3d")
+    mesh_tensors = Utils.make_mesh_tensors(dense_mesh, device="cpu")
+    lods = Utils.make_mesh_lods(dense_mesh, face_budgets=(30000, 8000, 2000), device="cpu")
+    assert [len(lod["faces"]) for lod in lods] == pytest.approx([2000, 8000], rel=0.05)   # The level above the mesh face count is skipped
+
+    K, H, W, poses, bbox2d = run_benchmark.make_crop_hypotheses(dense_mesh, "cpu", n_hypo=16, crop_size=CROP_SIZE)
+    diameter = Utils.compute_mesh_diameter(model_pts=dense_mesh.vertices, n_sample=1000)
+    glctx = Utils.CpuRasterizeContext()
+    _, depth_ref, _ = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=CROP_SIZE, bbox2d=bbox2d)
+    for lod, min_iou, max_depth_err in zip(lods, [0.99, 0.998], [0.004, 0.001]):
+        _, depth, _ = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=lod, output_size=CROP_SIZE, bbox2d=bbox2d)
+        mask, mask_ref = depth > 0, depth_ref > 0
+        both = mask & mask_ref
+        iou = (both.sum() / (mask | mask_ref).sum()).item()
+        depth_err = (depth - depth_ref).abs()[both].mean().item() / diameter
+        assert iou >= min_iou, (len(lod["faces"]), iou)
+        assert depth_err <= max_depth_err, (len(lod["faces"]), depth_err)
+
+
+def test_estimator_builds_no_lods_by_default(make_estimator):
+    assert "lods" not in make_estimator().mesh_tensors
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from conftest import make_network
+
+torch = pytest.importorskip("torch")
+model_backend = pytest.importorskip("learning.models.model_backend")
+
+requires_onnx = pytest.mark.skipif(model_backend.ort is None, reason="needs onnxruntime")
+
+C_IN = 6
+INPUT_RESIZE = (32, 32)
+L = 3
+
+
+def make_model(kind, use_BN, tmp_path):
+    return make_network(kind, tmp_path, use_BN=use_BN, c_in=C_IN, input_resize=INPUT_RESIZE)
+
+
+def make_inputs(n, seed=1):
+    gen = torch.Generator().manual_seed(seed)
+    return torch.rand((n, C_IN, *INPUT_RESIZE), generator=gen), torch.rand((n, C_IN, *INPUT_RESIZE), generator=gen)
+
+
+def run(model, kind, A, B, B_ids=None):
+    with torch.inference_mode():
+        if kind == "refine":
+            out = model(A, B, B_ids=B_ids)
+            return torch.cat([out["trans"], out["rot"]], dim=1)
+        return model(A, B, L=L, B_ids=B_ids)["score_logit"]
+
+
+@pytest.mark.parametrize("kind", ["refine", "score"])
+@pytest.mark.parametrize("use_BN", [False, True])
+@pytest.mark.parametrize("backend", [pytest.param("onnx", marks=requires_onnx), "compiled"])
+def test_backend_matches_eager(kind, use_BN, backend, tmp_path):
+    model, cfg, ckpt_dir = make_model(kind, use_BN, tmp_path)
+    wrapped = model_backend.make_model_backend(model, kind=kind, cfg=cfg, ckpt_dir=ckpt_dir, backend=backend, device="cpu")
+    for n in [L, 4 * L]:   # Batch sizes other than the one exported with
+        A, B = make_inputs(n)
+        torch.testing.assert_close(run(wrapped, kind, A, B), run(model, kind, A, B), atol=1e-4, rtol=1e-4)
+    # The cached artifact is picked up instead of being redone
+    cached = model_backend.make_model_backend(model, kind=kind, cfg=cfg, ckpt_dir=ckpt_dir, backend=backend, device="cpu")
+    torch.testing.assert_close(run(cached, kind, A, B), run(model, kind, A, B), atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("kind", ["refine", "score"])
+@pytest.mark.parametrize("backend", ["torch", pytest.param("onnx", marks=requires_onnx), "compiled"])
+def test_shared_crops_match_unshared(kind, backend, tmp_path):
+    model, cfg, ckpt_dir = make_model(kind, True, tmp_path)
+    wrapped = model_backend.make_model_backend(model, kind=kind, cfg=cfg, ckpt_dir=ckpt_dir, backend=backend, device="cpu")
+    # The graphs take B_ids themselves, so each distinct crop is encoded once instead of being expanded before the call
+    if backend == "onnx":
+        assert [x.name for x in wrapped.session.get_inputs()] == ["A", "B", "B_ids"]
+        assert wrapped.onnx_file.endswith(f"_v{model_backend.EXPORT_VERSION}.onnx")
+    elif backend == "compiled":
+        assert len(list(wrapped.module.graph.inputs())) == 4   # self, A, B, B_ids
+    A, crops = make_inputs(4 * L)
+    for n_crops in [1, 3]:
+        B_ids = torch.randint(0, n_crops, (len(A),), generator=torch.Generator().manual_seed(n_crops))
+        unshared = run(wrapped, kind, A, crops[:n_crops][B_ids])
+        torch.testing.assert_close(run(wrapped, kind, A, crops[:n_crops], B_ids=B_ids), unshared, atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(unshared, run(model, kind, A, crops[:n_crops][B_ids]), atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("kind", ["refine", "score"])
+def test_int8_backend_tracks_eager(kind, tmp_path):
+    model, cfg, ckpt_dir = make_model(kind, False, tmp_path)
+    base = ckpt_dir.rsplit(".", 1)[0]
+    with pytest.raises(RuntimeError, match="calibration"):
+        model_backend.make_model_backend(model, kind=kind, cfg=cfg, ckpt_dir=ckpt_dir, backend="int8")
+    torch.save([make_inputs(4 * L, seed=s) for s in range(4)], f"{base}_calib.pth")
+
+    A, B = make_inputs(4 * L, seed=10)
+    ref = run(model, kind, A, B)
+    for _ in range(2):   # Quantized from the calibration data, then reloaded from the cached state dict
+        out = run(model_backend.make_model_backend(model, kind=kind, cfg=cfg, ckpt_dir=ckpt_dir, backend="int8"), kind, A, B)
+        assert out.shape == ref.shape
+        err = (out - ref).abs().mean() / ref.abs().mean()
+        assert err < 0.05, err   # About 1% with random weights
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+trimesh = pytest.importorskip("trimesh")
+Utils = pytest.importorskip("Utils")
+run_benchmark = pytest.importorskip("run_benchmark")
+
+CROP_SIZE = (64, 64)
+
+
+@pytest.fixture(scope="module")
+def rasterizer_inputs():
+    """Clip space vertices, faces and resolution that nvdiffrast_render hands the rasterizer for the hypothesis crops of a bumpy sphere"""
+    rng = np.random.default_rng(0)
+    mesh = trimesh.creation.icosphere(subdivisions=3, radius=0.05)
+    mesh.vertices *= 1 + 0.15 * rng.random((len(mesh.vertices), 1))   # Uneven triangles, some of them nearly edge on
+    mesh.visual.vertex_colors = rng.integers(0, 255, (len(mesh.vertices), 4), dtype=np.uint8)
+    K, H, W, poses, bbox2d = run_benchmark.make_crop_hypotheses(mesh, "cpu", n_hypo=16, crop_size=CROP_SIZE)
+    calls = []
+
+    def spy(glctx, pos, tri, resolution):
+        calls.append((pos, tri, resolution))
+        return rasterize_cpu(glctx, pos, tri, resolution)
+
+    rasterize_cpu = Utils.rasterize_cpu
+    Utils.rasterize_cpu = spy
+    try:
+        Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=Utils.CpuRasterizeContext(tiled=False), mesh_tensors=Utils.make_mesh_tensors(mesh, device="cpu"), output_size=CROP_SIZE, bbox2d=bbox2d)
+    finally:
+        Utils.rasterize_cpu = rasterize_cpu
+    assert len(calls) == 1
+    return calls[0]
+
+
+@pytest.mark.parametrize("tile_size,num_threads", [(32, None), (8, 1), (16, 4)])
+def test_tiled_rasterizer_matches_reference(rasterizer_inputs, tile_size, num_threads):
+    pos, tri, resolution = rasterizer_inputs
+    ref, _ = Utils.rasterize_cpu(None, pos, tri, resolution)
+    out, _ = Utils.rasterize_cpu_tiled(Utils.CpuRasterizeContext(tile_size=tile_size, num_threads=num_threads), pos, tri, resolution)
+    assert out.shape == ref.shape
+
+    tri_id, tri_id_ref = out[..., 3], ref[..., 3]
+    assert (tri_id_ref > 0).float().mean() > 0.2   # The object covers a good part of every crop
+    same = tri_id == tri_id_ref
+    assert same.float().mean() >= 0.999, f"{(~same).sum().item()} pixels hit another triangle"   # Only ties on shared edges may differ
+    torch.testing.assert_close(out[same][:, :3], ref[same][:, :3], atol=1e-5, rtol=0)   # Barycentrics and depth
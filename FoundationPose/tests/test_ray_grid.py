@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+H, W = 48, 64
+
+
+def make_depth(seed=0):
+    rng = np.random.default_rng(seed)
+    depth = rng.uniform(0.3, 1.5, (H, W)).astype(np.float32)
+    depth[rng.random((H, W)) < 0.1] = 0
+    K = np.array([[300, 0, 31.5], [0, 310, 24.25], [0, 0, 1]], dtype=float)
+    return depth, K
+
+
+def unproject(depth, K):
+    """Per pixel pinhole back-projection, as depth2xyzmap computed it with a meshgrid"""
+    vs, us = np.meshgrid(np.arange(depth.shape[0]), np.arange(depth.shape[1]), indexing="ij")
+    xyz = np.stack([(us - K[0, 2]) * depth / K[0, 0], (vs - K[1, 2]) * depth / K[1, 1], depth], axis=-1)
+    xyz[depth < 0.001] = 0
+    return xyz
+
+
+def test_depth2xyzmap_matches_the_pinhole_model():
+    depth, K = make_depth()
+    xyz = Utils.depth2xyzmap(depth, K)
+    assert xyz.dtype == np.float32
+    np.testing.assert_allclose(xyz, unproject(depth, K), atol=1e-6)
+
+
+def test_depth2xyzmap_batch_with_per_sample_and_shared_rays():
+    depth, K = make_depth()
+    depths = torch.as_tensor(np.stack([depth, make_depth(seed=1)[0]]))
+    Ks = torch.as_tensor(np.stack([K, K * [[0.5], [0.5], [1]]]), dtype=torch.float)
+    xyz = Utils.depth2xyzmap_batch(depths, Ks, zfar=1.4)
+    for i in range(2):
+        ref = unproject(depths[i].numpy(), Ks[i].numpy().astype(float))
+        ref[depths[i].numpy() > 1.4] = 0
+        np.testing.assert_allclose(xyz[i].numpy(), ref, atol=1e-6)
+    rays = Utils.get_ray_grid(H, W, K, device="cpu")
+    torch.testing.assert_close(Utils.depth2xyzmap_batch(depths[:1], None, zfar=np.inf, rays=rays)[0], torch.as_tensor(unproject(depth, K), dtype=torch.float), atol=1e-6, rtol=0)
+
+
+def test_get_ray_grid_is_cached_per_camera_and_device():
+    _, K = make_depth()
+    rays = Utils.get_ray_grid(H, W, K)
+    assert isinstance(rays, np.ndarray) and rays.shape == (H, W, 3)
+    assert Utils.get_ray_grid(H, W, K.copy()) is rays
+    assert Utils.get_ray_grid(H, W, torch.as_tensor(K)) is rays
+    assert torch.is_tensor(Utils.get_ray_grid(H, W, K, device="cpu"))
+    K2 = K.copy()
+    K2[0, 2] += 1
+    assert Utils.get_ray_grid(H, W, K2) is not rays
+    for i in range(8):   # Evicted once max_entries other cameras were used
+        Utils.get_ray_grid(H, W + i + 1, K)
+    assert Utils.get_ray_grid(H, W, K) is not rays
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from conftest import make_scene
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+class PoseScorer:
+    """Stands in for ScorePredictor with a fixed random linear score of each pose, so every frame has one clear best hypothesis"""
+
+    def __init__(self, crop_ratio=1.2, input_resize=(160, 160)):
+        self.cfg = {"crop_ratio": crop_ratio, "input_resize": input_resize}
+        self.weights = torch.as_tensor(np.random.default_rng(0).normal(size=(4, 4)), dtype=torch.float)
+
+    def predict(self, ob_in_cams, get_vis=False, **kwargs):
+        return (ob_in_cams.reshape(-1, 4, 4) * self.weights.to(ob_in_cams.device)).sum(dim=(1, 2)), None
+
+
+def make_frames():
+    """Frames at different depths and mask positions, the third one without valid depth"""
+    frames = []
+    for z, shift in [(0.4, 0), (0.6, 10), (0.5, -8), (0.5, 20)]:
+        K, rgb, depth, mask = make_scene(z=z)
+        frames.append((rgb, depth, np.roll(mask, shift, axis=1)))
+    frames[2] = (frames[2][0], np.zeros_like(frames[2][1]), frames[2][2])
+    return K, frames
+
+
+def test_register_batch_matches_register_per_frame(make_estimator):
+    K, frames = make_frames()
+    est = make_estimator(scorer=PoseScorer())
+    rgbs, depths, masks = map(list, zip(*frames))
+    poses = est.register_batch(K=K, rgbs=rgbs, depths=depths, ob_masks=masks, iteration=1)
+
+    assert len(est.refiner.calls) == 1   # All frames refined in one batch
+    assert len(est.refiner.calls[0]) == 3 * len(est.rot_grid)
+    assert len(poses) == len(frames)
+    for pose, (rgb, depth, mask) in zip(poses, frames):
+        np.testing.assert_allclose(pose, est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1), atol=1e-6)
+
+
+def test_warp_perspective_frames_crops_each_pose_from_its_frame():
+    kornia = pytest.importorskip("kornia")
+    run_benchmark = pytest.importorskip("run_benchmark")
+    rng = np.random.default_rng(0)
+    imgs = torch.as_tensor(rng.random((3, 2, 24, 32)), dtype=torch.float)
+    tfs = torch.eye(3)[None].repeat(5, 1, 1)
+    tfs[:, :2, 2] = torch.as_tensor(rng.uniform(-8, 8, (5, 2)), dtype=torch.float)
+    frame_ids = np.array([2, 0, 2, 1, 0])
+    crops = run_benchmark.warp_perspective_frames(imgs, tfs, dsize=(16, 16), mode="bilinear", frame_ids=frame_ids)
+    for i, f in enumerate(frame_ids):
+        ref = kornia.geometry.transform.warp_perspective(imgs[f:f + 1], tfs[i:i + 1], dsize=(16, 16), mode="bilinear", align_corners=False)
+        torch.testing.assert_close(crops[i:i + 1], ref)
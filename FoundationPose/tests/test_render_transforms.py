@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from conftest import make_scene, requires_cuda
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+@pytest.mark.parametrize("D", [3, 4])
+def test_transform_pts_batch_matches_transform_pts(D):
+    rng = np.random.default_rng(0)
+    pts = torch.as_tensor(rng.normal(size=(50, 3)), dtype=torch.float)
+    tfs = torch.eye(4)[None].repeat(6, 1, 1)
+    tfs[:, :3, :3] = torch.as_tensor(np.array([Utils.random_rotation_matrix(rng.random(3))[:3, :3] for _ in range(6)]), dtype=torch.float)
+    tfs[:, :3, 3] = torch.as_tensor(rng.normal(size=(6, 3)), dtype=torch.float)
+    if D == 4:
+        tfs[:, 3] = torch.as_tensor(rng.normal(size=(6, 4)), dtype=torch.float)   # Projective last row
+    ref = (tfs[:, None] @ Utils.to_homo_torch(pts)[None, ..., None])[..., :D, 0]
+    torch.testing.assert_close(Utils.transform_pts_batch(pts, tfs[:, :D]), ref, atol=1e-5, rtol=1e-5)
+
+
+def test_render_crop_windows_per_hypothesis(box_mesh):
+    """Two renders of the same pose, the second crop window shifted by a whole number of pixels, give the same crop shifted back"""
+    K, _, depth, _ = make_scene()
+    H, W = depth.shape
+    shift = 10
+    poses = torch.eye(4)[None].repeat(2, 1, 1)
+    poses[:, 2, 3] = 0.5
+    bbox2d = torch.tensor([[W / 2 - 40, H / 2 - 30, W / 2 + 40, H / 2 + 30]], dtype=torch.float).repeat(2, 1)
+    bbox2d[1, [0, 2]] += shift
+    extra = {}
+    color, depth, normal = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=Utils.CpuRasterizeContext(), mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cpu"), bbox2d=bbox2d, output_size=(60, 80), get_normal=True, extra=extra)
+    mask = depth > 0
+    assert mask[0].sum() > 0 and not mask[0, :, -shift:].any()
+    torch.testing.assert_close(depth[1, :, :-shift], depth[0, :, shift:])
+    torch.testing.assert_close(extra["xyz_map"][1, :, :-shift], extra["xyz_map"][0, :, shift:])
+
+    z_front = 0.5 - 0.02
+    vs, us = torch.nonzero(mask[0], as_tuple=True)
+    half_w, half_h = K[0, 0] * 0.05 / z_front, K[1, 1] * 0.03 / z_front   # Crop pixels are image pixels here
+    assert abs(us.min().item() + 0.5 - (40 - half_w)) <= 1 and abs(us.max().item() + 0.5 - (40 + half_w)) <= 1   # Pixel centers
+    assert abs(vs.min().item() + 0.5 - (30 - half_h)) <= 1 and abs(vs.max().item() + 0.5 - (30 + half_h)) <= 1
+    torch.testing.assert_close(normal[1, :, :-shift], normal[0, :, shift:])
+
+
+def test_render_rotates_normals_with_the_pose(box_mesh):
+    """Rendering the mesh under a rotated pose gives the normals of the mesh rotated beforehand and rendered at identity"""
+    K, _, depth, _ = make_scene()
+    H, W = depth.shape
+    R = torch.as_tensor(Utils.euler_matrix(0.3, -0.4, 0.5)[:3, :3], dtype=torch.float)
+    pose = torch.eye(4)[None]
+    pose[0, :3, :3] = R
+    pose[0, 2, 3] = 0.5
+    mesh_tensors = Utils.make_mesh_tensors(box_mesh, device="cpu")
+    rotated = dict(mesh_tensors, pos=mesh_tensors["pos"] @ R.T, vnormals=mesh_tensors["vnormals"] @ R.T)
+    shifted = torch.eye(4)[None]
+    shifted[0, 2, 3] = 0.5
+    glctx = Utils.CpuRasterizeContext()
+    _, depth, normal = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=pose, glctx=glctx, mesh_tensors=mesh_tensors, get_normal=True)
+    _, depth_ref, normal_ref = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=shifted, glctx=glctx, mesh_tensors=rotated, get_normal=True)
+    mask = (depth > 0) & (depth_ref > 0)
+    assert mask.sum() > 0.99 * (depth_ref > 0).sum()
+    torch.testing.assert_close(normal[mask], normal_ref[mask], atol=1e-4, rtol=0)
+
+
+@requires_cuda
+def test_render_reports_peak_memory(box_mesh):
+    K, _, depth, _ = make_scene()
+    H, W = depth.shape
+    poses = torch.eye(4, device="cuda")[None].repeat(8, 1, 1)
+    poses[:, 2, 3] = 0.5
+    extra = {}
+    Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cuda"), extra=extra, track_memory=True)
+    assert extra["peak_memory_mb"] > 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+def cluster_poses_loop(angle_diff, dist_diff, poses, symmetry_tfs):
+    """Direct port of the mycpp.cluster_poses loop"""
+    kept = [poses[0]]
+    for pose in poses[1:]:
+        is_new = True
+        for cluster in kept:
+            if np.linalg.norm(pose[:3, 3] - cluster[:3, 3]) >= dist_diff:
+                continue
+            for tf in symmetry_tfs:
+                cos = (np.trace(pose[:3, :3] @ tf[:3, :3] @ cluster[:3, :3].T) - 1) / 2
+                if np.degrees(np.arccos(np.clip(cos, -1, 1))) < angle_diff:
+                    is_new = False
+                    break
+            if not is_new:
+                break
+        if is_new:
+            kept.append(pose)
+    return np.asarray(kept)
+
+
+def z_rotations(n):
+    return np.stack([Utils.euler_matrix(0, 0, a) for a in np.linspace(0, 2 * np.pi, n, endpoint=False)])
+
+
+@pytest.mark.parametrize("symmetry_tfs, n_kept", [
+    (np.eye(4)[None], 252),
+    (z_rotations(2), 126),
+    (z_rotations(36), 20),
+])
+def test_rotation_grid_matches_the_cpp_clustering(symmetry_tfs, n_kept):
+    cam_in_obs = Utils.sample_views_icosphere(n_views=40)
+    poses = np.stack([np.linalg.inv(cam_in_ob @ Utils.euler_matrix(0, 0, a)) for cam_in_ob in cam_in_obs for a in np.deg2rad(np.arange(0, 360, 60))])
+    ref = cluster_poses_loop(30, 99999, poses, symmetry_tfs)
+    rot_grid = Utils.make_rotation_grid(symmetry_tfs=symmetry_tfs)
+    assert len(rot_grid) == len(ref) == n_kept
+    np.testing.assert_allclose(rot_grid, ref, atol=1e-6)
+
+
+def test_cluster_poses_keeps_far_apart_poses():
+    poses = np.tile(np.eye(4), (3, 1, 1))
+    poses[1, :3, 3] = [0.1, 0, 0]   # Same rotation, too far away
+    poses[2, :3, 3] = [0.001, 0, 0]
+    np.testing.assert_allclose(Utils.cluster_poses(30, 0.01, poses, np.eye(4)[None]), poses[:2])
+
+
+def test_rotation_grid_is_cached_per_symmetry_class(make_estimator):
+    grid = Utils.make_rotation_grid(symmetry_tfs=z_rotations(2))
+    assert Utils.make_rotation_grid(symmetry_tfs=z_rotations(2)) is grid
+    assert Utils.make_rotation_grid(symmetry_tfs=z_rotations(4)) is not grid
+    expected = grid.copy()
+    est = make_estimator(symmetry_tfs=z_rotations(2))
+    torch.testing.assert_close(est.rot_grid, torch.as_tensor(expected, dtype=torch.float))
+    est.rot_grid[:] = 0   # The estimator owns a copy
+    np.testing.assert_array_equal(Utils.make_rotation_grid(symmetry_tfs=z_rotations(2)), expected)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from conftest import make_scene, make_score_predictor, requires_cuda
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+model_backend = pytest.importorskip("learning.models.model_backend")
+
+N_POSE = 12
+CHUNK_MEMORY_MB = 1.8   # 4 hypotheses of 32x32 crops per chunk, see ScorePredictor.get_chunk_size
+
+
+def make_inputs(box_mesh, n_frame=1, seed=0):
+    rng = np.random.default_rng(seed)
+    K, rgb, depth, _ = make_scene()
+    rgb = rgb + rng.integers(0, 60, rgb.shape, dtype=np.uint8)   # So the real image crops differ
+    poses = np.tile(np.eye(4, dtype=np.float32), (N_POSE, 1, 1))
+    poses[:, :3, :3] = [Utils.random_rotation_matrix(rng.random(3))[:3, :3] for _ in range(N_POSE)]
+    poses[:, :3, 3] = rng.normal([0, 0, 0.5], 0.01, (N_POSE, 3))
+    kwargs = dict(K=K, ob_in_cams=poses, mesh=box_mesh, mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cpu"), glctx=Utils.CpuRasterizeContext(), mesh_diameter=0.125)
+    if n_frame > 1:
+        rgb, depth = np.stack([rgb] * n_frame), np.stack([depth] * n_frame)
+        kwargs["frame_ids"] = np.repeat(np.arange(n_frame), N_POSE // n_frame)
+    return dict(rgb=rgb, depth=depth, **kwargs)
+
+
+@pytest.mark.parametrize("n_frame", [1, 2])
+def test_chunked_scores_and_vis_match_one_shot(box_mesh, tmp_path, n_frame):
+    inputs = make_inputs(box_mesh, n_frame=n_frame)
+    scorer = make_score_predictor(tmp_path)
+    assert scorer.get_chunk_size() == np.inf
+    scores, vis = scorer.predict(get_vis=True, **inputs)
+
+    scorer.max_memory_mb = CHUNK_MEMORY_MB
+    assert 1 < scorer.get_chunk_size() < N_POSE
+    calls = []
+    predict_chunked = scorer.predict_chunked
+    scorer.predict_chunked = lambda *args, **kwargs: calls.append(kwargs["get_vis"]) or predict_chunked(*args, **kwargs)
+    chunked_scores, chunked_vis = scorer.predict(get_vis=True, **inputs)
+    assert calls == [True]
+    torch.testing.assert_close(chunked_scores, scores, atol=1e-4, rtol=1e-5)
+    np.testing.assert_array_equal(chunked_vis(), vis())
+
+    chunked_scores, chunked_vis = scorer.predict(get_vis=False, **inputs)
+    torch.testing.assert_close(chunked_scores, scores, atol=1e-4, rtol=1e-5)
+    assert chunked_vis is None and calls == [True, False]
+
+
+@pytest.mark.skipif(model_backend.ort is None, reason="needs onnxruntime")
+def test_backend_without_score_feats_scores_in_one_shot(box_mesh, tmp_path):
+    inputs = make_inputs(box_mesh)
+    scorer = make_score_predictor(tmp_path, backend="onnx", max_memory_mb=CHUNK_MEMORY_MB)
+    assert not hasattr(scorer.model, "score_feats") and scorer.get_chunk_size() == np.inf
+    scores, vis = scorer.predict(get_vis=True, **inputs)
+
+    reference = make_score_predictor(tmp_path)
+    torch.testing.assert_close(scores, reference.predict(**inputs)[0], atol=1e-4, rtol=1e-5)
+    assert vis().shape[0] > 0
+
+
+@requires_cuda
+def test_chunked_peak_memory_stays_under_the_cap(box_mesh, tmp_path):
+    inputs = make_inputs(box_mesh)
+    inputs.update(rgb=torch.as_tensor(inputs["rgb"], device="cuda", dtype=torch.float), depth=torch.as_tensor(inputs["depth"], device="cuda", dtype=torch.float), mesh_tensors=Utils.make_mesh_tensors(box_mesh, device="cuda"), glctx=None)
+    inputs["ob_in_cams"] = np.concatenate([inputs["ob_in_cams"]] * 8)
+    scorer = make_score_predictor(tmp_path, max_memory_mb=4, device="cuda")
+    scorer.predict(**inputs)   # Warm up, measures the per hypothesis footprint and sizes the crop buffers
+    assert 1 < scorer.get_chunk_size() < len(inputs["ob_in_cams"])
+
+    torch.cuda.synchronize()
+    base = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    scorer.predict(**inputs)
+    torch.cuda.synchronize()
+    assert torch.cuda.max_memory_allocated() - base <= scorer.max_memory_mb * 1024**2
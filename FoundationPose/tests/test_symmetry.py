@@ -0,0 +1,233 @@
+import base64
+import importlib
+import logging
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from conftest import IdentityRefiner
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+def test_symmetry_tfs_from_info_discrete_in_mm():
+    tf = Utils.euler_matrix(0, 0, np.pi)
+    tf[:3, 3] = [0, 0, 20]
+    symmetry_tfs = Utils.symmetry_tfs_from_info({"symmetries_discrete": [tf.reshape(-1).tolist()]})
+    assert symmetry_tfs.shape == (2, 4, 4)
+    np.testing.assert_allclose(symmetry_tfs[0], np.eye(4))
+    np.testing.assert_allclose(symmetry_tfs[1, :3, :3], tf[:3, :3])
+    np.testing.assert_allclose(symmetry_tfs[1, :3, 3], [0, 0, 0.02])
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_symmetry_tfs_from_info_continuous(axis):
+    info = {"symmetries_continuous": [{"axis": np.eye(3)[axis].tolist(), "offset": [0, 0, 0]}]}
+    symmetry_tfs = Utils.symmetry_tfs_from_info(info, rot_angle_discrete=30)
+    assert symmetry_tfs.shape == (1 + 12, 4, 4)
+    R = symmetry_tfs[:, :3, :3]
+    np.testing.assert_allclose(R[:, :, axis], np.tile(np.eye(3)[axis], (13, 1)), atol=1e-12)   # Rotations about the axis
+    angles = np.degrees(np.arccos(np.clip((np.trace(R[1:], axis1=1, axis2=2) - 1) / 2, -1, 1)))
+    np.testing.assert_allclose(np.sort(angles), np.sort(np.minimum(np.arange(0, 360, 30), 360 - np.arange(0, 360, 30))), atol=1e-6)
+
+
+def test_symmetry_tfs_from_info_without_symmetries_is_identity():
+    np.testing.assert_allclose(Utils.symmetry_tfs_from_info({}), np.eye(4)[None])
+
+
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_cluster_pose_ids_keeps_one_pose_per_symmetric_group(as_tensor):
+    rng = np.random.default_rng(0)
+    flip = Utils.euler_matrix(0, 0, np.pi)
+    poses = np.tile(np.eye(4), (6, 1, 1))
+    poses[0, :3, :3] = Utils.random_rotation_matrix(rng.random(3))[:3, :3]
+    poses[1] = poses[0] @ flip   # Same pose under the flip
+    poses[2, :3, :3] = poses[0, :3, :3] @ Utils.euler_matrix(0, 0, np.radians(2))[:3, :3]   # Within the angle threshold
+    poses[3] = poses[0] @ Utils.euler_matrix(np.pi / 2, 0, 0)   # Not a symmetry
+    poses[4] = poses[0].copy()
+    poses[4, :3, 3] = [0.1, 0, 0]   # Same rotation, too far away
+    poses[5] = poses[3] @ flip
+    poses[:, :3, 3] += [0, 0, 0.5]
+    symmetry_tfs = np.stack([np.eye(4), flip])
+    if as_tensor:
+        poses, symmetry_tfs = torch.as_tensor(poses, dtype=torch.float), torch.as_tensor(symmetry_tfs, dtype=torch.float)
+
+    keep = Utils.cluster_pose_ids(5, 0.01, poses, symmetry_tfs)
+    np.testing.assert_array_equal(np.asarray(keep), [True, False, False, True, True, False])
+    keep = Utils.cluster_pose_ids(5, 0.01, poses, symmetry_tfs[:1])
+    np.testing.assert_array_equal(np.asarray(keep), [True, True, False, True, True, True])
+
+
+def test_collapse_symmetric_poses_logs_at_debug(make_estimator, caplog):
+    est = make_estimator(symmetry_tfs=np.stack([np.eye(4), Utils.euler_matrix(0, 0, np.pi)]))
+    poses = torch.eye(4)[None].repeat(4, 1, 1)
+    poses[:, 2, 3] = 0.5
+    with caplog.at_level(logging.INFO):
+        kept = est.collapse_symmetric_poses(poses)
+    assert len(kept) == 1
+    assert not [r for r in caplog.records if "collapsed" in r.getMessage()]
+
+
+def test_collapse_symmetric_poses_per_frame_pads_with_the_first_kept_pose(make_estimator):
+    flip = Utils.euler_matrix(0, 0, np.pi)
+    est = make_estimator(symmetry_tfs=np.stack([np.eye(4), flip]))
+    turn_x, turn_y = Utils.euler_matrix(np.pi / 2, 0, 0), Utils.euler_matrix(0, np.pi / 2, 0)
+    poses = np.stack([[np.eye(4), flip, turn_x], [turn_x, np.eye(4), turn_y]])
+    poses[..., 2, 3] = 0.5
+    kept = est.collapse_symmetric_poses(torch.as_tensor(poses, dtype=torch.float))
+    assert kept.shape == (2, 3, 4, 4)
+    np.testing.assert_allclose(kept[0].numpy(), poses[0][[0, 2, 0]], atol=1e-6)
+    np.testing.assert_allclose(kept[1].numpy(), poses[1], atol=1e-6)
+
+
+def test_register_batch_collapses_symmetric_poses_like_register(make_estimator):
+    from test_register_batch import PoseScorer, make_frames
+
+    class CountingScorer(PoseScorer):
+        def predict(self, ob_in_cams, get_vis=False, **kwargs):
+            self.calls.append(len(ob_in_cams))
+            return super().predict(ob_in_cams, get_vis=get_vis, **kwargs)
+
+    class SnappingRefiner(IdentityRefiner):
+        """Every hypothesis converges to the identity rotation or its flip, so each frame ends with one pose up to symmetry"""
+        def predict(self, ob_in_cams, get_vis=False, **kwargs):
+            poses, _ = super().predict(ob_in_cams)
+            poses[:, :3, :3] = torch.where(poses[:, :1, :1] > 0, torch.eye(3), torch.diag(torch.tensor([-1.0, -1.0, 1.0])))
+            return poses, None
+
+    K, frames = make_frames()
+    scorer = CountingScorer()
+    scorer.calls = []
+    est = make_estimator(symmetry_tfs=np.stack([np.eye(4), Utils.euler_matrix(0, 0, np.pi)]), refiner=SnappingRefiner(), scorer=scorer)
+    rgbs, depths, masks = map(list, zip(*frames))
+    poses = est.register_batch(K=K, rgbs=rgbs, depths=depths, ob_masks=masks, iteration=1)
+    assert scorer.calls == [3]   # One pose per frame
+    for pose, (rgb, depth, mask) in zip(poses, frames):
+        np.testing.assert_allclose(pose, est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1), atol=1e-6)
+
+
+
+def colored(mesh, color=(200, 80, 40)):
+    mesh.visual.vertex_colors = np.tile(np.array([[*color, 255]], dtype=np.uint8), (len(mesh.vertices), 1))
+    return mesh
+
+
+def group_is_closed(symmetry_tfs):
+    products = (symmetry_tfs[:, None] @ symmetry_tfs[None])[..., :3, :3].reshape(-1, 1, 9)
+    return np.abs(products - symmetry_tfs[None, :, :3, :3].reshape(1, -1, 9)).max(axis=-1).min(axis=-1).max() < 1e-3
+
+
+@pytest.mark.parametrize("make_mesh, n_tfs", [
+    (lambda trimesh: trimesh.creation.cylinder(radius=0.03, height=0.1, sections=64), 144),
+    (lambda trimesh: trimesh.creation.cone(radius=0.03, height=0.1, sections=64), 72),
+    (lambda trimesh: trimesh.creation.box(extents=(0.1, 0.06, 0.04)), 4),
+    (lambda trimesh: trimesh.creation.box(extents=(0.05, 0.05, 0.05)), 24),
+    (lambda trimesh: trimesh.creation.box(extents=(0.05, 0.05, 0.1)), 8),
+    (lambda trimesh: trimesh.creation.cylinder(radius=0.03, height=0.1, sections=8), 16),
+    (lambda trimesh: trimesh.creation.cylinder(radius=0.03, height=0.1, sections=64).apply_scale([1, 0.97, 1]), 4),   # 3% elliptical, not a surface of revolution
+    (lambda trimesh: trimesh.creation.cylinder(radius=0.03, height=0.1, sections=6).apply_transform(Utils.euler_matrix(0.3, 0.7, -0.2)), 12),
+    (lambda trimesh: trimesh.util.concatenate([trimesh.creation.box(extents=(0.1, 0.06, 0.04)), trimesh.creation.box(extents=(0.02, 0.02, 0.02)).apply_translation([0.03, 0.02, 0.03])]), 1),
+    (lambda trimesh: trimesh.convex.convex_hull(np.random.default_rng(0).normal(size=(30, 3)) * 0.05), 1),
+])
+def test_detect_symmetry_tfs_on_primitives(make_mesh, n_tfs):
+    trimesh = pytest.importorskip("trimesh")
+    mesh = colored(make_mesh(trimesh))
+    symmetry_tfs = Utils.detect_symmetry_tfs(mesh)
+    assert len(symmetry_tfs) == n_tfs
+    np.testing.assert_allclose(symmetry_tfs[0], np.eye(4))
+    assert group_is_closed(symmetry_tfs)
+    pts = np.asarray(mesh.vertices)
+    center = Utils.mesh_surface_moments(mesh)[0]
+    np.testing.assert_allclose(pts[:5] @ symmetry_tfs[:, :3, :3].transpose(0, 2, 1) + symmetry_tfs[:, None, :3, 3] - center, (pts[:5] - center) @ symmetry_tfs[:, :3, :3].transpose(0, 2, 1), atol=1e-6)   # Rotations about the centroid
+
+
+def test_detect_symmetry_tfs_checks_colors():
+    trimesh = pytest.importorskip("trimesh")
+    mesh = trimesh.creation.box(extents=(0.1, 0.05, 0.04))
+    mesh.visual.vertex_colors = np.where(mesh.vertices[:, :1] > 0, [[200, 80, 40, 255]], [[40, 80, 200, 255]]).astype(np.uint8)
+    symmetry_tfs = Utils.detect_symmetry_tfs(mesh)
+    assert len(symmetry_tfs) == 2
+    np.testing.assert_allclose(symmetry_tfs[1, :3, 0], [1, 0, 0], atol=1e-6)   # The half turn about x keeps the colors
+
+
+def test_detect_symmetry_tfs_is_cached_per_mesh():
+    trimesh = pytest.importorskip("trimesh")
+    mesh = colored(trimesh.creation.box(extents=(0.1, 0.06, 0.04)))
+    symmetry_tfs = Utils.detect_symmetry_tfs(mesh)
+    assert Utils.detect_symmetry_tfs(mesh.copy()) is symmetry_tfs
+    assert Utils.detect_symmetry_tfs(colored(trimesh.creation.box(extents=(0.05, 0.05, 0.05)))) is not symmetry_tfs
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """pose_api_server with run_pose_estimation replaced by a stub that records symmetry_info and writes an identity pose"""
+    pytest.importorskip("flask")
+    trimesh = pytest.importorskip("trimesh")
+    calls = []
+
+    def run_pose_estimation(test_scene_dir, mesh_file, debug_dir, symmetry_info=None):
+        calls.append(symmetry_info)
+        os.makedirs(f"{debug_dir}/ob_in_cam", exist_ok=True)
+        np.savetxt(f"{debug_dir}/ob_in_cam/000000.txt", np.eye(4))
+
+    monkeypatch.setenv("DIR", str(tmp_path))
+    monkeypatch.setitem(sys.modules, "run_demo", types.SimpleNamespace(run_pose_estimation=run_pose_estimation))
+    monkeypatch.delitem(sys.modules, "pose_api_server", raising=False)
+    monkeypatch.syspath_prepend(REPO_DIR)
+    app = importlib.import_module("pose_api_server").app
+    b64 = lambda data: base64.b64encode(data).decode()
+    payload = {
+        "camera_matrix": [[500, 0, 320], [0, 500, 240], [0, 0, 1]],
+        "images": [{"filename": "000000", "rgb": b64(b"rgb"), "depth": b64(b"depth")}],
+        "mask": b64(b"mask"),
+        "mesh": b64(trimesh.creation.box(extents=(100, 60, 40)).export(file_type="ply")),
+    }
+    yield app.test_client(), payload, calls
+    sys.modules.pop("pose_api_server", None)
+
+
+@pytest.mark.parametrize("symmetries", [
+    [np.eye(4).reshape(-1).tolist()],
+    {"symmetries_discrete": [np.eye(4).reshape(-1).tolist()], "symmetries": []},
+    {"symmetries_discrete": [[1, 0, 0]]},
+    {"symmetries_discrete": [["a"] * 16]},
+    {"symmetries_continuous": [{"offset": [0, 0, 0]}]},
+    {"symmetries_continuous": [{"axis": [0, 0, 1], "offset": [0, 0]}]},
+    {"symmetries_continuous": []},
+])
+def test_server_rejects_invalid_symmetries(server, symmetries):
+    client, payload, calls = server
+    response = client.post("/foundationpose", json=dict(payload, symmetries=symmetries))
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid symmetries"
+    assert calls == []
+
+
+@pytest.mark.parametrize("symmetries, details", [
+    ([np.eye(4).reshape(-1).tolist()], "symmetries must be an object"),
+    ({"symmetries": []}, "unknown symmetries keys ['symmetries']"),
+])
+def test_server_names_the_invalid_symmetries(server, symmetries, details):
+    client, payload, calls = server
+    response = client.post("/foundationpose", json=dict(payload, symmetries=symmetries))
+    assert response.status_code == 400
+    assert response.get_json()["details"].startswith(details)
+
+
+@pytest.mark.parametrize("symmetries", [
+    None,
+    {"symmetries_discrete": [Utils.euler_matrix(0, 0, np.pi).reshape(-1).tolist()]},
+    {"symmetries_continuous": [{"axis": [0, 0, 1], "offset": [0, 0, 0]}]},
+])
+def test_server_passes_valid_symmetries_on(server, symmetries):
+    client, payload, calls = server
+    if symmetries is not None:
+        payload = dict(payload, symmetries=symmetries)
+    response = client.post("/foundationpose", json=payload)
+    assert response.status_code == 200, response.get_json()
+    assert calls == [symmetries]
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from conftest import make_scene, requires_cuda, requires_weights
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+# Input transfers, the depth roi box read back for slicing, the valid pixel check and the returned pose.
+# Hypotheses and refine iterations must not add any
+REGISTER_SYNC_BUDGET = 20
+TRACK_SYNC_BUDGET = 12
+
+
+def random_poses(n, rng, spread=0.02):
+    poses = np.tile(np.eye(4, dtype=np.float32), (n, 1, 1))
+    poses[:, :3, :3] = [Utils.random_rotation_matrix(rng.random(3))[:3, :3] for _ in range(n)]
+    poses[:, :3, 3] = rng.normal([0, 0, 0.5], spread, (n, 3))
+    return poses
+
+
+@pytest.mark.parametrize("n_sym", [1, 2, 4])
+def test_cluster_pose_ids_tensor_matches_numpy(n_sym):
+    rng = np.random.default_rng(n_sym)
+    poses = random_poses(200, rng)
+    poses[100:] = poses[:100] @ Utils.euler_matrix(0, 0, np.pi).astype(np.float32)   # Copies turned by a half turn about z
+    symmetry_tfs = np.stack([Utils.euler_matrix(0, 0, 2 * np.pi * i / n_sym) for i in range(n_sym)]).astype(np.float32)
+    keep = Utils.cluster_pose_ids(30, 0.05, poses, symmetry_tfs)
+    keep_tensor = Utils.cluster_pose_ids(30, 0.05, torch.as_tensor(poses), torch.as_tensor(symmetry_tfs))
+    assert torch.is_tensor(keep_tensor)
+    np.testing.assert_array_equal(keep_tensor.numpy(), keep)
+
+
+def test_guess_translation_tensor_matches_numpy(make_estimator, scene):
+    K, _, depth, mask = scene
+    est = make_estimator()
+    center = est.guess_translation(depth=depth, mask=mask, K=K)
+    center_tensor = est.guess_translation(depth=torch.as_tensor(depth), mask=torch.as_tensor(mask), K=K)
+    np.testing.assert_allclose(center_tensor.numpy(), center, atol=1e-6)
+
+
+def test_degenerate_frame_returns_the_translation_guess(make_estimator, scene):
+    K, rgb, depth, mask = scene
+    pose = make_estimator().register(K=K, rgb=rgb, depth=np.zeros_like(depth), ob_mask=mask, iteration=1)
+    np.testing.assert_allclose(pose, np.eye(4))
+
+
+@requires_cuda
+def test_estimator_syncs_do_not_grow_with_hypotheses(make_estimator):
+    from run_benchmark import count_syncs
+
+    K, rgb, depth, mask = make_scene()
+    counts = {}
+    for name, symmetry_tfs in [("plain", None), ("symmetric", Utils.euler_matrix(0, 0, np.pi)[None])]:
+        est = make_estimator(symmetry_tfs=symmetry_tfs, device="cuda")
+        est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=2)   # Warm up
+        _, counts[name] = count_syncs(est.register, K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=2)
+        track_counts = [count_syncs(est.track_one, rgb=rgb, depth=depth, K=K, iteration=2)[1] for _ in range(3)]
+        assert len(set(track_counts)) == 1, track_counts
+        assert track_counts[0] <= TRACK_SYNC_BUDGET
+    assert counts["plain"] <= REGISTER_SYNC_BUDGET
+    assert counts["symmetric"] <= counts["plain"] + 1   # Collapsing reads back the number of kept poses only
+
+
+@requires_cuda
+@requires_weights
+def test_pipeline_syncs_are_the_same_every_frame(box_mesh, tmp_path):
+    estimater = pytest.importorskip("estimater")
+    from run_benchmark import count_syncs
+
+    K, rgb, depth, mask = make_scene()
+    est = estimater.FoundationPose(model_pts=box_mesh.vertices, model_normals=box_mesh.vertex_normals, mesh=box_mesh, debug_dir=str(tmp_path), debug=0, device="cuda")
+    est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=2)
+    est.track_one(rgb=rgb, depth=depth, K=K, iteration=2)
+    counts = [count_syncs(est.track_one, rgb=rgb, depth=depth, K=K, iteration=2)[1] for _ in range(3)]
+    assert len(set(counts)) == 1, counts
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from conftest import IdentityRefiner
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+CROP_SIZE = (160, 160)
+CROP_RATIO = 1.2
+
+
+@pytest.fixture
+def bank_setup(box_mesh):
+    rng = np.random.default_rng(0)
+    rot_grid = torch.as_tensor(np.stack([Utils.random_rotation_matrix(rng.random(3)) for _ in range(6)]), dtype=torch.float)
+    rot_grid[:, :3, 3] = 0
+    mesh_tensors = Utils.make_mesh_tensors(box_mesh, device="cpu")
+    diameter = Utils.compute_mesh_diameter(model_pts=box_mesh.vertices, n_sample=1000)
+    return rot_grid, mesh_tensors, diameter
+
+
+def build(bank_setup, **kwargs):
+    rot_grid, mesh_tensors, diameter = bank_setup
+    return Utils.TemplateBank.build(rot_grid, mesh_tensors, diameter, render_size=CROP_SIZE, crop_ratio=CROP_RATIO, glctx=Utils.CpuRasterizeContext(), **kwargs)
+
+
+def test_rotation_to_ray_turns_the_optical_axis_onto_t():
+    t = torch.tensor([[0, 0, 1], [0.3, -0.2, 1], [-1, 0.5, 0.2]], dtype=torch.float)
+    R = Utils.rotation_to_ray(t)
+    torch.testing.assert_close(R @ R.transpose(1, 2), torch.eye(3).expand(3, 3, 3), atol=1e-6, rtol=0)
+    torch.testing.assert_close(torch.det(R), torch.ones(3))
+    torch.testing.assert_close(R[:, :, 2], t / t.norm(dim=-1, keepdim=True), atol=1e-6, rtol=0)
+    torch.testing.assert_close(R[0], torch.eye(3))
+
+
+@pytest.mark.parametrize("angle, depth, min_iou, max_color_err, max_xyz_err", [
+    (0, 4, 0.99, 3, 0.001),
+    (20, 4, 0.98, 8, 0.01),
+    (20, 2, 0.9, 8, 0.03),
+])
+def test_bank_crops_match_renders(bank_setup, angle, depth, min_iou, max_color_err, max_xyz_err):
+    """Bank crops warped to hypotheses off the optical axis and off the canonical depth stay close to rendering them, exactly so on the axis at canonical_depth"""
+    rot_grid, mesh_tensors, diameter = bank_setup
+    bank = build(bank_setup)
+    H, W = 240, 320
+    K = np.array([[300, 0, W / 2], [0, 300, H / 2], [0, 0, 1]], dtype=float)
+    center = torch.tensor([np.sin(np.deg2rad(angle)), 0, np.cos(np.deg2rad(angle))], dtype=torch.float) * depth * diameter
+    poses = bank.hypotheses(center)
+    torch.testing.assert_close(poses[:, :3, 3], center.expand(len(poses), 3))
+    tfs = Utils.compute_crop_window_tf_batch(poses=poses, K=K, crop_ratio=CROP_RATIO, out_size=CROP_SIZE[::-1], method="box_3d", mesh_diameter=diameter)
+    bbox2d = Utils.transform_pts(torch.tensor([[0, 0], [CROP_SIZE[1] - 1, CROP_SIZE[0] - 1]], dtype=torch.float), tfs.inverse()[:, None]).reshape(-1, 4)
+    extra = {}
+    color_ref, depth_ref, _ = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=Utils.CpuRasterizeContext(), mesh_tensors=mesh_tensors, output_size=CROP_SIZE, bbox2d=bbox2d, use_light=True, extra=extra)
+    color, depth_map, xyz_map = bank.crops(np.arange(len(poses)), poses, K, tfs)
+    assert color.shape == color_ref.shape and depth_map.shape == depth_ref.shape
+    torch.testing.assert_close(depth_map, xyz_map[..., 2])
+    mask, mask_ref = depth_map > 0, depth_ref > 0
+    both = mask & mask_ref
+    assert (both.sum() / (mask | mask_ref).sum()).item() >= min_iou
+    assert (color - color_ref).abs()[both].mean().item() * 255 <= max_color_err
+    assert (xyz_map - extra["xyz_map"]).norm(dim=-1)[both].mean().item() <= max_xyz_err * diameter
+
+
+def test_bank_covers_only_hypotheses_near_the_optical_axis(bank_setup):
+    bank = build(bank_setup, max_off_axis=30)
+    on_axis = bank.hypotheses(torch.tensor([0, 0, 0.5]))
+    assert bank.covers(on_axis)
+    assert bank.covers(bank.hypotheses(torch.tensor([0.5 * np.tan(np.deg2rad(25)), 0, 0.5])))
+    assert not bank.covers(torch.cat([on_axis, bank.hypotheses(torch.tensor([0, 0.5 * np.tan(np.deg2rad(35)), 0.5]))]))
+
+
+def test_bank_is_memory_mapped_from_cache_dir(bank_setup, tmp_path):
+    bank = build(bank_setup, cache_dir=str(tmp_path), key="box")
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = build(bank_setup, cache_dir=str(tmp_path), key="box")
+    assert isinstance(cached.rgba, np.memmap) and isinstance(cached.xyz, np.memmap)
+    np.testing.assert_array_equal(cached.rgba, bank.rgba)
+    np.testing.assert_array_equal(cached.xyz, bank.xyz)
+    build(bank_setup, cache_dir=str(tmp_path), key="other mesh")
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_register_starts_from_the_bank(make_estimator):
+    est = make_estimator(refiner=IdentityRefiner(input_resize=(32, 32)))
+    center = torch.tensor([0.05, 0, 0.5])
+    est.guess_translation = lambda **kwargs: center
+    plain = est.generate_random_pose_hypo(K=None, rgb=None, depth=None, mask=None)
+    torch.testing.assert_close(plain[:, :3, :3], est.rot_grid[:, :3, :3])
+    est.make_template_bank()
+    assert len(est.template_bank.rgba) == len(est.rot_grid)
+    turned = est.generate_random_pose_hypo(K=None, rgb=None, depth=None, mask=None)
+    torch.testing.assert_close(turned[:, :3, :3], Utils.rotation_to_ray(center[None]) @ est.rot_grid[:, :3, :3])
+    torch.testing.assert_close(turned[:, :3, 3], center.expand(len(turned), 3))
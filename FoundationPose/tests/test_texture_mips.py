@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from conftest import make_scene
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+def test_texture_size_for_crop():
+    assert Utils.texture_size_for_crop(160 / 1.2) == 1024
+    assert Utils.texture_size_for_crop(64) == 256
+
+
+def test_make_texture_mips_box_filters_down_to_min_size():
+    rng = np.random.default_rng(0)
+    tex = torch.as_tensor(rng.integers(0, 256, (1, 64, 48, 3)), dtype=torch.uint8)
+    mips = Utils.make_texture_mips(tex)
+    assert [mip.shape[1:3] for mip in mips] == [(64, 48), (32, 24), (16, 12)]
+    assert all(mip.dtype == torch.uint8 for mip in mips)
+    for fine, coarse in zip(mips[:-1], mips[1:]):
+        ref = fine.float().reshape(1, fine.shape[1] // 2, 2, fine.shape[2] // 2, 2, 3).mean(dim=(2, 4))
+        assert (coarse.float() - ref).abs().max() <= 0.5
+
+
+def test_select_texture_mip_picks_the_coarsest_with_enough_texels():
+    tex = torch.full((1, 64, 48, 3), 51, dtype=torch.uint8)
+    mesh_tensors = {"tex": tex, "tex_mips": Utils.make_texture_mips(tex)}
+    assert Utils.select_texture_mip(mesh_tensors).shape[1:3] == (64, 48)
+    assert Utils.select_texture_mip(mesh_tensors, lod_size=4).shape[1:3] == (16, 12)
+    assert Utils.select_texture_mip(mesh_tensors, lod_size=6).shape[1:3] == (32, 24)
+    assert Utils.select_texture_mip(mesh_tensors, lod_size=100).shape[1:3] == (64, 48)
+    picked = Utils.select_texture_mip(mesh_tensors, lod_size=4)
+    assert picked.dtype == torch.float
+    torch.testing.assert_close(picked, torch.full_like(picked, 0.2))
+    assert mesh_tensors["tex"].dtype == torch.uint8
+
+
+@pytest.mark.parametrize("lod_size", [None, 4, 100])
+def test_render_samples_the_uint8_texture(box_mesh, lod_size):
+    """A uniformly colored texture renders in its color whichever mip is picked, and stays uint8"""
+    K, _, depth, _ = make_scene()
+    H, W = depth.shape
+    mesh_tensors = Utils.make_mesh_tensors(box_mesh, device="cpu")
+    del mesh_tensors["vertex_color"]
+    tex = torch.as_tensor(np.tile(np.array([200, 80, 40], dtype=np.uint8), (1, 64, 64, 1)))
+    mesh_tensors["tex"] = tex
+    mesh_tensors["tex_mips"] = Utils.make_texture_mips(tex)
+    uv = torch.as_tensor(box_mesh.vertices[:, :2] / box_mesh.extents[:2] + 0.5, dtype=torch.float)
+    mesh_tensors["uv"] = uv
+    mesh_tensors["uv_idx"] = mesh_tensors["faces"]
+    pose = torch.eye(4)[None]
+    pose[0, 2, 3] = 0.5
+    color, depth, _ = Utils.nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=pose, glctx=Utils.CpuRasterizeContext(), mesh_tensors=mesh_tensors, lod_size=lod_size)
+    mask = depth[0] > 0
+    assert mask.sum() > 0
+    torch.testing.assert_close(color[0][mask], torch.tensor([200, 80, 40], dtype=torch.float).expand(mask.sum(), 3) / 255, atol=1e-5, rtol=0)
+    assert mesh_tensors["tex"].dtype == torch.uint8 and mesh_tensors["tex"] is tex
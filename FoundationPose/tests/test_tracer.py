@@ -0,0 +1,90 @@
+import json
+import logging
+
+import pytest
+
+torch = pytest.importorskip("torch")
+Utils = pytest.importorskip("Utils")
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Utils.Tracer()
+    assert tracer.span("render", n_pose=3) is tracer.span("forward")   # The shared no-op context
+    with tracer.span("render"):
+        pass
+    assert len(tracer.events) == 0
+
+
+def test_spans_export_as_chrome_trace(tmp_path):
+    tracer = Utils.Tracer()
+    tracer.enabled = True
+    with tracer.span("before"):
+        pass
+    since = tracer.now()
+    with tracer.span("register"):
+        with tracer.span("render", n_pose=252):
+            pass
+    trace = tracer.export_chrome_trace(str(tmp_path / "trace.json"), since=since)
+    with open(tmp_path / "trace.json") as f:
+        assert json.load(f) == trace
+    events = trace["traceEvents"]
+    assert [e["name"] for e in events] == ["render", "register"]   # Recorded as they end
+    render, register = events
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert register["ts"] <= render["ts"] and render["ts"] + render["dur"] <= register["ts"] + register["dur"]
+    assert render["args"] == {"n_pose": 252}
+    assert len(tracer.export_chrome_trace()["traceEvents"]) == 3
+
+
+def test_tracer_keeps_the_latest_spans():
+    tracer = Utils.Tracer(capacity=4)
+    tracer.enabled = True
+    for i in range(10):
+        with tracer.span(f"span{i}"):
+            pass
+    assert [e["name"] for e in tracer.export_chrome_trace()["traceEvents"]] == ["span6", "span7", "span8", "span9"]
+    tracer.clear()
+    assert tracer.export_chrome_trace()["traceEvents"] == []
+
+
+def test_trace_span_decorator_uses_the_shared_tracer(monkeypatch):
+    monkeypatch.setattr(Utils, "tracer", Utils.Tracer())
+
+    @Utils.trace_span("score")
+    def score(x):
+        """Doc"""
+        return x + 1
+
+    assert score(1) == 2 and len(Utils.tracer.events) == 0
+    Utils.tracer.enabled = True
+    assert score(2) == 3
+    assert [e[0] for e in Utils.tracer.events] == ["score"]
+    assert score.__name__ == "score" and score.__doc__ == "Doc"
+
+
+def test_set_logging_format_keeps_an_existing_setup_unless_forced():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    handler = logging.NullHandler()
+    try:
+        root.handlers = [handler]
+        Utils.set_logging_format(force=False)
+        assert root.handlers == [handler]
+        Utils.set_logging_format(level=logging.WARNING)
+        assert handler not in root.handlers and root.level == logging.WARNING
+    finally:
+        root.handlers = handlers
+        root.setLevel(level)
+
+
+def test_register_and_track_record_their_stages(make_estimator, scene, monkeypatch):
+    monkeypatch.setattr(Utils.tracer, "enabled", True)
+    Utils.tracer.clear()
+    K, rgb, depth, mask = scene
+    est = make_estimator()
+    est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1)
+    est.track_one(rgb=rgb, depth=depth, K=K, iteration=1)
+    names = [e["name"] for e in Utils.tracer.export_chrome_trace()["traceEvents"]]
+    Utils.tracer.clear()
+    assert {"register", "hypothesis_generation", "preprocess_depth", "track"} <= set(names)
+    assert names.index("hypothesis_generation") < names.index("register") < names.index("track")
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from conftest import requires_weights
+
+torch = pytest.importorskip("torch")
+
+
+def test_track_one_keeps_tracking_after_the_first_frame(make_estimator, scene):
+    K, rgb, depth, mask = scene
+    est = make_estimator()
+    pose = est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1)
+    assert pose.shape == (4, 4)
+    for _ in range(3):
+        pose = est.track_one(rgb=rgb, depth=depth, K=K, iteration=1)
+        assert pose.shape == (4, 4)
+        assert est.pose_last.shape == (4, 4)
+    # Every frame refines the pose of the frame before
+    assert all(torch.allclose(poses, est.refiner.calls[-1]) for poses in est.refiner.calls[-3:])
+
+
+@requires_weights
+def test_register_then_track_with_the_networks(box_mesh, scene, tmp_path):
+    estimater = pytest.importorskip("estimater")
+    K, rgb, depth, mask = scene
+    est = estimater.FoundationPose(model_pts=box_mesh.vertices, model_normals=box_mesh.vertex_normals, mesh=box_mesh, debug_dir=str(tmp_path), debug=0, device="cuda" if torch.cuda.is_available() else "cpu")
+    est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=1)
+    poses = [est.track_one(rgb=rgb, depth=depth, K=K, iteration=1) for _ in range(2)]
+    assert all(np.isfinite(pose).all() and pose.shape == (4, 4) for pose in poses)
@@ -7,6 +7,7 @@ import torch
 # make FoundationPose importable, assume under same parent directory, change as needed\
 sys.path.append(os.path.join(".", "FoundationPose"))
 from run_demo import run_pose_estimation
+from Utils import symmetry_tfs_from_info
 
 app = Flask(__name__)
 
@@ -94,7 +95,7 @@ def foundationpose():
 
     try:
         # auto-parse nested JSON strings (often happens with form posts)
-        for key in ["camera_matrix", "images", "mesh"]:
+        for key in ["camera_matrix", "images", "mesh", "symmetries"]:
             if (
                 key in data
                 and isinstance(data[key], str)
@@ -105,6 +106,27 @@ def foundationpose():
         traceback.print_exc()
         return jsonify({"error": "Invalid JSON format!", "details": str(e)}), 402
 
+    # optional object symmetries, BOP models_info style (translations in mm)
+    symmetries = data.get("symmetries")
+    try:
+        if symmetries is not None:
+            if not isinstance(symmetries, dict):
+                raise ValueError("symmetries must be an object")
+            unknown = set(symmetries) - {"symmetries_discrete", "symmetries_continuous"}
+            if unknown:
+                raise ValueError(f"unknown symmetries keys {sorted(unknown)}")
+            symmetry_tfs_from_info(symmetries)  # raises on malformed transforms, axes or offsets
+    except Exception as e:
+        return (
+            jsonify(
+                {
+                    "error": "Invalid symmetries",
+                    "details": f"{e}. symmetries must be an object with symmetries_discrete (flattened 4x4 transforms) and/or symmetries_continuous (axis and offset)",
+                }
+            ),
+            400,
+        )
+
     os.makedirs(os.path.join(FOUNDATION_POSE_DIR, "saved_requests"), exist_ok=True)
 
     # Stage 2: save files on disk
@@ -121,6 +143,11 @@ def foundationpose():
         for row in data["camera_matrix"]:
             f.write(f"{row[0]} {row[1]} {row[2]}\n")
 
+    # save symmetries
+    if symmetries is not None:
+        with open(os.path.join(base, "symmetries.json"), "w") as f:
+            json.dump(symmetries, f)
+
     # save images and depth
     for img in data["images"]:
         filename = img["filename"]
@@ -153,6 +180,7 @@ def foundationpose():
                 test_scene_dir=base,
                 mesh_file=os.path.join(base, "mesh", filenames[0] + ".ply"),
                 debug_dir=os.path.join(FOUNDATION_POSE_DIR, "debug"),
+                symmetry_info=symmetries,
             )
     except Exception as e:
         # print error in terminal and return error json on failure
@@ -160,8 +188,9 @@ def foundationpose():
         return jsonify({"error": "Pose estimation failed", "details": str(e)}), 403
     finally:
         # free GPU memory for the next request
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
         gc.collect()
 
     # Stage 4: read result matrix